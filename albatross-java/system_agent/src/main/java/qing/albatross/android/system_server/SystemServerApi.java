@@ -51,6 +51,12 @@ public interface SystemServerApi {
 
   String getFrontActivityQuick();
 
+  String getPackages(boolean thirdParty, boolean includeDisabled);
+
+  String getMainActivities(String pkgName);
+
+  boolean isScreenOn();
+
 
   @Broadcast
   byte launchProcess(String data);
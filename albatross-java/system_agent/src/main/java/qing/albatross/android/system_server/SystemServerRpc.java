@@ -26,8 +26,10 @@ import android.content.pm.ApplicationInfo;
 import android.content.pm.PackageManager;
 import android.content.pm.ResolveInfo;
 import android.os.Build;
+import android.os.PowerManager;
 import android.os.UserHandle;
 
+import java.util.ArrayList;
 import java.util.HashMap;
 import java.util.List;
 import java.util.Map;
@@ -368,5 +370,37 @@ public class SystemServerRpc extends UnixRpcInstance implements SystemServerApi
     return JsonFormatter.fmt(getAppProcessList(), false);
   }
 
+  @Override
+  public String getPackages(boolean thirdParty, boolean includeDisabled) {
+    List<ApplicationInfo> applications = context.getPackageManager().getInstalledApplications(0);
+    List<String> packages = new ArrayList<>(applications.size());
+    for (ApplicationInfo info : applications) {
+      if (thirdParty && (info.flags & ApplicationInfo.FLAG_SYSTEM) != 0)
+        continue;
+      if (!includeDisabled && !info.enabled)
+        continue;
+      packages.add(info.packageName);
+    }
+    return JsonFormatter.fmt(packages.toArray());
+  }
+
+  @Override
+  public String getMainActivities(String pkgName) {
+    Intent intent = new Intent(Intent.ACTION_MAIN);
+    intent.setPackage(pkgName);
+    List<ResolveInfo> resolveInfos = context.getPackageManager().queryIntentActivities(intent, 0);
+    Object[] activities = new Object[resolveInfos.size()];
+    for (int i = 0; i < activities.length; i++) {
+      activities[i] = pkgName + "/" + resolveInfos.get(i).activityInfo.name;
+    }
+    return JsonFormatter.fmt(activities);
+  }
+
+  @Override
+  public boolean isScreenOn() {
+    PowerManager powerManager = (PowerManager) context.getSystemService(Context.POWER_SERVICE);
+    return powerManager.isInteractive();
+  }
+
 
 }
@@ -13,10 +13,12 @@
 # limitations under the License.
 
 from typing import Optional
-from . import device
+from . import device, metrics_server
 
 __version__ = "1.0.0"
 
 
 def get_device(device_id: Optional[str] = None) -> device.AlbatrossDevice:
-  return device.get_device_manager().get_devices(device_id)
+  manager = device.get_device_manager()
+  metrics_server.start_configured_metrics_server(manager)
+  return manager.get_devices(device_id)
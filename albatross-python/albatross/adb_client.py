@@ -0,0 +1,336 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Client of the adb server smart socket protocol, so device operations do not spawn
+# the adb binary. A request is its length as 4 hex digits followed by the request,
+# the server answers OKAY or FAIL plus a hex length prefixed message. Requests for
+# one device switch the socket to it with host:transport:<serial> first, after that
+# the socket talks to a device service such as shell: or sync:.
+
+import os
+import socket
+import stat
+import struct
+import uuid
+
+from .common import Configuration, OUT_TIME_CODE, FAULT_CODE, run_shell
+from .shell_session import ShellSession, wrap_command, parse_marker, strip_marker_newline
+from .wrapper import cached_class_property
+
+SHELL_V2_STDIN = 0
+SHELL_V2_STDOUT = 1
+SHELL_V2_STDERR = 2
+SHELL_V2_EXIT = 3
+SHELL_V2_CLOSE_STDIN = 4
+
+SYNC_DATA_MAX = 64 * 1024
+
+shell_v2_head = struct.Struct('<BI')
+sync_head = struct.Struct('<4sI')
+sync_stat = struct.Struct('<4sIII')
+
+
+class AdbError(Exception):
+  pass
+
+
+def recv_exact(sock, n):
+  buf = bytearray(n)
+  view = memoryview(buf)
+  pos = 0
+  while pos < n:
+    got = sock.recv_into(view[pos:])
+    if not got:
+      raise AdbError('adb connection closed')
+    pos += got
+  return bytes(buf)
+
+
+def recv_all(sock):
+  chunks = []
+  while True:
+    chunk = sock.recv(65536)
+    if not chunk:
+      return b''.join(chunks)
+    chunks.append(chunk)
+
+
+def close_socket(sock):
+  try:
+    sock.shutdown(socket.SHUT_RDWR)
+  except OSError:
+    pass
+  sock.close()
+
+
+class AdbClient(object):
+
+  def __init__(self, host='127.0.0.1', port=5037, timeout=10):
+    self.host = host
+    self.port = port
+    self.timeout = timeout
+    self.features_cache = {}
+
+  def __repr__(self):
+    return 'adb-{}:{}'.format(self.host, self.port)
+
+  def create_connection(self, timeout=None):
+    sock = socket.create_connection((self.host, self.port), timeout or self.timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+  @staticmethod
+  def send_request(sock, request: str):
+    bs = request.encode()
+    sock.sendall(b'%04x' % len(bs) + bs)
+
+  @staticmethod
+  def read_hex_data(sock):
+    n = int(recv_exact(sock, 4), 16)
+    return recv_exact(sock, n) if n else b''
+
+  def check_status(self, sock, request):
+    status = recv_exact(sock, 4)
+    if status == b'OKAY':
+      return
+    if status == b'FAIL':
+      raise AdbError('{} fail: {}'.format(request, self.read_hex_data(sock).decode(errors='replace')))
+    raise AdbError('{} unexpected status {}'.format(request, status))
+
+  def host_request(self, request, has_data=True):
+    sock = self.create_connection()
+    try:
+      self.send_request(sock, request)
+      self.check_status(sock, request)
+      if has_data:
+        return self.read_hex_data(sock)
+      return None
+    finally:
+      sock.close()
+
+  def available(self):
+    try:
+      self.version()
+      return True
+    except (OSError, AdbError):
+      return False
+
+  def version(self):
+    return int(self.host_request('host:version'), 16)
+
+  def devices(self):
+    """return [(serial, state)]"""
+    data = self.host_request('host:devices').decode()
+    devices = []
+    for line in data.splitlines():
+      parts = line.split()
+      if len(parts) >= 2:
+        devices.append((parts[0], parts[1]))
+    return devices
+
+  def connect(self, address):
+    return self.host_request('host:connect:' + address).decode()
+
+  def disconnect(self, address):
+    return self.host_request('host:disconnect:' + address).decode()
+
+  def features(self, serial):
+    features = self.features_cache.get(serial)
+    if features is None:
+      try:
+        features = set(self.host_request('host-serial:{}:features'.format(serial)).decode().split(','))
+      except AdbError:
+        features = set()
+      self.features_cache[serial] = features
+    return features
+
+  def forward(self, serial, local, remote):
+    request = 'host-serial:{}:forward:{};{}'.format(serial, local, remote)
+    sock = self.create_connection()
+    try:
+      self.send_request(sock, request)
+      # one status for the host service, one for the forward itself
+      self.check_status(sock, request)
+      self.check_status(sock, request)
+    finally:
+      sock.close()
+
+  def list_forward(self, serial=None):
+    if serial:
+      data = self.host_request('host-serial:{}:list-forward'.format(serial))
+    else:
+      data = self.host_request('host:list-forward')
+    return [line.split() for line in data.decode().splitlines() if line.strip()]
+
+  def transport(self, serial, service, timeout=None):
+    """return a socket connected to service on the device"""
+    sock = self.create_connection(timeout)
+    try:
+      request = 'host:transport:' + serial
+      self.send_request(sock, request)
+      self.check_status(sock, request)
+      self.send_request(sock, service)
+      self.check_status(sock, service)
+    except BaseException:
+      sock.close()
+      raise
+    return sock
+
+  def open_shell(self, serial, cmd, timeout=None):
+    """raw shell without the v2 packet framing, the returned socket carries stdin and stdout"""
+    sock = self.transport(serial, 'shell:' + cmd)
+    sock.settimeout(timeout)
+    return sock
+
+  def shell(self, serial, cmd, timeout=20):
+    """run cmd and return (ret_code, output) like common.run_shell"""
+    try:
+      if 'shell_v2' in self.features(serial):
+        return self.shell_v2(serial, cmd, timeout)
+      return self.shell_v1(serial, cmd, timeout)
+    except socket.timeout:
+      return OUT_TIME_CODE, b''
+    except (OSError, AdbError) as e:
+      return FAULT_CODE, str(e).encode()
+
+  def shell_v2(self, serial, cmd, timeout):
+    sock = self.transport(serial, 'shell,v2,raw:' + cmd, timeout)
+    try:
+      sock.settimeout(timeout)
+      sock.sendall(shell_v2_head.pack(SHELL_V2_CLOSE_STDIN, 0))
+      stdout = []
+      stderr = []
+      ret_code = FAULT_CODE
+      while True:
+        try:
+          packet_id, n = shell_v2_head.unpack(recv_exact(sock, 5))
+        except AdbError:
+          break
+        data = recv_exact(sock, n) if n else b''
+        if packet_id == SHELL_V2_STDOUT:
+          stdout.append(data)
+        elif packet_id == SHELL_V2_STDERR:
+          stderr.append(data)
+        elif packet_id == SHELL_V2_EXIT:
+          ret_code = data[0]
+          break
+    finally:
+      sock.close()
+    stdout = b''.join(stdout)
+    stderr = b''.join(stderr)
+    # same layout as run_shell
+    if stdout and stderr:
+      return ret_code, b"\nError:\n".join([stdout, stderr])
+    if stderr:
+      return ret_code, b"Error:\n" + stderr
+    return ret_code, stdout
+
+  def shell_v1(self, serial, cmd, timeout):
+    # the old protocol has no exit code, print it after a marker like ShellSession
+    marker = ('__albatross_' + uuid.uuid4().hex + '__').encode()
+    sock = self.transport(serial, 'shell:' + wrap_command(cmd, marker).decode(), timeout)
+    try:
+      sock.settimeout(timeout)
+      data = recv_all(sock).replace(b'\r\n', b'\n')
+    finally:
+      sock.close()
+    idx = data.rfind(marker)
+    if idx < 0:
+      return FAULT_CODE, data
+    return parse_marker(data[idx:].split(b'\n', 1)[0], marker), strip_marker_newline(data[:idx])
+
+  def root(self, serial):
+    sock = self.transport(serial, 'root:')
+    try:
+      return recv_all(sock)
+    finally:
+      sock.close()
+
+  def stat(self, serial, path):
+    """return (mode, size, mtime), mode is 0 when path does not exist"""
+    sock = self.transport(serial, 'sync:')
+    try:
+      bs = path.encode()
+      sock.sendall(sync_head.pack(b'STAT', len(bs)) + bs)
+      ident, mode, size, mtime = sync_stat.unpack(recv_exact(sock, sync_stat.size))
+      if ident != b'STAT':
+        raise AdbError('stat {} unexpected reply {}'.format(path, ident))
+      sock.sendall(sync_head.pack(b'QUIT', 0))
+      return mode, size, mtime
+    finally:
+      sock.close()
+
+  def push(self, serial, local, remote, mode=None):
+    if remote.endswith('/'):
+      remote += os.path.basename(local)
+    st = os.stat(local)
+    if mode is None:
+      mode = st.st_mode
+    spec = '{},{}'.format(remote, stat.S_IFREG | (mode & 0o777)).encode()
+    sock = self.transport(serial, 'sync:')
+    try:
+      sock.sendall(sync_head.pack(b'SEND', len(spec)) + spec)
+      with open(local, 'rb') as fp:
+        while True:
+          chunk = fp.read(SYNC_DATA_MAX)
+          if not chunk:
+            break
+          sock.sendall(sync_head.pack(b'DATA', len(chunk)) + chunk)
+      sock.sendall(sync_head.pack(b'DONE', int(st.st_mtime)))
+      ident, n = sync_head.unpack(recv_exact(sock, sync_head.size))
+      if ident != b'OKAY':
+        msg = recv_exact(sock, n).decode(errors='replace') if ident == b'FAIL' else str(ident)
+        raise AdbError('push {} to {} fail: {}'.format(local, remote, msg))
+      sock.sendall(sync_head.pack(b'QUIT', 0))
+    finally:
+      sock.close()
+    return '{}: 1 file pushed, {} bytes'.format(local, st.st_size)
+
+
+class AdbShellSession(ShellSession):
+  """ShellSession over a raw shell: socket of the adb server instead of an adb process"""
+
+  def __init__(self, client: AdbClient, serial, cmd, name=None):
+    super().__init__(['shell:' + cmd], name or '{}-{}'.format(serial, cmd))
+    self.client = client
+    self.serial = serial
+    self.cmd = cmd
+
+  def open(self):
+    sock = self.client.open_shell(self.serial, self.cmd)
+    return sock.makefile('wb'), sock.makefile('rb'), lambda: close_socket(sock)
+
+
+_adb_client = None
+
+
+def get_adb_client() -> AdbClient | None:
+  """
+  The adb server client chosen by adb_backend: 'socket' always uses it, 'binary'
+  never does and 'auto' uses it when the server answers, starting it once with the
+  adb binary if needed. None means every operation spawns the adb binary.
+  """
+  global _adb_client
+  if _adb_client is None:
+    backend = Configuration.adb_backend
+    client = None
+    if backend != 'binary':
+      client = AdbClient('127.0.0.1', Configuration.adb_server_port)
+      if backend == 'auto' and not client.available():
+        if Configuration.adb is not cached_class_property.nil_value:
+          run_shell(Configuration.adb + ' start-server')
+        if not client.available():
+          client = None
+    _adb_client = client or False
+  return _adb_client or None
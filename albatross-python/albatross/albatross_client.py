@@ -15,6 +15,7 @@
 import struct
 from enum import IntEnum, IntFlag
 
+from .async_rpc_client import AsyncRpcClient
 from .rpc_client import RpcClient
 from .rpc_client import rpc_api, broadcast_api, void, ByteEnum
 
@@ -157,3 +158,7 @@ class AlbatrossClient(RpcClient):
   def launch_process(self, process_info: dict):
     if self.can_send:
       raise Exception("launch_process should register handler")
+
+
+class AsyncAlbatrossClient(AsyncRpcClient, AlbatrossClient):
+  pass
@@ -0,0 +1,335 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import inspect
+import struct
+import threading
+import time
+import traceback
+import zlib
+
+from .rpc_client import AlbRpcMethod, RpcClient, RpcCloseException, RpcSendException, BanRequestException, \
+  JustReturn, MSG_APIS, BROADCAST_RESULT_NO_HANDLER, void, pack_frame, binary_return_convertors, \
+  FRAME_HEAD_LEN, FRAME_LEN_MASK, COMPRESSED_LEN_MASK, FLAG_COMPRESSED
+
+
+async def read_frame(reader: asyncio.StreamReader, compressed=False):
+  try:
+    bs = await reader.readexactly(8)
+  except asyncio.IncompleteReadError:
+    raise RpcCloseException("not get head data")
+  if bs[:2] != b'wq':
+    raise struct.error('wrong head:' + str(bs))
+  idx, len_result = struct.unpack('<HI', bs[2:])
+  if compressed:
+    data_len = len_result & COMPRESSED_LEN_MASK
+    inflate = len_result & FLAG_COMPRESSED
+  else:
+    data_len = len_result & FRAME_LEN_MASK
+    inflate = 0
+  result = len_result >> 24
+  if data_len:
+    try:
+      data = await reader.readexactly(data_len)
+    except asyncio.IncompleteReadError:
+      raise RpcCloseException('socket close')
+    if inflate:
+      data = zlib.decompress(data)
+  else:
+    data = None
+  if result >= 128:
+    result -= 256
+  return idx, result, data
+
+
+class AsyncRpcMethod(AlbRpcMethod):
+
+  async def __call__(self, *args, hint=None, timeout=None, **kwargs):
+    client = self.client
+    method_name = self.name
+    if client.prohibit_request:
+      raise BanRequestException('forbid request {} this time'.format(method_name))
+    assert not kwargs
+    method_id = client.next_call_id()
+    method_id_name = self.log_request(method_id, args, hint)
+    content = self.handler(*args)
+    if content and not isinstance(content, bytes):
+      if isinstance(content, JustReturn):
+        return content.result
+      content = str(content).encode()
+    sent = FRAME_HEAD_LEN + len(content) if content else FRAME_HEAD_LEN
+    start = time.time()
+    client.last_request_time = start
+    metrics = self.metrics
+    if metrics is None:
+      result, data = await client.request(content, method_id, self.rpc_id, self.parser != void, timeout)
+      return self.handle_response(result, data, method_id_name, time.time() - start)
+    # the request is written and awaited in one step, its time counts as wait
+    begin = time.perf_counter()
+    wait_end = 0
+    received = 0
+    try:
+      result, data = await client.request(content, method_id, self.rpc_id, self.parser != void, timeout)
+      wait_end = time.perf_counter()
+      if result is not None:
+        received = FRAME_HEAD_LEN + len(data) if data else FRAME_HEAD_LEN
+      data = self.handle_response(result, data, method_id_name, time.time() - start)
+    except BaseException:
+      end = time.perf_counter()
+      if wait_end:
+        metrics.record(None, wait_end - begin, end - wait_end, sent, received, True)
+      else:
+        metrics.record(None, end - begin, None, sent, 0, True)
+      raise
+    metrics.record(None, wait_end - begin, time.perf_counter() - wait_end, sent, received)
+    return data
+
+
+class AsyncRpcClient(RpcClient):
+  """
+  asyncio flavour of RpcClient. The rpc and broadcast tables are the ones RpcMeta
+  generates for the sync class, so an async client is declared by mixing this class
+  in front of an existing client, e.g. class AsyncFoo(AsyncRpcClient, FooClient).
+  Rpc methods return awaitables and broadcast handlers may be coroutine functions.
+  """
+  rpc_method_class = AsyncRpcMethod
+  reader: asyncio.StreamReader | None = None
+  writer: asyncio.StreamWriter | None = None
+  read_task: asyncio.Task | None = None
+  subscribed = False
+  # broadcasts are handled one at a time on the event loop, plain attributes replace the
+  # per thread reply state of RpcClient
+  can_send = True
+  send_count = 0
+  idx = None
+
+  def __init__(self, host, port, name=None, timeout=None, server_key=None):
+    self.host = host
+    self.port = port
+    self.server_key = server_key
+    if timeout:
+      self.default_timeout = timeout
+    if name is None:
+      name = self.__class__.__name__.lower() + '-{}'.format(port)
+    self.name = name
+    self.pending_calls = {}
+    self.call_id_lock = threading.Lock()
+    # the tables come with connect, until then every call fails as on a closed client
+    self.allow_apis = {}
+    self.broadcast_tables = {}
+    self.broadcast_id_maps = {}
+
+  @classmethod
+  async def create(cls, host, port, name=None, timeout=None, server_key=None):
+    client = cls(host, port, name, timeout, server_key)
+    await client.connect()
+    return client
+
+  async def connect(self):
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), 20)
+    try:
+      api_table = self.cached_api_table()
+      head, payload = pack_frame(self.handshake_payload(api_table), self.call_counter, MSG_APIS)
+      self.call_counter += 1
+      writer.write(head)
+      if payload:
+        writer.write(payload)
+      await writer.drain()
+      idx, result, data = await asyncio.wait_for(read_frame(reader), 20)
+      self.handle_handshake(result, data, api_table)
+    except BaseException:
+      writer.close()
+      raise
+    self.reader = reader
+    self.writer = writer
+    self.sock = writer.get_extra_info('socket')
+    self.connect_time = time.time()
+    self.connect_count += 1
+    self.subscribed = False
+    self.read_task = asyncio.get_running_loop().create_task(self.__read_loop(reader, writer))
+
+  async def reconnect(self):
+    try:
+      if not self.sock:
+        await self.connect()
+        return True
+    except:
+      pass
+    return False
+
+  async def try_connect(self):
+    try:
+      if self.sock:
+        await self.ping(timeout=5)
+        return True
+    except:
+      pass
+    try:
+      await self.connect()
+      await self.ping(timeout=5)
+      return True
+    except:
+      return False
+
+  def write_frame(self, data, call_id, cmd):
+    writer = self.writer
+    if writer is None or not self.sock:
+      raise RpcCloseException("connection is closed")
+    data, flags = self.compress_payload(data)
+    head, data = pack_frame(data, call_id, cmd, flags)
+    if data:
+      writer.writelines([head, data])
+    else:
+      writer.write(head)
+
+  async def request(self, content, call_id, cmd, wait_response=True, timeout=None):
+    pending_calls = self.pending_calls
+    future = None
+    if wait_response:
+      future = asyncio.get_running_loop().create_future()
+      pending_calls[call_id] = (future, cmd)
+    try:
+      self.write_frame(content, call_id, cmd)
+      await self.writer.drain()
+    except BaseException:
+      pending_calls.pop(call_id, None)
+      raise
+    if future is None:
+      return None, None
+    try:
+      return await asyncio.wait_for(future, timeout or self.default_timeout)
+    except asyncio.TimeoutError:
+      pending_calls.pop(call_id, None)
+      raise TimeoutError(f'{self.name} wait response {call_id} timeout')
+
+  async def __read_loop(self, reader, writer):
+    pending_calls = self.pending_calls
+    try:
+      while self.writer is writer:
+        idx, result, data = await read_frame(reader, self.compress)
+        if self.subscribed:
+          await self.dispatch_broadcast(idx, result, data)
+          continue
+        future, cmd = pending_calls.pop(idx, (None, None))
+        if future is None:
+          print(f'{self.name} drop response {idx} which has no caller')
+          continue
+        if result >= 0 and cmd == self.allow_apis.get('subscribe'):
+          # from now on every frame on this connection is a broadcast
+          self.subscribed = True
+        if not future.done():
+          future.set_result((result, data))
+    except asyncio.CancelledError:
+      pass
+    except Exception as e:
+      if self.writer is writer and self.continuous:
+        traceback.print_exc()
+        print(f'{self.name} reader close:', e)
+    for call_id in list(pending_calls):
+      future, _ = pending_calls.pop(call_id)
+      if not future.done():
+        future.set_exception(RpcCloseException(f'{self.name} closed before response {call_id}'))
+    if self.writer is writer:
+      self.on_close(True, writer)
+
+  async def dispatch_broadcast(self, idx, cmd, data):
+    broadcast_name = self.broadcast_id_maps.get(cmd)
+    should_send = idx & 1
+    to_send = b'send empty'
+    args = None
+    self.idx = idx
+    if should_send:
+      self.can_send = True
+      self.send_count = 0
+    else:
+      self.can_send = False
+    try:
+      if broadcast_name:
+        arg_parser = getattr(self, 'receive_' + broadcast_name)
+        args = arg_parser(data)
+        handler = getattr(self, 'handle_' + broadcast_name)
+        result = handler(*args)
+        if inspect.isawaitable(result):
+          result = await result
+        convertor = getattr(self, 'result_' + broadcast_name, None)
+        if convertor and self.binary_payload:
+          convertor = binary_return_convertors.get(convertor, convertor)
+        if convertor:
+          cmd, idx, to_send = convertor(cmd, idx, result)
+      else:
+        cmd = BROADCAST_RESULT_NO_HANDLER
+        print('no handler! receive', idx, cmd, data)
+    except Exception as e:
+      traceback.print_exc()
+    if should_send and not self.send_count:
+      self.send(cmd, to_send, idx)
+    if args is not None:
+      self.notify_broadcast_listeners(broadcast_name, args)
+
+  def send(self, cmd, data, idx):
+    if self.can_send:
+      self.write_frame(data, idx, cmd)
+    else:
+      raise RpcSendException('can not send data {}'.format(data))
+    self.send_count += 1
+
+  def parse_subscribe(self, data, result):
+    return result >= 0
+
+  async def join_subscribe(self):
+    read_task = self.read_task
+    if read_task is not None and self.subscribed:
+      await asyncio.shield(read_task)
+
+  async def create_subscriber(self, handlers: dict | None = None) -> 'AsyncRpcClient':
+    if self.subscriber:
+      return self.subscriber
+    subscriber = await self.__class__.create(self.host, self.port, self.name + ':subscribe', self.default_timeout,
+      self.server_key)
+    for broadcast_name, handler in (handlers or {}).items():
+      subscriber.register_broadcast_handler(broadcast_name, handler)
+    await subscriber.subscribe()
+    self.subscriber = subscriber
+    subscriber.set_on_close_listener(self._subscriber_close)
+    return subscriber
+
+  def close(self):
+    writer = self.writer
+    if writer is None or not self.sock:
+      return False
+    self.sock = None
+    self.writer = None
+    writer.close()
+    read_task = self.read_task
+    if read_task is not None and read_task is not asyncio.current_task():
+      read_task.cancel()
+    for call_id in list(self.pending_calls):
+      future, _ = self.pending_calls.pop(call_id)
+      if not future.done():
+        future.set_exception(RpcCloseException(f'{self.name} closed before response {call_id}'))
+    if self.on_close_callback:
+      try:
+        self.on_close_callback(self)
+      except:
+        traceback.print_exc()
+    return True
+
+  async def wait_closed(self):
+    read_task = self.read_task
+    if read_task is not None:
+      try:
+        await read_task
+      except asyncio.CancelledError:
+        pass
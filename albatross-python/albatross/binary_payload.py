@@ -0,0 +1,163 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compact typed encoding for dict/list rpc payloads, used instead of json strings
+# when both sides agree on CAP_BINARY_PAYLOAD during the MSG_APIS handshake.
+# Every value is a one byte tag followed by its body, all little endian:
+#   nil/false/true      tag only
+#   int32/int64/double  fixed width body
+#   str8/str16/str32    u8/u16/u32 byte length then utf-8 bytes
+#   bin32               u32 length then raw bytes
+#   list32/map32        u32 count then the items, a map item is key then value
+
+import struct
+
+TAG_NIL = 0x00
+TAG_FALSE = 0x01
+TAG_TRUE = 0x02
+TAG_INT32 = 0x03
+TAG_INT64 = 0x04
+TAG_DOUBLE = 0x05
+TAG_STR8 = 0x06
+TAG_STR16 = 0x07
+TAG_STR32 = 0x08
+TAG_BIN32 = 0x09
+TAG_LIST32 = 0x0a
+TAG_MAP32 = 0x0b
+
+_u8 = struct.Struct('<B')
+_u16 = struct.Struct('<H')
+_u32 = struct.Struct('<I')
+_i32 = struct.Struct('<i')
+_i64 = struct.Struct('<q')
+_double = struct.Struct('<d')
+
+_tag_u32 = struct.Struct('<BI')
+_tag_i32 = struct.Struct('<Bi')
+_tag_i64 = struct.Struct('<Bq')
+_tag_double = struct.Struct('<Bd')
+_tag_u8 = struct.Struct('<BB')
+_tag_u16 = struct.Struct('<BH')
+
+
+class BinaryPayloadError(ValueError):
+  pass
+
+
+def _dump(o, pieces):
+  if o is None:
+    pieces.append(b'\x00')
+  elif o is True:
+    pieces.append(b'\x02')
+  elif o is False:
+    pieces.append(b'\x01')
+  elif isinstance(o, int):
+    if -0x80000000 <= o <= 0x7fffffff:
+      pieces.append(_tag_i32.pack(TAG_INT32, o))
+    elif -0x8000000000000000 <= o <= 0x7fffffffffffffff:
+      pieces.append(_tag_i64.pack(TAG_INT64, o))
+    else:
+      raise BinaryPayloadError('int {} does not fit int64'.format(o))
+  elif isinstance(o, float):
+    pieces.append(_tag_double.pack(TAG_DOUBLE, o))
+  elif isinstance(o, str):
+    bs = o.encode()
+    n = len(bs)
+    if n <= 0xff:
+      pieces.append(_tag_u8.pack(TAG_STR8, n))
+    elif n <= 0xffff:
+      pieces.append(_tag_u16.pack(TAG_STR16, n))
+    else:
+      pieces.append(_tag_u32.pack(TAG_STR32, n))
+    pieces.append(bs)
+  elif isinstance(o, dict):
+    pieces.append(_tag_u32.pack(TAG_MAP32, len(o)))
+    for k, v in o.items():
+      _dump(k, pieces)
+      _dump(v, pieces)
+  elif isinstance(o, (list, tuple)):
+    pieces.append(_tag_u32.pack(TAG_LIST32, len(o)))
+    for v in o:
+      _dump(v, pieces)
+  elif isinstance(o, (bytes, bytearray, memoryview)):
+    pieces.append(_tag_u32.pack(TAG_BIN32, len(o)))
+    pieces.append(o)
+  else:
+    raise BinaryPayloadError('can not encode {}'.format(type(o)))
+
+
+def dumps(o) -> bytes:
+  pieces = []
+  _dump(o, pieces)
+  return b''.join(pieces)
+
+
+def _bytes(data, idx, n):
+  end = idx + n
+  if end > len(data):
+    raise BinaryPayloadError('truncated payload: {} bytes at {}, {} left'.format(n, idx, len(data) - idx))
+  return data[idx:end], end
+
+
+def _load(data, idx):
+  tag = data[idx]
+  idx += 1
+  if tag == TAG_STR8:
+    bs, idx = _bytes(data, idx + 1, data[idx])
+    return str(bs, 'utf-8'), idx
+  if tag == TAG_INT32:
+    return _i32.unpack_from(data, idx)[0], idx + 4
+  if tag == TAG_MAP32:
+    n, = _u32.unpack_from(data, idx)
+    idx += 4
+    d = {}
+    for _ in range(n):
+      k, idx = _load(data, idx)
+      d[k], idx = _load(data, idx)
+    return d, idx
+  if tag == TAG_LIST32:
+    n, = _u32.unpack_from(data, idx)
+    idx += 4
+    items = []
+    for _ in range(n):
+      v, idx = _load(data, idx)
+      items.append(v)
+    return items, idx
+  if tag == TAG_NIL:
+    return None, idx
+  if tag == TAG_TRUE:
+    return True, idx
+  if tag == TAG_FALSE:
+    return False, idx
+  if tag == TAG_INT64:
+    return _i64.unpack_from(data, idx)[0], idx + 8
+  if tag == TAG_DOUBLE:
+    return _double.unpack_from(data, idx)[0], idx + 8
+  if tag == TAG_STR16:
+    bs, idx = _bytes(data, idx + 2, _u16.unpack_from(data, idx)[0])
+    return str(bs, 'utf-8'), idx
+  if tag == TAG_STR32:
+    bs, idx = _bytes(data, idx + 4, _u32.unpack_from(data, idx)[0])
+    return str(bs, 'utf-8'), idx
+  if tag == TAG_BIN32:
+    bs, idx = _bytes(data, idx + 4, _u32.unpack_from(data, idx)[0])
+    return bytes(bs), idx
+  raise BinaryPayloadError('unknown tag {} at {}'.format(tag, idx - 1))
+
+
+def loads(data, idx=0):
+  try:
+    return _load(data, idx)
+  except (IndexError, struct.error) as e:
+    raise BinaryPayloadError('truncated payload: {}'.format(e))
@@ -0,0 +1,169 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import itertools
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+
+_stop_worker = object()
+
+
+class DispatcherClosed(Exception):
+  pass
+
+
+class OrderedDispatcher(object):
+  """
+  Runs submitted calls on a fixed set of worker threads. Calls with the same key run
+  one after another in submit order, calls with different keys run in parallel.
+  At most max_pending calls wait, a full submit blocks or, for a reader which must
+  not block, registers on_space and returns False.
+  """
+
+  def __init__(self, name, workers=4, max_pending=256):
+    self.name = name
+    self.max_pending = max_pending
+    self.lock = threading.Lock()
+    self.not_full = threading.Condition(self.lock)
+    # a key stays in key_calls while one of its calls runs, later calls queue behind it
+    self.key_calls = {}
+    self.ready_keys = queue.SimpleQueue()
+    self.pending = 0
+    self.space_waiters = []
+    self.closed = False
+    self.threads = []
+    for i in range(workers):
+      worker = threading.Thread(target=self.__work_loop, name='{}-{}'.format(name, i), daemon=True)
+      worker.start()
+      self.threads.append(worker)
+
+  def submit(self, key, fn, *args, on_space=None):
+    """
+    Queue fn(*args) behind the calls of key. When the queue is full and on_space is
+    given, return False instead of waiting, on_space is called once there is room.
+    """
+    with self.not_full:
+      while self.pending >= self.max_pending and not self.closed:
+        if on_space is not None:
+          self.space_waiters.append(on_space)
+          return False
+        self.not_full.wait()
+      if self.closed:
+        raise DispatcherClosed(self.name)
+      self.pending += 1
+      calls = self.key_calls.get(key)
+      if calls is None:
+        self.key_calls[key] = deque([(fn, args)])
+        self.ready_keys.put(key)
+      else:
+        calls.append((fn, args))
+    return True
+
+  def __work_loop(self):
+    ready_keys = self.ready_keys
+    while True:
+      key = ready_keys.get()
+      if key is _stop_worker:
+        return
+      with self.lock:
+        fn, args = self.key_calls[key].popleft()
+      try:
+        fn(*args)
+      except Exception:
+        traceback.print_exc()
+      with self.lock:
+        self.pending -= 1
+        self.not_full.notify()
+        if self.key_calls[key]:
+          ready_keys.put(key)
+        else:
+          del self.key_calls[key]
+        space_waiters = self.space_waiters
+        if space_waiters:
+          self.space_waiters = []
+      for on_space in space_waiters:
+        try:
+          on_space()
+        except Exception:
+          traceback.print_exc()
+
+  def close(self):
+    """stop the workers after the calls they run, calls still queued are dropped"""
+    with self.lock:
+      if self.closed:
+        return
+      self.closed = True
+      self.not_full.notify_all()
+    for _ in self.threads:
+      self.ready_keys.put(_stop_worker)
+
+
+class DeadlineTimer(object):
+  """One thread calling scheduled functions at their deadline, a cancelled entry is skipped."""
+
+  def __init__(self, name):
+    self.name = name
+    self.cond = threading.Condition()
+    self.heap = []
+    self.counter = itertools.count()
+    self.thread: threading.Thread | None = None
+
+  def schedule(self, delay, fn):
+    entry = [time.time() + delay, next(self.counter), fn]
+    with self.cond:
+      heapq.heappush(self.heap, entry)
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.__timer_loop, name=self.name, daemon=True)
+        self.thread.start()
+      self.cond.notify()
+    return entry
+
+  @staticmethod
+  def cancel(entry):
+    entry[2] = None
+
+  def __timer_loop(self):
+    heap = self.heap
+    while True:
+      with self.cond:
+        while not heap:
+          self.cond.wait()
+        deadline, _, fn = heap[0]
+        remain = deadline - time.time()
+        if remain > 0:
+          self.cond.wait(remain)
+          continue
+        heapq.heappop(heap)
+      if fn is not None:
+        try:
+          fn()
+        except Exception:
+          traceback.print_exc()
+
+
+_deadline_timer = None
+_singleton_lock = threading.Lock()
+
+
+def get_deadline_timer() -> DeadlineTimer:
+  global _deadline_timer
+  if _deadline_timer is None:
+    with _singleton_lock:
+      if _deadline_timer is None:
+        _deadline_timer = DeadlineTimer('albatross-deadline')
+  return _deadline_timer
@@ -0,0 +1,111 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import threading
+import traceback
+from dataclasses import dataclass
+
+# filters in the order they are indexed, the most selective one present is the index key
+FILTER_FIELDS = ('pid', 'uid', 'package')
+
+
+@dataclass
+class BroadcastListener:
+  id: int
+  broadcast_name: str
+  callback: object
+  filters: dict
+
+  def matches(self, attrs: dict):
+    for field, value in self.filters.items():
+      if attrs.get(field) != value:
+        return False
+    return True
+
+
+class ListenerRegistry(object):
+  """
+  Listeners of the broadcasts of one client. A listener may filter on pid, uid and
+  package and is kept in a hash map under the most selective of them, so a broadcast
+  only looks at the listeners registered for its own pid, uid or package plus the
+  unfiltered ones.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.counter = itertools.count(1)
+    # broadcast_name -> {field or None: {value: {id: listener}}}
+    self.indexes = {}
+    self.listeners = {}
+
+  def __len__(self):
+    return len(self.listeners)
+
+  def add(self, broadcast_name, callback, **filters) -> BroadcastListener:
+    filters = {field: value for field, value in filters.items() if value is not None}
+    for field in filters:
+      if field not in FILTER_FIELDS:
+        raise ValueError('unknown broadcast filter ' + field)
+    field = next((field for field in FILTER_FIELDS if field in filters), None)
+    with self.lock:
+      listener = BroadcastListener(next(self.counter), broadcast_name, callback, filters)
+      index = self.indexes.setdefault(broadcast_name, {}).setdefault(field, {})
+      index.setdefault(filters.get(field), {})[listener.id] = listener
+      self.listeners[listener.id] = listener
+    return listener
+
+  def remove(self, listener: BroadcastListener):
+    filters = listener.filters
+    field = next((field for field in FILTER_FIELDS if field in filters), None)
+    with self.lock:
+      if self.listeners.pop(listener.id, None) is None:
+        return False
+      index = self.indexes[listener.broadcast_name][field]
+      key = filters.get(field)
+      bucket = index[key]
+      del bucket[listener.id]
+      if not bucket:
+        del index[key]
+      return True
+
+  def match(self, broadcast_name, attrs: dict) -> list:
+    indexes = self.indexes.get(broadcast_name)
+    if not indexes:
+      return []
+    candidates = []
+    with self.lock:
+      unfiltered = indexes.get(None)
+      if unfiltered:
+        candidates.extend(unfiltered[None].values())
+      for field in FILTER_FIELDS:
+        value = attrs.get(field)
+        if value is None:
+          continue
+        index = indexes.get(field)
+        if index:
+          bucket = index.get(value)
+          if bucket:
+            candidates.extend(bucket.values())
+    matched = [listener for listener in candidates if listener.matches(attrs)]
+    # registration order, whatever index the listener sits in
+    matched.sort(key=lambda listener: listener.id)
+    return matched
+
+  def notify(self, broadcast_name, attrs: dict, args):
+    for listener in self.match(broadcast_name, attrs):
+      try:
+        listener.callback(*args)
+      except Exception:
+        traceback.print_exc()
@@ -0,0 +1,181 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+from .metrics import ClientMetrics
+from .rpc_client import RpcClient, RpcCloseException
+from .wrapper import cached_property
+
+
+class PoolExhausted(RpcCloseException):
+  pass
+
+
+class RpcClientPool(object):
+  """
+  Keeps up to size connections of client_class to one forwarded port and lends
+  them to worker threads, so parallel calls scale with the connections instead of
+  queuing on one request_lock. Only the first connection fetches the api tables,
+  the others check them against the cached digest in their handshake. A
+  connection which was idle longer than health_check_interval is pinged before
+  it is handed out.
+  """
+  health_check_interval = 30
+
+  def __init__(self, client_class, host, port, size=4, name=None, timeout=None, template: RpcClient = None,
+      quiet=True, server_key=None):
+    self.client_class = client_class
+    self.host = host
+    self.port = port
+    self.size = size
+    if name is None:
+      name = client_class.__name__.lower() + '-pool-{}'.format(port)
+    self.name = name
+    self.timeout = timeout
+    self.template = template
+    if server_key is None and template is not None:
+      server_key = template.server_key
+    self.server_key = server_key
+    self.quiet = quiet
+    self.idle = []
+    self.created = 0
+    self.closed = False
+    self.condition = threading.Condition()
+    # the connections come and go, their calls are counted together
+    self.metrics = ClientMetrics(name)
+
+  def __repr__(self):
+    return self.name
+
+  def create_client(self):
+    client = self.client_class(self.host, self.port, '{}:{}'.format(self.name, self.created), self.timeout,
+      server_key=self.server_key)
+    client.quiet = self.quiet
+    cached_property.reset(client, 'metrics', self.metrics)
+    if self.template is None:
+      self.template = client
+    return client
+
+  def prefill(self):
+    clients = []
+    try:
+      while True:
+        with self.condition:
+          if self.created >= self.size:
+            break
+        clients.append(self.acquire())
+    finally:
+      for client in clients:
+        self.release(client)
+    return self
+
+  def check_health(self, client):
+    if not client.sock:
+      return False
+    if time.time() - client.last_request_time < self.health_check_interval:
+      return True
+    try:
+      client.ping(timeout=5)
+      return True
+    except Exception:
+      return False
+
+  def discard(self, client):
+    try:
+      client.close()
+    except Exception:
+      traceback.print_exc()
+    with self.condition:
+      self.created -= 1
+      self.condition.notify()
+
+  def acquire(self, timeout=None) -> RpcClient:
+    deadline = time.time() + timeout if timeout else None
+    while True:
+      with self.condition:
+        while True:
+          if self.closed:
+            raise RpcCloseException('pool {} is closed'.format(self.name))
+          if self.idle:
+            client = self.idle.pop()
+            create = False
+            break
+          if self.created < self.size:
+            self.created += 1
+            client = None
+            create = True
+            break
+          remain = deadline - time.time() if deadline else None
+          if remain is not None and remain <= 0:
+            raise PoolExhausted('no free connection in pool {}'.format(self.name))
+          self.condition.wait(remain)
+      if create:
+        try:
+          return self.create_client()
+        except BaseException:
+          with self.condition:
+            self.created -= 1
+            self.condition.notify()
+          raise
+      if self.check_health(client):
+        return client
+      self.discard(client)
+
+  def release(self, client: RpcClient):
+    if not client.sock or self.closed:
+      self.discard(client)
+      return
+    with self.condition:
+      self.idle.append(client)
+      self.condition.notify()
+
+  @contextmanager
+  def connection(self, timeout=None):
+    client = self.acquire(timeout)
+    try:
+      yield client
+    finally:
+      self.release(client)
+
+  def __getattr__(self, method):
+    # proxy rpc methods, each call borrows a connection for its duration
+    if method.startswith('_') or 'template' not in self.__dict__ or not self.has_api(method):
+      raise AttributeError(method)
+
+    def call(*args, **kwargs):
+      with self.connection() as client:
+        return getattr(client, method)(*args, **kwargs)
+
+    call.__name__ = method
+    return call
+
+  def has_api(self, method):
+    template = self.template
+    if template is None or not template.sock:
+      # a closed client forgot its api table, fall back to the declared methods
+      return hasattr(self.client_class, 'call_' + method)
+    return method in template.allow_apis
+
+  def close(self):
+    with self.condition:
+      self.closed = True
+      idle = self.idle
+      self.idle = []
+      self.condition.notify_all()
+    for client in idle:
+      self.discard(client)
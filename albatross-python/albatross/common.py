@@ -20,6 +20,7 @@ from .wrapper import cached_class_property
 
 import re
 import subprocess
+import time
 
 OUT_TIME_CODE = 996
 FAULT_CODE = 997
@@ -46,6 +47,23 @@ def run_shell(cmd, timeout=20, split=False):
     return FAULT_CODE, str(e).encode()
 
 
+def wait_until(predicate, timeout, interval=0.05, max_interval=1.0):
+  """
+  Call predicate until it returns a true value and return that value, the pause
+  between calls doubles up to max_interval. Return None once timeout seconds passed.
+  """
+  deadline = time.time() + timeout
+  while True:
+    result = predicate()
+    if result:
+      return result
+    remain = deadline - time.time()
+    if remain <= 0:
+      return None
+    time.sleep(min(interval, remain))
+    interval = min(interval * 2, max_interval)
+
+
 class Configuration(object):
 
   @cached_class_property
@@ -174,6 +192,52 @@ class Configuration(object):
 
   server_port = __make_get('server_port', 19088)
 
+  client_pool_size = __make_get('client_pool_size', 4)
+
+  # run shell commands through one long lived adb shell per device instead of an adb process each
+  shell_session = __make_get('shell_session', True)
+
+  # 'auto' talks to the adb server socket when it answers, 'socket' always, 'binary' spawns adb for everything
+  adb_backend = __make_get('adb_backend', 'auto')
+
+  # keep the device list up to date from adb host:track-devices, needs the socket adb backend
+  track_devices = __make_get('track_devices', True)
+
+  # push server, libs and the app agent dex as one tar instead of file by file
+  bundle_deploy = __make_get('bundle_deploy', True)
+
+  # seconds to wait for the albatross server to accept connections after it was started
+  server_start_timeout = __make_get('server_start_timeout', 10)
+
+  # seconds to wait for system_server to be up again after a restart
+  system_server_start_timeout = __make_get('system_server_start_timeout', 60)
+
+  # seconds after which a lookup reloads the process table of a device from system_server in the background
+  process_table_max_age = __make_get('process_table_max_age', 30)
+
+  # reuse the probed device facts across runs while the build fingerprint matches
+  device_facts_cache = __make_get('device_facts_cache', True)
+
+  # serve /metrics and /health of all devices on this port, 0 leaves the endpoint off
+  metrics_port = __make_get('metrics_port', 0)
+
+  metrics_host = __make_get('metrics_host', '127.0.0.1')
+
+  @cached_class_property
+  def cache_dir(self):
+    cache_dir = self.config.get('cache_dir')
+    if cache_dir is not None:
+      return cache_dir
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'albatross')
+
+  @cached_class_property
+  def adb_server_port(self):
+    port = self.config.get('adb_server_port')
+    if port:
+      return port
+    return int(os.environ.get('ANDROID_ADB_SERVER_PORT', 5037))
+
   system_server_address = __make_get('system_server_address', 'localabstract:albatross_system_server')
 
   system_server_init_class = __make_get('system_server_init_class',
@@ -12,19 +12,36 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import logging
 import os
+import posixpath
 import re
 import socket
 import subprocess
+import tarfile
+import tempfile
+import threading
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
+from .adb_client import AdbError, AdbShellSession, close_socket, get_adb_client
 from .albatross_client import AlbatrossClient, DexLoadResult, InjectFlag, LoadDexFlag, RunTimeISA
-from .common import Configuration, run_shell
+from .client_pool import RpcClientPool
+from .common import Configuration, run_shell, wait_until
+from .device_registry import get_device_registry, STATE_DEVICE, STATE_OFFLINE
+from .local_cache import load_json, save_json
+from .process_table import ProcessTable
 from .exceptions import DeviceOffline, NoDeviceFound, DeviceNoFindErr, DeviceNotRoot, PackageNotInstalled
-from .rpc_client import byte
+from .rpc_client import RpcException, byte
+from .shell_session import ShellSession, ShellSessionClosed
 from .system_server_client import SystemServerClient
+from .task_graph import TaskGraph
 from .wrapper import cached_property
 
+logger = logging.getLogger('albatross.device')
+
 
 def check_socket_port(ip, port):
   try:
@@ -48,9 +65,47 @@ def get_valid_port():
 
 
 adb_path = Configuration.adb
+if adb_path is cached_property.nil_value:
+  # no adb binary, only the adb server socket can be used
+  adb_path = 'adb'
+
+
+def adb_connect(address, timeout=3):
+  adb = get_adb_client()
+  if adb:
+    try:
+      return adb.connect(address)
+    except (OSError, AdbError) as e:
+      return str(e)
+  return run_shell(adb_path + ' connect ' + address, timeout=timeout)[1].decode()
+
+
+def adb_disconnect(address, timeout=4):
+  adb = get_adb_client()
+  if adb:
+    try:
+      return adb.disconnect(address)
+    except (OSError, AdbError) as e:
+      return str(e)
+  return run_shell(adb_path + ' disconnect ' + address, timeout=timeout)[1].decode()
 
 
 def get_devices():
+  registry = get_device_registry()
+  if registry and registry.ready.is_set():
+    return registry.devices()
+  adb = get_adb_client()
+  if adb:
+    try:
+      devices = []
+      for serial, state in adb.devices():
+        if state != "offline":
+          devices.append(serial)
+        else:
+          adb_disconnect(serial)
+      return devices
+    except (OSError, AdbError):
+      return []
   try:
     _, lines = run_shell(adb_path + " devices", split=True)
     if "Error" in lines:
@@ -64,7 +119,7 @@ def get_devices():
           if device[1] != "offline":
             devices.append(device[0])
           else:
-            run_shell(adb_path + ' disconnect ' + device[0], timeout=4)
+            adb_disconnect(device[0])
       return devices
     return []
   except:
@@ -72,8 +127,15 @@ def get_devices():
 
 
 def check_device_alive(device_name, try_time=3):
+  registry = get_device_registry()
+  if registry and registry.ready.is_set():
+    return registry.is_online(device_name)
   for i in range(try_time):
-    ret_code, bs = run_shell(f"{adb_path} -s {device_name} shell echo ping", timeout=2)
+    adb = get_adb_client()
+    if adb:
+      ret_code, bs = adb.shell(device_name, 'echo ping', timeout=2)
+    else:
+      ret_code, bs = run_shell(f"{adb_path} -s {device_name} shell echo ping", timeout=2)
     if b'ping\n' == bs:
       return True
     if i < try_time - 1:
@@ -81,18 +143,59 @@ def check_device_alive(device_name, try_time=3):
   return False
 
 
+# path -> (size, mtime_ns, inode, md5), a file is only hashed again after it changed
+_md5_memo = {}
+md5_line_pattern = re.compile(r"^([0-9a-f]{32})\s+(.+)$", re.M)
+
+
 def file_md5(file_path):
-  ret, ret_bs = run_shell('md5sum ' + file_path)
-  if ret == 0:
-    return ret_bs.decode().split()[0]
-  return None
+  try:
+    st = os.stat(file_path)
+  except OSError:
+    return None
+  path = os.path.abspath(file_path)
+  memo = _md5_memo.get(path)
+  if memo and memo[:3] == (st.st_size, st.st_mtime_ns, st.st_ino):
+    return memo[3]
+  md5 = hashlib.md5()
+  with open(path, 'rb') as fp:
+    while True:
+      chunk = fp.read(1 << 20)
+      if not chunk:
+        break
+      md5.update(chunk)
+  digest = md5.hexdigest()
+  _md5_memo[path] = (st.st_size, st.st_mtime_ns, st.st_ino, digest)
+  return digest
 
 
 pkg_pattern = re.compile(r"package:([\w.]+)(?:\s+|$)")
 
+# prints key=value lines, enough to identify the build and boot of a device
+identity_probe = '''echo "fingerprint=$(getprop ro.build.fingerprint)"
+echo "boot_id=$(cat /proc/sys/kernel/random/boot_id)"
+echo "uid=$(id -u)"'''
+
+# everything the device setup asks for, in one shell command
+facts_probe = identity_probe + '''
+echo "abi=$(getprop ro.product.cpu.abi)"
+echo "sh_file=$(file /system/bin/sh 2>/dev/null)"
+su=$(which su 2>/dev/null)
+if [ -z "$su" ] && ls /sbin/su >/dev/null 2>&1; then su=/sbin/su; fi
+echo "su=$su"
+echo "zygote=$(pidof zygote)"'''
+
+
+def parse_probe(output: str) -> dict:
+  facts = {}
+  for line in output.splitlines():
+    key, sep, value = line.partition('=')
+    if sep:
+      facts[key] = value.strip()
+  return facts
+
 
 class AlbatrossDevice(object):
-  ret_code: int
   shell_user = 'shell'
   lib_dst: str
   lib_dir: str
@@ -100,6 +203,10 @@ class AlbatrossDevice(object):
   update_kill = True
   lib32_dst: str
   max_launch_count = 20
+  # a client closed again within reconnect_stable_time after a reconnect waits twice as
+  # long before the next one, past reconnect_max_delay it is dropped instead
+  reconnect_stable_time = 10
+  reconnect_max_delay = 5
 
   def __init__(self, device_id):
     self.device_id = device_id
@@ -107,13 +214,106 @@ class AlbatrossDevice(object):
     self.shellcmd = self.cmd + "shell "
     self.process_launch_callback = {}
     self.app_launch_count = {}
+    self.push_lock = threading.Lock()
+    # provisioning steps run in parallel, each thread sees the return code of its own shell call
+    self.thread_state = threading.local()
+    self.provision_timings = {}
+    self.shell_sessions = {}
+    self.shell_session_lock = threading.Lock()
+    self.adb = get_adb_client()
+    # filled once system_server_client is up, pid lookups use the shell before that
+    self.process_table: ProcessTable | None = None
+    self.process_table_listeners = []
+    # what went wrong so far, exported by metrics_server
+    self.stats_lock = threading.Lock()
+    self.connection_closes = Counter()
+    self.dex_load_results = Counter()
+    self.inject_failures = 0
+    # client kind -> (delay before its next reconnect, time of its last reconnect)
+    self.reconnect_backoff = {}
+
+  def count_connection_close(self, kind):
+    with self.stats_lock:
+      self.connection_closes[kind] += 1
+
+  def count_inject(self, res, dex_res=None):
+    """res of inject_albatross, dex_res of the load_dex or load_injector call which followed"""
+    with self.stats_lock:
+      if res < 0:
+        self.inject_failures += 1
+      else:
+        self.dex_load_results[getattr(dex_res, 'name', str(dex_res))] += 1
+
+  @property
+  def ret_code(self) -> int:
+    return getattr(self.thread_state, 'ret_code', 0)
+
+  @ret_code.setter
+  def ret_code(self, ret_code):
+    self.thread_state.ret_code = ret_code
+
+  def run_steps(self, graph: TaskGraph):
+    try:
+      return graph.run()
+    finally:
+      self.provision_timings[graph.name] = dict(graph.timings)
+      logger.debug('%s', graph.report())
+
+  def get_shell_session(self, user) -> ShellSession | None:
+    session = self.shell_sessions.get(user)
+    if session is None and user not in self.shell_sessions:
+      # su_file may run a shell command itself, look it up before taking the lock
+      shell_cmd = 'sh' if user == 'shell' else self.su_file
+      with self.shell_session_lock:
+        # provisioning steps ask from several threads, only one of them opens the session
+        sessions = self.shell_sessions
+        if user in sessions:
+          return sessions[user]
+        name = '{}-{}'.format(user, self.device_id)
+        if self.adb:
+          session = AdbShellSession(self.adb, self.device_id, shell_cmd, name)
+        else:
+          session = ShellSession([adb_path, '-s', self.device_id, 'shell', shell_cmd], name)
+        sessions[user] = session
+    return session
+
+  def session_shell(self, user, cmd, timeout):
+    """
+    Run cmd in the persistent shell of user, 'shell' or 'su'. Return None when there
+    is no usable session, the caller then spawns adb for this command.
+    """
+    if not Configuration.shell_session:
+      return None
+    session = self.get_shell_session(user)
+    if session is None:
+      return None
+    try:
+      return session.run(cmd, timeout)
+    except ShellSessionClosed as e:
+      if not session.command_count:
+        # e.g. a su which does not read commands from stdin
+        print('disable shell session:', e)
+        self.shell_sessions[user] = None
+      return None
+
+  def close_shell_sessions(self):
+    with self.shell_session_lock:
+      sessions = self.shell_sessions
+      self.shell_sessions = {}
+    for session in sessions.values():
+      if session:
+        session.close()
 
   def shell(self, cmd, timeout=None) -> list | str:
-    cmd = self.shellcmd + "'" + cmd + "'"
-    if timeout:
-      ret = run_shell(cmd, timeout=timeout)
-    else:
-      ret = run_shell(cmd)
+    ret = self.session_shell('shell', cmd, timeout or 20)
+    if ret is None and self.adb:
+      ret = self.adb.shell(self.device_id, cmd, timeout or 20)
+    if ret is None:
+      cmd = self.shellcmd + "'" + cmd + "'"
+      if timeout:
+        ret = run_shell(cmd, timeout=timeout)
+      else:
+        ret = run_shell(cmd)
     self.ret_code = ret[0]
     result = ret[1].decode().strip()
     return result
@@ -131,14 +331,31 @@ class AlbatrossDevice(object):
         pass
       device_id = self.device_id
       if '.' in device_id:
-        run_shell(adb_path + ' connect ' + device_id, timeout=2)
+        adb_connect(device_id, timeout=2)
         time.sleep(1)
     return 'ping' == self.shell('echo "ping"', timeout=2)
 
+  def system_server_call(self, method, *args):
+    """
+    Call method of the system_server agent if it is already loaded and knows the
+    method, which saves starting an am/pm/dumpsys process on the device. Return None
+    when the caller has to use the shell instead.
+    """
+    client = self.__dict__.get('system_server_client')
+    if client is None or method not in client.allow_apis:
+      return None
+    try:
+      return getattr(client, method)(*args)
+    except (RpcException, OSError, TimeoutError) as e:
+      logger.debug('system_server %s fail, use shell: %s', method, e)
+      return None
+
   @property
   def is_screen_on(self):
-    cmd = self.shellcmd + "dumpsys power"
-    ret_str = run_shell(cmd)[1].decode("utf-8")
+    screen_on = self.system_server_call('is_screen_on')
+    if screen_on is not None:
+      return screen_on
+    ret_str = self.shell("dumpsys power")
     if 'mWakefulness=' in ret_str:
       return 'mWakefulness=Awake' in ret_str
     match = re.search(r"Display Power: state=(\w+)", ret_str)
@@ -146,7 +363,7 @@ class AlbatrossDevice(object):
 
   def wake_up(self):
     if not self.is_screen_on:
-      run_shell(self.shellcmd + "input keyevent 26")
+      self.shell("input keyevent 26")
 
   def check_alive(self):
     if not self.device_alive(1):
@@ -159,6 +376,11 @@ class AlbatrossDevice(object):
     return run_shell(cmd_line, **kwargs)
 
   def forward_list(self):
+    if self.adb:
+      try:
+        return self.adb.list_forward(self.device_id)
+      except (OSError, AdbError):
+        return []
     lines = (self.adb_cmd("forward", "--list")[1].decode("utf-8").strip().splitlines())
     return [line.strip().split() for line in lines]
 
@@ -167,11 +389,34 @@ class AlbatrossDevice(object):
       local = "tcp:%d" % local
     else:
       local = "udp:%d" % local
+    if self.adb:
+      try:
+        self.adb.forward(self.device_id, local, remote)
+        return 0
+      except (OSError, AdbError) as e:
+        print(e)
+        return 1
     ret_code, _ = self.adb_cmd("forward", local, remote)
     return ret_code
 
   def connect(self):
-    run_shell(adb_path + ' connect ' + self.device_id, timeout=3)
+    adb_connect(self.device_id, timeout=3)
+
+  def adb_root(self) -> bytes:
+    if self.adb:
+      try:
+        return self.adb.root(self.device_id)
+      except (OSError, AdbError) as e:
+        return str(e).encode()
+    return self.adb_cmd("root")[1]
+
+  def adb_push(self, file, dst):
+    if self.adb:
+      try:
+        return 0, self.adb.push(self.device_id, file, dst).encode()
+      except (OSError, AdbError) as e:
+        return 1, str(e).encode()
+    return run_shell(self.cmd + ' push "{}" "{}"'.format(file, dst))
 
   def is_online(self):
     devices = get_devices()
@@ -180,7 +425,9 @@ class AlbatrossDevice(object):
   def is_adb_root(self):
     un_root = "Permission" in self.shell("rm /data/local/file_test")
     if un_root or "Permission" in self.shell("touch /data/local/file_test"):
-      ret, rstr = self.adb_cmd("root")
+      rstr = self.adb_root()
+      # adbd restarts, the running shells die with it
+      self.close_shell_sessions()
       if b'cannot run as root in production builds' in rstr:
         return False
       i = 2
@@ -198,8 +445,12 @@ class AlbatrossDevice(object):
       return "Permission" not in self.shell("rm /data/local/file_test")
 
   def su_shell(self, cmd, timeout=10):
-    cmd = self.shellcmd + "' {} -c ".format(self.su_file) + cmd + "'"
-    ret = run_shell(cmd, timeout=timeout)
+    ret = self.session_shell('su', cmd, timeout)
+    if ret is None and self.adb:
+      ret = self.adb.shell(self.device_id, ' {} -c '.format(self.su_file) + cmd, timeout)
+    if ret is None:
+      cmd = self.shellcmd + "' {} -c ".format(self.su_file) + cmd + "'"
+      ret = run_shell(cmd, timeout=timeout)
     self.ret_code = ret[0]
     result = ret[1].decode().strip()
     return result
@@ -209,32 +460,68 @@ class AlbatrossDevice(object):
     ret = "Permission" not in self.su_shell("rm /data/local/file_test")
     return ret
 
+  @cached_property
+  def facts(self) -> dict:
+    """
+    Device facts collected by one probe and kept in the local cache per serial. While
+    the build fingerprint matches only the identity is asked, root_mode is only
+    reused within the same boot.
+
+    A cache hit still costs the identity probe, one short shell in place of the full
+    probe and the root checks. adb only knows the serial, which stays the same across
+    a reflash, a reboot or an adb root, so the fingerprint, boot_id and uid the cache
+    is checked against have to come from the device itself.
+    """
+    if Configuration.device_facts_cache:
+      cached = load_json('devices', self.device_id)
+      if cached and cached.get('fingerprint'):
+        identity = parse_probe(self.shell(identity_probe))
+        if identity.get('fingerprint') == cached['fingerprint']:
+          facts = dict(cached)
+          root_mode = facts.get('root_mode')
+          if identity.get('boot_id') != facts.get('boot_id') or (root_mode == 'adb' and identity.get('uid') != '0'):
+            facts.pop('root_mode', None)
+          facts.update(identity)
+          return facts
+    facts = parse_probe(self.shell(facts_probe))
+    if facts.get('fingerprint'):
+      self.save_facts(facts)
+    return facts
+
+  def save_facts(self, facts=None):
+    if Configuration.device_facts_cache:
+      save_json('devices', self.device_id, facts or self.facts)
+
   @cached_property
   def su_file(self):
-    su_file = self.shell('which su')
-    if su_file:
-      return su_file
-    for i in ['/sbin/su']:
-      ret = self.shell('ls ' + i)
-      if self.ret_code == 0:
-        return i
-    return 'su'
+    return self.facts.get('su') or 'su'
 
   @cached_property
   def is_root(self):
-    adb_root = self.is_adb_root()
-    if adb_root:
+    facts = self.facts
+    root_mode = facts.get('root_mode')
+    if not root_mode:
+      if facts.get('uid') == '0' or self.is_adb_root():
+        root_mode = 'adb'
+      elif self.is_shell_root():
+        root_mode = 'su'
+      if root_mode:
+        facts['root_mode'] = root_mode
+        self.save_facts()
+    if root_mode == 'adb':
       self.shell_user = 'root'
       self.root_shell = self.shell
       return True
-    shell_root = self.is_shell_root()
-    if shell_root:
+    if root_mode == 'su':
       self.root_shell = self.su_shell
-    return shell_root
+      return True
+    return False
+
+  agent_dex_name = "app_agent.dex"
 
   @cached_property
   def agent_dex(self):
-    dst = Configuration.app_injector_dir + "app_agent.dex"
+    dst = Configuration.app_injector_dir + self.agent_dex_name
     self.push_file(Configuration.app_agent_file, dst, mode='444')
     return dst
 
@@ -244,8 +531,38 @@ class AlbatrossDevice(object):
       return None
     return ret.split()[0].strip()
 
+  def get_files_md5(self, file_paths) -> dict:
+    """md5 of many remote files with one md5sum, missing files are left out"""
+    if not file_paths:
+      return {}
+    ret: str = self.shell('md5sum ' + ' '.join(file_paths))
+    return {path: md5 for md5, path in md5_line_pattern.findall(ret)}
+
+  @cached_property
+  def manifest(self) -> dict:
+    """
+    Remote path -> md5 of the files pushed to this device. The manifest saved by a
+    previous run is verified with one md5sum when it is loaded, after that files
+    whose local md5 matches the manifest are not checked on the device again.
+    """
+    manifest = load_json('manifests', self.device_id)
+    if not manifest:
+      return {}
+    remote_md5 = self.get_files_md5(list(manifest))
+    return {path: md5 for path, md5 in manifest.items() if remote_md5.get(path) == md5}
+
+  def update_manifest(self, dst, md5):
+    manifest = self.manifest
+    if md5:
+      manifest[dst] = md5
+    else:
+      manifest.pop(dst, None)
+    save_json('manifests', self.device_id, dict(manifest))
+
   def delete_file(self, file_path):
     self.root_shell('rm -rf {}'.format(file_path))
+    if file_path in self.manifest:
+      self.update_manifest(file_path, None)
     return self.ret_code == 0
 
   def push_file(self, file, dst, check=False, mode=None):
@@ -254,26 +571,28 @@ class AlbatrossDevice(object):
     md5_dst = file_md5(file)
     if not md5_dst:
       return False
+    if dst[-1] == "/":
+      dst += os.path.basename(file)
+    if self.manifest.get(dst) == md5_dst:
+      return False
     if check or os.stat(file).st_size > 8192:
-      if dst[-1] == "/":
-        dst += os.path.basename(file)
       md5_src = self.get_file_md5(dst)
       if md5_dst == md5_src:
+        self.update_manifest(dst, md5_dst)
         return False
     if self.shell_user == 'shell':
       self.delete_file(dst)
-    command = self.cmd + ' push "{}" "{}"'.format(file, dst)
-    ret_code, s = run_shell(command)
+    ret_code, s = self.adb_push(file, dst)
     res = ret_code == 0
     if res:
       if mode:
         self.shell('chmod {} {}'.format(mode, dst))
       print(s)
+      self.update_manifest(dst, md5_dst)
       return res
     if self.is_root and self.shell_user == 'shell':
       tmp_path = '/data/local/tmp/' + md5_dst
-      command = self.cmd + ' push "{}" "{}"'.format(file, tmp_path)
-      ret_code, s = run_shell(command)
+      ret_code, s = self.adb_push(file, tmp_path)
       res = ret_code == 0
       if res:
         command = self.root_shell('mv {} {}'.format(tmp_path, dst))
@@ -281,9 +600,81 @@ class AlbatrossDevice(object):
           print(s)
           if mode:
             self.root_shell('chmod {} {}'.format(mode, dst))
+          self.update_manifest(dst, md5_dst)
           return True
     return False
 
+  def deploy_files(self, files) -> set:
+    """
+    Bring (local, remote, mode) files up to date and return the remote paths which
+    changed. Files the manifest or one bulk md5sum shows as current are skipped, the
+    rest are packed into one tar named by its content hash, pushed once and
+    extracted by a single root shell command. Falls back to push_file per file when
+    that does not work, e.g. without a tar on the device.
+    """
+    wanted = {}
+    for local, remote, mode in files:
+      md5 = file_md5(local)
+      if not md5:
+        continue
+      if remote[-1] == "/":
+        remote += os.path.basename(local)
+      wanted[remote] = (local, md5, mode)
+    manifest = self.manifest
+    stale = [remote for remote, (_, md5, _) in wanted.items() if manifest.get(remote) != md5]
+    if not stale:
+      return set()
+    remote_md5 = self.get_files_md5(stale)
+    changed = []
+    for remote in stale:
+      md5 = wanted[remote][1]
+      if remote_md5.get(remote) == md5:
+        self.update_manifest(remote, md5)
+      else:
+        changed.append(remote)
+    if not changed:
+      return set()
+    if len(changed) == 1 or not self.push_bundle([(remote,) + wanted[remote] for remote in changed]):
+      changed = [remote for remote in changed if self.push_file(wanted[remote][0], remote, mode=wanted[remote][2])]
+    return set(changed)
+
+  def push_bundle(self, files):
+    """push [(remote, local, md5, mode)] as one tar and extract it on the device"""
+    bundle_md5 = hashlib.md5()
+    for remote, local, md5, mode in files:
+      bundle_md5.update('{} {} {}\n'.format(remote, md5, mode).encode())
+    bundle_name = 'albatross-{}.tar'.format(bundle_md5.hexdigest())
+    bundle = os.path.join(tempfile.gettempdir(), bundle_name)
+    try:
+      with tarfile.open(bundle, 'w') as tar:
+        for remote, local, md5, mode in files:
+          info = tar.gettarinfo(local, remote.lstrip('/'))
+          if mode:
+            info.mode = int(mode, 8)
+          info.uid = info.gid = 0
+          info.uname = info.gname = ''
+          with open(local, 'rb') as fp:
+            tar.addfile(info, fp)
+      remote_bundle = '/data/local/tmp/' + bundle_name
+      ret_code, s = self.adb_push(bundle, remote_bundle)
+    finally:
+      if os.path.exists(bundle):
+        os.remove(bundle)
+    if ret_code != 0:
+      print('push bundle fail:', s)
+      return False
+    dirs = ' '.join(sorted({posixpath.dirname(remote) for remote, _, _, _ in files}))
+    # tar keeps the modes of the entries, no chmod per file
+    self.root_shell('mkdir -p {} && tar -xf {} -C /; ret=$?; rm -f {}; [ $ret = 0 ]'.format(
+      dirs, remote_bundle, remote_bundle), 60)
+    if self.ret_code != 0:
+      print('extract bundle fail, push files one by one')
+      return False
+    print('deploy bundle', bundle_name, ' '.join(remote for remote, _, _, _ in files))
+    for remote, _, md5, _ in files:
+      self.update_manifest(remote, md5)
+    return True
+
   def pidofs(self, cmd_line):
     pids = []
     grep_cmd = f'grep "{cmd_line}"'
@@ -299,7 +690,15 @@ class AlbatrossDevice(object):
         pids.append(line.split(maxsplit=2)[1])
     return pids
 
-  def pidof(self, process_name):
+  def pidof(self, process_name, use_table=True):
+    table = self.process_table
+    if use_table and table is not None:
+      # the broadcasts keep the table current, a pid which is gone anyway is removed by
+      # the call that fails on it. Only app processes are in the table, a miss may be a
+      # native process and is asked from the device
+      pids = table.pids_of_name(process_name)
+      if pids:
+        return [str(pid) for pid in pids]
     s = self.shell('pidof ' + process_name)
     return s.split()
 
@@ -313,11 +712,21 @@ class AlbatrossDevice(object):
   def kill_pid(self, pid, sig=9):
     if pid:
       self.root_shell("kill -{} {}".format(sig, pid))
+      table = self.process_table
+      if table is not None and sig == 9:
+        table.remove(int(pid))
 
   def __on_close(self, client):
     cached_property.delete(self, 'client')
+    self.close_pool('albatross_pool')
+    self.count_connection_close('albatross')
     print('albatross server disconnected')
 
+  def close_pool(self, name):
+    pool = self.__dict__.pop(name, None)
+    if pool:
+      pool.close()
+
   def setenforce(self, on=False):
     if on:
       self.root_shell("setenforce 1")
@@ -326,36 +735,55 @@ class AlbatrossDevice(object):
 
   @cached_property
   def support_32(self):
-    return not not self.pidof('zygote')
+    return not not self.facts.get('zygote')
 
   def get_client(self) -> AlbatrossClient:
     if not self.is_root:
       raise DeviceNotRoot(self)
-    self.setenforce(False)
     server_dst_path = Configuration.server_dst_path
     server_dst_path = '/data/local/tmp/' + server_dst_path
     server_port = Configuration.server_port
-    local_port = self.get_forward_port(server_port)
     device_abi = self.cpu_api
     server_file, abi_lib, abi_lib32 = Configuration.get_server_path(device_abi)
     assert os.path.exists(server_file)
-    update = self.push_file(server_file, server_dst_path)
     lib_dst = Configuration.lib_path + Configuration.abi_lib_names[device_abi] + '/'
-    update += self.push_file(abi_lib, lib_dst)
     self.lib_dir = lib_dst
     self.lib_dst = lib_dst + Configuration.lib_name
     lib_dst_32 = None
+    lib_src_32 = None
     if abi_lib32 and self.support_32:
       lib_src_32, abi32_name = abi_lib32
       self.lib32_dir = Configuration.lib_path + abi32_name + "/"
       lib_dst_32 = self.lib32_dir + Configuration.lib_name
-      self.push_file(lib_src_32, lib_dst_32)
       self.lib32_dst = lib_dst_32
+    # independent steps run in parallel, the server is started once all are done
+    graph = TaskGraph('get_client-' + self.device_id)
+    graph.add('setenforce', lambda: self.setenforce(False))
+    graph.add('forward', lambda: self.get_forward_port(server_port))
+    graph.add('server_key', lambda: file_md5(server_file))
+    if Configuration.bundle_deploy:
+      files = [(server_file, server_dst_path, None), (abi_lib, lib_dst, None)]
+      if lib_dst_32:
+        files.append((lib_src_32, lib_dst_32, None))
+      files.append((Configuration.app_agent_file, Configuration.app_injector_dir + self.agent_dex_name, '444'))
+      graph.add('deploy', lambda: self.deploy_files(files))
+      results = self.run_steps(graph)
+      updated = results['deploy']
+      update = server_dst_path in updated or self.lib_dst in updated
+    else:
+      graph.add('push_server', lambda: self.push_file(server_file, server_dst_path))
+      graph.add('push_lib', lambda: self.push_file(abi_lib, lib_dst))
+      if lib_dst_32:
+        graph.add('push_lib32', lambda: self.push_file(lib_src_32, lib_dst_32))
+      results = self.run_steps(graph)
+      update = results['push_server'] or results['push_lib']
+    local_port = results['forward']
+    server_key = results['server_key']
     if update and self.update_kill:
       self.kill_process(os.path.basename(server_dst_path))
     else:
       try:
-        client = AlbatrossClient('127.0.0.1', local_port, 'albatross-' + self.device_id, 500)
+        client = self.connect_client(local_port, server_key)
         if lib_dst_32:
           client.set_2nd_arch_lib(lib_dst_32)
         return client
@@ -365,74 +793,205 @@ class AlbatrossDevice(object):
       cmd_prefix = "nohup su -c "
     else:
       cmd_prefix = "nohup "
-    cmd = f'{self.shellcmd} "LD_LIBRARY_PATH={lib_dst} {cmd_prefix} {server_dst_path} {server_port} >/data/local/tmp/albatross.log 2>&1 &"'
-    process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    time.sleep(2)
-    process.terminate()
-    client = AlbatrossClient('127.0.0.1', local_port, 'albatross-' + self.device_id, 500)
+    server_cmd = f'LD_LIBRARY_PATH={lib_dst} {cmd_prefix} {server_dst_path} {server_port} >/data/local/tmp/albatross.log 2>&1 &'
+    if self.adb:
+      sock = self.adb.open_shell(self.device_id, server_cmd)
+      stop_launcher = lambda: close_socket(sock)
+    else:
+      cmd = f'{self.shellcmd} "{server_cmd}"'
+      process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+      stop_launcher = process.terminate
+    try:
+      # the forwarded port accepts before the server listens, the server is ready once it answers a ping
+      client = wait_until(lambda: self.try_create_client(local_port, server_key), Configuration.server_start_timeout)
+    finally:
+      stop_launcher()
+    if not client:
+      raise TimeoutError('{} albatross server not ready in {}s'.format(self.device_id,
+        Configuration.server_start_timeout))
     if lib_dst_32:
       client.set_2nd_arch_lib(lib_dst_32)
     return client
 
-  def restart_system_server(self):
+  def connect_client(self, local_port, server_key) -> AlbatrossClient:
+    """a client of a server which answered a ping, not only the handshake"""
+    client = AlbatrossClient('127.0.0.1', local_port, 'albatross-' + self.device_id, 500, server_key=server_key)
+    try:
+      client.ping(timeout=5)
+    except BaseException:
+      client.close()
+      raise
+    return client
+
+  def try_create_client(self, local_port, server_key):
+    try:
+      return self.connect_client(local_port, server_key)
+    except Exception:
+      return None
+
+  def system_server_pid(self):
+    return self.client.get_process_pid('system_server')
+
+  def system_server_ready(self, old_pid=0):
+    """
+    The pid of a system_server other than old_pid whose services are published, 0 while
+    not ready. sys.boot_completed only counts because restart_system_server clears it,
+    the activity service is dropped with the old process either way.
+    """
+    pid = self.system_server_pid()
+    if pid <= 0 or pid == old_pid:
+      return 0
+    if 'not found' in self.shell('service check activity'):
+      return 0
+    if self.shell('getprop sys.boot_completed') != '1':
+      return 0
+    return pid
+
+  @staticmethod
+  def system_server_responds(system_server: SystemServerClient):
+    """True once the injected agent answers a call that needs the framework services"""
+    try:
+      return system_server.is_screen_on() is not None
+    except (RpcException, OSError, TimeoutError):
+      return False
+
+  def wait_system_server(self, old_pid=0, timeout=None):
+    """wait until system_server_ready, return its pid or 0 on timeout"""
+    return wait_until(lambda: self.system_server_ready(old_pid),
+      timeout or Configuration.system_server_start_timeout, 0.2) or 0
+
+  def restart_system_server(self, timeout=None):
+    """restart the framework and return the pid of the new system_server once it is ready, 0 on timeout"""
+    old_pid = self.system_server_pid()
     self.root_shell('stop')
-    time.sleep(0.5)
+    # stop only asks init, start before the old system_server is gone would be a no-op
+    wait_until(lambda: self.system_server_pid() <= 0, 5)
+    # init keeps the property of the previous boot, the new system_server sets it again in finishBooting
+    self.root_shell('setprop sys.boot_completed 0')
     self.root_shell('start')
-    time.sleep(1)
+    return self.wait_system_server(old_pid, timeout)
+
+  def reconnect_closed(self, client, kind):
+    """
+    Reconnect a client from its close callback. A server which takes connections and
+    drops them again is given up on after a few reconnects with growing delays
+    instead of being reconnected to in a loop.
+    """
+    with self.stats_lock:
+      delay, last_reconnect = self.reconnect_backoff.get(kind, (0, 0))
+    if time.time() - last_reconnect > self.reconnect_stable_time:
+      delay = 0
+    if delay > self.reconnect_max_delay:
+      print(f'{kind} of {self.device_id} keeps closing, give up reconnecting')
+      with self.stats_lock:
+        self.reconnect_backoff.pop(kind, None)
+      return False
+    if delay:
+      time.sleep(delay)
+    reconnected = client.reconnect()
+    with self.stats_lock:
+      self.reconnect_backoff[kind] = (delay * 2 or 0.2, time.time())
+    return reconnected
 
   def on_system_subscribe_close(self, client):
     print('system_server subscriber close')
-    if client.reconnect():
+    self.count_connection_close('system_server_subscriber')
+    if self.reconnect_closed(client, 'system_server_subscriber'):
       client.subscribe()
     else:
       cached_property.delete(self, "system_server_subscriber")
 
   def on_system_client_close(self, client):
     print('system_server client close')
-    if not client.reconnect():
+    self.count_connection_close('system_server')
+    if not self.reconnect_closed(client, 'system_server'):
       cached_property.delete(self, "system_server_client")
+      self.close_pool('system_server_pool')
+      self.process_table = None
+      self.remove_process_table_listeners()
+
+  def remove_process_table_listeners(self):
+    client = self.__dict__.get('client')
+    subscriber = client.subscriber if client else None
+    if subscriber is not None:
+      for listener in self.process_table_listeners:
+        subscriber.unregister_broadcast_listener(listener)
+    self.process_table_listeners = []
+
+  def on_albatross_launch_process(self, process_info: dict):
+    table = self.process_table
+    if table is not None:
+      table.on_launch_process(process_info)
+
+  def create_process_table(self, system_server: SystemServerClient):
+    table = ProcessTable(system_server.get_all_processes, Configuration.process_table_max_age)
+    if not table.refresh():
+      return None
+    try:
+      # the albatross server tells which processes went away
+      # the default launch_process handler raises once the server waits for a reply
+      subscriber = self.client.create_subscriber({'launch_process': self.on_albatross_launch_process})
+      self.process_table_listeners = [
+        subscriber.register_broadcast_listener(subscriber.process_disconnect, table.on_process_disconnect)]
+    except Exception as e:
+      print('process table without disconnect broadcasts:', e)
+    return table
 
   @cached_property
   def system_server_subscriber(self) -> SystemServerClient:
     port = self.get_forward_port(SystemServerClient.remote_addr)
-    subscribe_client = SystemServerClient('127.0.0.1', port, 'system-' + self.device_id)
+    subscribe_client = SystemServerClient('127.0.0.1', port, 'system-' + self.device_id, multiplex=False,
+      server_key=self.system_server_key)
     subscribe_client.set_on_close_listener(self.on_system_subscribe_close)
     subscribe_client.register_broadcast_handler(subscribe_client.launch_process, self.on_launch_process)
     subscribe_client.subscribe()
     return subscribe_client
 
+  @cached_property
+  def system_server_key(self):
+    # api tables of the agent only change with its dex
+    return file_md5(Configuration.system_server_agent_file)
+
   @cached_property
   def system_server_client(self) -> SystemServerClient:
     client = self.client
     agent_dst = Configuration.system_server_agent_dst
     update = self.push_file(Configuration.system_server_agent_file, agent_dst, mode='444')
     if update:
-      self.restart_system_server()
-      time.sleep(20)
-    server_pid = client.get_process_pid('system_server')
-    if server_pid <= 0:
-      self.restart_system_server()
-      time.sleep(15)
+      server_pid = self.restart_system_server()
+    else:
       server_pid = client.get_process_pid('system_server')
+    if server_pid <= 0:
+      server_pid = self.restart_system_server()
     if server_pid <= 0:
       return cached_property.nil_value
     res = client.inject_albatross(server_pid, SystemServerClient.inject_flags, '')
     if res < 0:
+      self.count_inject(res)
       return cached_property.nil_value
     res = client.load_dex(server_pid, agent_dst, None, Configuration.albatross_class_name,
       Configuration.system_server_init_class, Configuration.albatross_register_func,
       SystemServerClient.dex_flags, timeout=30)
+    self.count_inject(0, res)
     if res in [DexLoadResult.DEX_LOAD_SUCCESS, DexLoadResult.DEX_ALREADY_LOAD]:
       port = self.get_forward_port(Configuration.system_server_address)
-      system_server = SystemServerClient('127.0.0.1', port, 'system-' + self.device_id)
+      server_key = self.system_server_key
+      system_server = SystemServerClient('127.0.0.1', port, 'system-' + self.device_id, server_key=server_key)
+      if not wait_until(lambda: self.system_server_responds(system_server),
+          Configuration.system_server_start_timeout, 0.2):
+        print('system_server agent does not respond')
+        system_server.close()
+        return cached_property.nil_value
       system_server.init()
       system_server.set_on_close_listener(self.on_system_client_close)
-      subscribe_client = SystemServerClient('127.0.0.1', port, 'system-' + self.device_id)
+      subscribe_client = SystemServerClient('127.0.0.1', port, 'system-' + self.device_id, multiplex=False,
+        server_key=server_key)
       subscribe_client.set_on_close_listener(self.on_system_subscribe_close)
       subscribe_client.register_broadcast_handler(subscribe_client.launch_process, self.on_launch_process)
       subscribe_client.subscribe()
       system_server.set_intercept_app(None)
       cached_property.reset(self, 'system_server_subscriber', subscribe_client)
+      self.process_table = self.create_process_table(system_server)
       return system_server
     return cached_property.nil_value
 
@@ -442,16 +1001,29 @@ class AlbatrossDevice(object):
     client.set_on_close_listener(self.__on_close)
     return client
 
+  @cached_property
+  def albatross_pool(self) -> RpcClientPool:
+    client = self.client
+    return RpcClientPool(AlbatrossClient, client.host, client.port, Configuration.client_pool_size,
+      'albatross-pool-' + self.device_id, client.default_timeout, template=client)
+
+  @cached_property
+  def system_server_pool(self) -> RpcClientPool:
+    client = self.system_server_client
+    return RpcClientPool(SystemServerClient, client.host, client.port, Configuration.client_pool_size,
+      'system-pool-' + self.device_id, client.default_timeout, template=client)
+
   @cached_property
   def is_64(self):
     return '64' in self.cpu_api
 
   @cached_property
   def cpu_api(self):
-    cpu_api = self.shell('getprop ro.product.cpu.abi')
+    facts = self.facts
+    cpu_api = facts.get('abi')
     if cpu_api:
       return cpu_api
-    file_type = self.shell('file /system/bin/sh')
+    file_type = facts.get('sh_file', '')
     if 'arm64' in file_type:
       return 'arm64-v8a'
     if 'arm' in file_type:
@@ -466,7 +1038,10 @@ class AlbatrossDevice(object):
   app_inject_flags = InjectFlag.KEEP | InjectFlag.UNIX
 
   def on_launch_process(self, process_info: dict) -> byte:
-    print('launch process', process_info)
+    logger.debug('launch process %s', process_info)
+    table = self.process_table
+    if table is not None:
+      table.on_launch_process(process_info)
     uid = process_info['uid']
     inject_record = self.process_launch_callback.get(uid)
     if inject_record:
@@ -503,36 +1078,74 @@ class AlbatrossDevice(object):
     success = []
     if pids:
       assert os.path.exists(inject_dex)
-      client = self.client
+      if dex_lib:
+        assert os.path.exists(dex_lib)
       inject_dex_dst = Configuration.app_injector_dir + os.path.basename(inject_dex)
-      self.push_file(inject_dex, inject_dex_dst, mode='444')
-      for pid in pids:
-        pid_int = int(pid)
-        res = client.inject_albatross(pid_int, self.app_inject_flags, None)
-        if res >= 0:
-          if dex_lib:
-            assert os.path.exists(dex_lib)
-            if client.get_process_isa(pid_int) in [RunTimeISA.ISA_X86_64, RunTimeISA.ISA_ARM64]:
-              lib_dst_device = self.lib_dir + os.path.basename(dex_lib)
-            else:
-              lib_dst_device = self.lib32_dir + os.path.basename(dex_lib)
-            self.push_file(dex_lib, lib_dst_device)
-          else:
-            lib_dst_device = None
-          agent_dex = self.agent_dex
-          res = client.load_injector(pid_int, agent_dex, None, Configuration.albatross_class_name,
-            Configuration.albatross_agent_class, Configuration.albatross_register_func,
-            init_flags, inject_dex_dst, lib_dst_device, injector_class, arg_str,
-            arg_int)
-          if res in [DexLoadResult.DEX_LOAD_SUCCESS, DexLoadResult.DEX_ALREADY_LOAD]:
-            success.append(pid_int)
+      graph = TaskGraph('attach-' + self.device_id)
+      graph.add('client', lambda: self.client)
+      # pushes need shell_user from the root check of client, which also deploys the agent dex
+      graph.add('inject_dex', lambda: self.push_file(inject_dex, inject_dex_dst, mode='444'), ['client'])
+      graph.add('agent_dex', lambda: self.agent_dex, ['client'])
+      if dex_lib:
+        # most processes run the primary abi, attach_pid finds it in the manifest afterward
+        graph.add('dex_lib', lambda: self.push_file(dex_lib, self.lib_dir + os.path.basename(dex_lib)), ['client'])
+      client = self.run_steps(graph)['client']
+      attach_args = (inject_dex_dst, dex_lib, injector_class, arg_str, arg_int, init_flags)
+      success = self.attach_pids(client, pids, attach_args)
+      if len(success) < len(pids) and isinstance(package_or_pid, str) and self.process_table is not None:
+        # the failed pids left the table, the process may run under a pid it missed
+        new_pids = [pid for pid in self.pidof(package_or_pid, use_table=False) if pid not in pids]
+        if new_pids:
+          success += self.attach_pids(client, new_pids, attach_args)
+    return success
+
+  def attach_pids(self, client, pids, attach_args) -> list:
+    if len(pids) > 1 and Configuration.client_pool_size > 1:
+      # every rpc of the pool borrows its own connection, so pids are injected in parallel
+      pool = self.albatross_pool
+      with ThreadPoolExecutor(min(len(pids), pool.size), 'attach-' + self.device_id) as executor:
+        results = executor.map(lambda pid: self.attach_pid(pool, int(pid), *attach_args), pids)
+        return [pid for pid in results if pid is not None]
+    success = []
+    for pid in pids:
+      pid_int = self.attach_pid(client, int(pid), *attach_args)
+      if pid_int is not None:
+        success.append(pid_int)
     return success
 
+  def attach_pid(self, client, pid_int, inject_dex_dst, dex_lib, injector_class, arg_str, arg_int, init_flags):
+    res = client.inject_albatross(pid_int, self.app_inject_flags, None)
+    if res < 0:
+      self.count_inject(res)
+      table = self.process_table
+      if table is not None:
+        # most likely the process is gone, the next refresh adds it back otherwise
+        table.remove(pid_int)
+      return None
+    if dex_lib:
+      if client.get_process_isa(pid_int) in [RunTimeISA.ISA_X86_64, RunTimeISA.ISA_ARM64]:
+        lib_dst_device = self.lib_dir + os.path.basename(dex_lib)
+      else:
+        lib_dst_device = self.lib32_dir + os.path.basename(dex_lib)
+      with self.push_lock:
+        self.push_file(dex_lib, lib_dst_device)
+    else:
+      lib_dst_device = None
+    agent_dex = self.agent_dex
+    res = client.load_injector(pid_int, agent_dex, None, Configuration.albatross_class_name,
+      Configuration.albatross_agent_class, Configuration.albatross_register_func,
+      init_flags, inject_dex_dst, lib_dst_device, injector_class, arg_str,
+      arg_int)
+    self.count_inject(0, res)
+    if res in [DexLoadResult.DEX_LOAD_SUCCESS, DexLoadResult.DEX_ALREADY_LOAD]:
+      return pid_int
+    return None
+
   def get_forward_port(self, remote_port, not_check=True):
     if isinstance(remote_port, int):
       remote_port = 'tcp:' + str(remote_port)
     for s, lp, rp in self.forward_list():
-      if rp == remote_port and s == self:
+      if rp == remote_port and s == self.device_id:
         local_port = int(lp[4:])
         if not_check or check_socket_port("127.0.0.1", local_port):
           break
@@ -542,9 +1155,10 @@ class AlbatrossDevice(object):
     return local_port
 
   def get_app_main_activities(self, pkg):
-    cmd = self.shellcmd + " dumpsys package " + pkg
-    _, ret_bs = run_shell(cmd)
-    ret_str = ret_bs.decode("utf-8")
+    activities = self.system_server_call('get_main_activities', pkg)
+    if activities is not None:
+      return activities
+    ret_str = self.shell("dumpsys package " + pkg)
     res = ret_str.split("android.intent.action.MAIN:")
     if len(res) > 1:
       str_list = (re.match("(\\s+[\\da-f]+\\s+[\\w/.]+)+", res[1]).group(0).strip().split())
@@ -553,20 +1167,31 @@ class AlbatrossDevice(object):
     return []
 
   def start_activity(self, pkg_activity, action=None):
-    command = self.cmd + "shell am start -n {}".format(pkg_activity)
+    if action is None and '/' in pkg_activity:
+      pkg, activity = pkg_activity.split('/', 1)
+      if activity.startswith('.'):
+        activity = pkg + activity
+      res = self.system_server_call('start_activity', pkg, activity, 0)
+      if res is not None:
+        return res == 'success'
+    command = "am start -n {}".format(pkg_activity)
     if action:
       command += ' -a ' + action
-    # command = self.cmd + 'shell am start -n {}/{}'.format(pkg_name, activity)
-    ret_code, ret_str = run_shell(command, timeout=None)
-    if ret_code == 0 and b"Error" not in ret_str:
+    ret_str = self.shell(command, timeout=60)
+    if self.ret_code == 0 and "Error" not in ret_str:
       return True
     else:
       return False
 
   def stop_app(self, target_package):
-    command = self.shellcmd + "am force-stop " + target_package
-    ret_code, _ = run_shell(command)
-    if ret_code == 0:
+    table = self.process_table
+    if table is not None:
+      table.remove_package(target_package)
+    res = self.system_server_call('force_stop_app', target_package)
+    if res is not None:
+      return res
+    self.shell("am force-stop " + target_package)
+    if self.ret_code == 0:
       return True
     return False
 
@@ -583,6 +1208,9 @@ class AlbatrossDevice(object):
     return pkg in self.get_user_packages(include_disabled=True)
 
   def get_user_packages(self, include_disabled=False):
+    pkgs = self.system_server_call('get_packages', True, include_disabled)
+    if pkgs is not None:
+      return pkgs
     if include_disabled:
       pkgs = self.shell('pm list packages -3')
     else:
@@ -590,12 +1218,10 @@ class AlbatrossDevice(object):
     return pkg_pattern.findall(pkgs)
 
   def home(self):
-    cmd = self.shellcmd + "input keyevent 3"
-    run_shell(cmd)
+    self.shell("input keyevent 3")
 
   def switch_app(self):
-    cmd = self.shellcmd + 'input keyevent KEYCODE_APP_SWITCH'
-    run_shell(cmd)
+    self.shell('input keyevent KEYCODE_APP_SWITCH')
 
 
 _device_manager = None
@@ -605,15 +1231,33 @@ class DeviceManager:
 
   def __init__(self):
     self.devices = {}
+    registry = get_device_registry()
+    if registry:
+      registry.add_listener(self.on_device_state)
+
+  def on_device_state(self, serial, state, old_state):
+    if state == STATE_OFFLINE and ":" in serial:
+      adb_disconnect(serial)
+    device = self.devices.get(serial)
+    if device is not None and old_state == STATE_DEVICE:
+      # the shells died with the transport
+      device.close_shell_sessions()
 
   def get_devices(self, device_id) -> AlbatrossDevice:
+    registry = get_device_registry()
+    if registry and not registry.ready.is_set():
+      registry = None
+    if registry and device_id in self.devices and registry.is_online(device_id):
+      return self.devices[device_id]
     if device_id and ":" in device_id:
-      if device_id not in run_shell(adb_path + " devices")[1].decode():
+      if device_id not in get_devices():
         if "." in device_id or "localhost" in device_id:
-          run_shell(adb_path + " connect " + device_id, timeout=5)
+          adb_connect(device_id, timeout=5)
         else:
           port = device_id.split(":")[1]
-          run_shell(adb_path + " connect 127.0.0.1:" + port, timeout=5)
+          adb_connect("127.0.0.1:" + port, timeout=5)
+        if registry:
+          registry.wait_state(device_id, timeout=5)
     devices = get_devices()
     if not devices:
       raise NoDeviceFound()
@@ -0,0 +1,165 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import traceback
+
+from .adb_client import AdbClient, AdbError, get_adb_client
+from .common import Configuration
+
+STATE_DEVICE = 'device'
+STATE_OFFLINE = 'offline'
+
+
+class DeviceRegistry(object):
+  """
+  Device states pushed by the adb server over host:track-devices. The server sends
+  the whole device list whenever it changes, so lookups read the table instead of
+  asking adb. Listeners are called with (serial, state, old_state) on every change,
+  state is None when the device is gone.
+  """
+  retry_interval = 1
+
+  def __init__(self, adb: AdbClient):
+    self.adb = adb
+    self.lock = threading.Lock()
+    self.changed = threading.Condition(self.lock)
+    self.states = {}
+    self.listeners = []
+    self.ready = threading.Event()
+    self.running = False
+    self.track_thread: threading.Thread | None = None
+    self.sock = None
+
+  def start(self):
+    if self.running:
+      return self
+    self.running = True
+    track_thread = threading.Thread(target=self.__track_loop, name='adb-track-devices', daemon=True)
+    self.track_thread = track_thread
+    track_thread.start()
+    return self
+
+  def stop(self):
+    self.running = False
+    sock = self.sock
+    if sock:
+      sock.close()
+
+  def wait_ready(self, timeout=None):
+    return self.ready.wait(timeout)
+
+  def __track_loop(self):
+    adb = self.adb
+    while self.running:
+      try:
+        sock = adb.create_connection()
+        self.sock = sock
+        try:
+          adb.send_request(sock, 'host:track-devices')
+          adb.check_status(sock, 'host:track-devices')
+          sock.settimeout(None)
+          while self.running:
+            self.update(parse_devices(adb.read_hex_data(sock)))
+            self.ready.set()
+        finally:
+          self.sock = None
+          sock.close()
+      except (OSError, AdbError) as e:
+        if self.running and self.ready.is_set():
+          print('adb track-devices lost:', e)
+      except Exception:
+        traceback.print_exc()
+      # lookups fall back to asking adb until the stream is back
+      self.ready.clear()
+      if self.running:
+        time.sleep(self.retry_interval)
+
+  def update(self, devices: dict):
+    changes = []
+    with self.lock:
+      states = self.states
+      for serial, state in devices.items():
+        old_state = states.get(serial)
+        if old_state != state:
+          changes.append((serial, state, old_state))
+      for serial in states.keys() - devices.keys():
+        changes.append((serial, None, states[serial]))
+      self.states = devices
+      listeners = list(self.listeners)
+      self.changed.notify_all()
+    for change in changes:
+      for listener in listeners:
+        try:
+          listener(*change)
+        except Exception:
+          traceback.print_exc()
+
+  def add_listener(self, listener):
+    with self.lock:
+      self.listeners.append(listener)
+
+  def remove_listener(self, listener):
+    with self.lock:
+      if listener in self.listeners:
+        self.listeners.remove(listener)
+
+  def get_state(self, serial):
+    return self.states.get(serial)
+
+  def is_online(self, serial):
+    return self.states.get(serial) == STATE_DEVICE
+
+  def wait_state(self, serial, state=STATE_DEVICE, timeout=None):
+    deadline = time.time() + timeout if timeout else None
+    with self.changed:
+      while self.states.get(serial) != state:
+        remain = deadline - time.time() if deadline else None
+        if remain is not None and remain <= 0:
+          return False
+        self.changed.wait(remain)
+    return True
+
+  def devices(self):
+    """serials which are not offline, same as device.get_devices"""
+    return [serial for serial, state in self.states.items() if state != STATE_OFFLINE]
+
+
+def parse_devices(data: bytes) -> dict:
+  devices = {}
+  for line in data.decode().splitlines():
+    parts = line.split()
+    if len(parts) >= 2:
+      devices[parts[0]] = parts[1]
+  return devices
+
+
+_device_registry = None
+
+
+def get_device_registry() -> DeviceRegistry | None:
+  """
+  The running registry, or None when adb is used through the binary or tracking is
+  disabled by track_devices. The first call waits briefly for the initial device list.
+  """
+  global _device_registry
+  if _device_registry is None:
+    adb = get_adb_client()
+    if adb and Configuration.track_devices:
+      _device_registry = DeviceRegistry(adb).start()
+      _device_registry.wait_ready(2)
+    else:
+      _device_registry = False
+  return _device_registry or None
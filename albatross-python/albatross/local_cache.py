@@ -0,0 +1,67 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# json files under Configuration.cache_dir that survive restarts of the host process
+
+import json
+import os
+import re
+import threading
+import traceback
+
+from .common import Configuration
+
+unsafe_name_pattern = re.compile(r'[^\w.-]')
+
+
+def cache_file(category, key):
+  cache_dir = Configuration.cache_dir
+  if not cache_dir:
+    return None
+  return os.path.join(cache_dir, category, unsafe_name_pattern.sub('_', key) + '.json')
+
+
+def load_json(category, key):
+  path = cache_file(category, key)
+  if not path or not os.path.exists(path):
+    return None
+  try:
+    with open(path) as fp:
+      return json.load(fp)
+  except (OSError, ValueError):
+    traceback.print_exc()
+    return None
+
+
+def save_json(category, key, value):
+  path = cache_file(category, key)
+  if not path:
+    return False
+  try:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp{}-{}'.format(os.getpid(), threading.get_ident())
+    with open(tmp_path, 'w') as fp:
+      json.dump(value, fp)
+    # readers never see a half written file
+    os.replace(tmp_path, path)
+    return True
+  except OSError:
+    traceback.print_exc()
+    return False
+
+
+def delete_json(category, key):
+  path = cache_file(category, key)
+  if path and os.path.exists(path):
+    os.remove(path)
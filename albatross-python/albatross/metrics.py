@@ -0,0 +1,197 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+# values below 2**SUB_BUCKET_BITS microseconds get a bucket each, above that every
+# power of two is split into SUB_BUCKET_HALF buckets, so a recorded value is off by
+# less than 1/SUB_BUCKET_HALF (under 2%) whatever its magnitude
+SUB_BUCKET_BITS = 7
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1
+# values are clamped to about 71 minutes
+MAX_VALUE = (1 << 32) - 1
+BUCKET_COUNT = (MAX_VALUE.bit_length() - SUB_BUCKET_BITS + 1) * SUB_BUCKET_HALF + SUB_BUCKET_HALF
+
+PHASES = ('send', 'wait', 'parse')
+
+
+def bucket_index(value: int) -> int:
+  if value < SUB_BUCKET_COUNT:
+    return value
+  shift = value.bit_length() - SUB_BUCKET_BITS
+  return shift * SUB_BUCKET_HALF + (value >> shift)
+
+
+def bucket_value(index: int) -> int:
+  """the highest value that lands in bucket index"""
+  if index < SUB_BUCKET_COUNT:
+    return index
+  shift = index // SUB_BUCKET_HALF - 1
+  return ((index - shift * SUB_BUCKET_HALF + 1) << shift) - 1
+
+
+class LatencyHistogram(object):
+  """
+  HDR style histogram of durations in seconds, kept as microsecond counts in log-linear
+  buckets. Recording is a couple of integer operations, percentiles walk the buckets.
+  The histogram has no lock of its own, MethodMetrics records under its lock.
+  """
+
+  def __init__(self):
+    self.counts = [0] * BUCKET_COUNT
+    self.count = 0
+    self.total = 0
+    self.max = 0
+
+  def record(self, seconds: float):
+    value = int(seconds * 1000000)
+    if value > MAX_VALUE:
+      value = MAX_VALUE
+    elif value < 0:
+      value = 0
+    self.counts[bucket_index(value)] += 1
+    self.count += 1
+    self.total += value
+    if value > self.max:
+      self.max = value
+
+  def merge(self, other: 'LatencyHistogram'):
+    counts = self.counts
+    for i, count in enumerate(other.counts):
+      if count:
+        counts[i] += count
+    self.count += other.count
+    self.total += other.total
+    if other.max > self.max:
+      self.max = other.max
+
+  def copy(self) -> 'LatencyHistogram':
+    histogram = LatencyHistogram()
+    histogram.merge(self)
+    return histogram
+
+  def percentile(self, percent: float) -> float:
+    if not self.count:
+      return 0.0
+    rank = max(1, int(self.count * percent / 100 + 0.5))
+    seen = 0
+    for i, count in enumerate(self.counts):
+      if count:
+        seen += count
+        if seen >= rank:
+          return min(bucket_value(i), self.max) / 1000000
+    return self.max / 1000000
+
+  def mean(self) -> float:
+    return self.total / self.count / 1000000 if self.count else 0.0
+
+  def summary(self) -> dict:
+    return {'count': self.count, 'mean': self.mean(), 'p50': self.percentile(50), 'p99': self.percentile(99),
+            'max': self.max / 1000000}
+
+
+class MethodMetrics(object):
+  """counters and send/wait/parse latencies of one rpc method of one client"""
+
+  def __init__(self, name):
+    self.name = name
+    self.lock = threading.Lock()
+    self.calls = 0
+    self.errors = 0
+    self.bytes_out = 0
+    self.bytes_in = 0
+    self.send = LatencyHistogram()
+    self.wait = LatencyHistogram()
+    self.parse = LatencyHistogram()
+
+  def record(self, send, wait, parse, bytes_out, bytes_in, error=False):
+    """a phase that did not happen is None"""
+    with self.lock:
+      self.calls += 1
+      if error:
+        self.errors += 1
+      self.bytes_out += bytes_out
+      self.bytes_in += bytes_in
+      if send is not None:
+        self.send.record(send)
+      if wait is not None:
+        self.wait.record(wait)
+      if parse is not None:
+        self.parse.record(parse)
+
+  def reset(self):
+    with self.lock:
+      self.calls = 0
+      self.errors = 0
+      self.bytes_out = 0
+      self.bytes_in = 0
+      for phase in PHASES:
+        setattr(self, phase, LatencyHistogram())
+
+  def copy(self) -> 'MethodMetrics':
+    metrics = MethodMetrics(self.name)
+    with self.lock:
+      metrics.calls = self.calls
+      metrics.errors = self.errors
+      metrics.bytes_out = self.bytes_out
+      metrics.bytes_in = self.bytes_in
+      for phase in PHASES:
+        setattr(metrics, phase, getattr(self, phase).copy())
+    return metrics
+
+  def summary(self) -> dict:
+    metrics = self.copy()
+    summary = {'calls': metrics.calls, 'errors': metrics.errors, 'bytes_out': metrics.bytes_out,
+               'bytes_in': metrics.bytes_in}
+    for phase in PHASES:
+      summary[phase] = getattr(metrics, phase).summary()
+    return summary
+
+
+class ClientMetrics(object):
+  """the MethodMetrics of every method one client called"""
+
+  def __init__(self, name):
+    self.name = name
+    self.lock = threading.Lock()
+    self.methods: dict[str, MethodMetrics] = {}
+
+  def method(self, name) -> MethodMetrics:
+    metrics = self.methods.get(name)
+    if metrics is None:
+      with self.lock:
+        metrics = self.methods.get(name)
+        if metrics is None:
+          metrics = MethodMetrics(name)
+          self.methods[name] = metrics
+    return metrics
+
+  def snapshot(self) -> dict[str, MethodMetrics]:
+    """consistent copies of the method metrics, safe to read while calls go on"""
+    with self.lock:
+      methods = list(self.methods.values())
+    return {metrics.name: metrics.copy() for metrics in methods}
+
+  def summary(self) -> dict:
+    with self.lock:
+      methods = list(self.methods.values())
+    return {metrics.name: metrics.summary() for metrics in methods}
+
+  def reset(self):
+    """zero the counters, the rpc methods keep recording into their MethodMetrics"""
+    with self.lock:
+      methods = list(self.methods.values())
+    for metrics in methods:
+      metrics.reset()
@@ -0,0 +1,272 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .common import Configuration
+from .device import AlbatrossDevice, DeviceManager, get_device_manager
+from .device_registry import get_device_registry
+from .metrics import ClientMetrics, PHASES
+
+QUANTILES = (('0.5', 50), ('0.99', 99), ('1', 100))
+
+
+def escape_label(value) -> str:
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsWriter(object):
+  """collects samples per metric family and renders the Prometheus text format"""
+
+  def __init__(self):
+    self.families = {}
+
+  def add(self, name, metric_type, help_text, value, suffix='', **labels):
+    """suffix is appended to the sample name, e.g. _sum and _count of a summary"""
+    family = self.families.get(name)
+    if family is None:
+      family = self.families[name] = (metric_type, help_text, [])
+    family[2].append((name + suffix, labels, value))
+
+  def render(self) -> str:
+    lines = []
+    for name, (metric_type, help_text, samples) in self.families.items():
+      lines.append(f'# HELP {name} {help_text}')
+      lines.append(f'# TYPE {name} {metric_type}')
+      for sample_name, labels, value in samples:
+        if labels:
+          label_str = ','.join(f'{key}="{escape_label(label)}"' for key, label in labels.items())
+          lines.append(f'{sample_name}{{{label_str}}} {value}')
+        else:
+          lines.append(f'{sample_name} {value}')
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def device_clients(device: AlbatrossDevice):
+  """(kind, client) of the connections the device has open, without opening any"""
+  device_dict = device.__dict__
+  client = device_dict.get('client')
+  if client:
+    yield 'albatross', client
+    if client.subscriber:
+      yield 'albatross_subscriber', client.subscriber
+  system_server = device_dict.get('system_server_client')
+  if system_server:
+    yield 'system_server', system_server
+  subscriber = device_dict.get('system_server_subscriber')
+  if subscriber:
+    yield 'system_server_subscriber', subscriber
+
+
+def device_metrics(device: AlbatrossDevice):
+  """(kind, ClientMetrics) of the device clients and client pools"""
+  for kind, client in device_clients(device):
+    if 'metrics' in client.__dict__:
+      yield kind, client.metrics
+  device_dict = device.__dict__
+  for kind, pool_name in (('albatross_pool', 'albatross_pool'), ('system_server_pool', 'system_server_pool')):
+    pool = device_dict.get(pool_name)
+    if pool is not None:
+      yield kind, pool.metrics
+
+
+def write_rpc_metrics(writer: MetricsWriter, device_id, kind, client_metrics: ClientMetrics):
+  for method, metrics in client_metrics.snapshot().items():
+    labels = {'device': device_id, 'client': kind, 'method': method}
+    writer.add('albatross_rpc_calls_total', 'counter', 'rpc calls', metrics.calls, **labels)
+    writer.add('albatross_rpc_errors_total', 'counter', 'rpc calls which raised', metrics.errors, **labels)
+    writer.add('albatross_rpc_sent_bytes_total', 'counter', 'bytes of rpc requests', metrics.bytes_out, **labels)
+    writer.add('albatross_rpc_received_bytes_total', 'counter', 'bytes of rpc responses', metrics.bytes_in, **labels)
+    for phase in PHASES:
+      histogram = getattr(metrics, phase)
+      if not histogram.count:
+        continue
+      name = 'albatross_rpc_latency_seconds'
+      help_text = 'rpc latency by phase: send the request, wait for the response, parse it'
+      for quantile, percent in QUANTILES:
+        writer.add(name, 'summary', help_text, histogram.percentile(percent), phase=phase, quantile=quantile, **labels)
+      writer.add(name, 'summary', help_text, histogram.total / 1000000, suffix='_sum', phase=phase, **labels)
+      writer.add(name, 'summary', help_text, histogram.count, suffix='_count', phase=phase, **labels)
+
+
+def tracked_registry():
+  """
+  the device registry when it has the device list, a scrape never asks adb itself:
+  get_devices() would run adb devices and disconnect offline devices
+  """
+  registry = get_device_registry()
+  if registry and registry.ready.is_set():
+    return registry
+  return None
+
+
+def write_device_metrics(writer: MetricsWriter, device: AlbatrossDevice, registry, now):
+  device_id = device.device_id
+  if registry:
+    writer.add('albatross_device_online', 'gauge', '1 when adb lists the device', int(registry.is_online(device_id)),
+      device=device_id)
+  is_root = device.__dict__.get('is_root')
+  if is_root is not None:
+    writer.add('albatross_device_root', 'gauge', '1 when the device has root', int(bool(is_root)), device=device_id)
+  for kind, client in device_clients(device):
+    if client.sock and client.connect_time:
+      writer.add('albatross_connection_age_seconds', 'gauge', 'seconds since the client connected',
+        round(now - client.connect_time, 3), device=device_id, client=kind)
+    writer.add('albatross_connection_connects_total', 'counter', 'connects of the current client, reconnects included',
+      client.connect_count, device=device_id, client=kind)
+    writer.add('albatross_broadcast_parked', 'gauge', '1 while the subscriber waits for room in the broadcast queue',
+      int(client.parked_broadcast is not None), device=device_id, client=kind)
+    dispatcher = client.broadcast_dispatcher
+    if dispatcher is not None:
+      writer.add('albatross_broadcast_queue_depth', 'gauge', 'broadcasts waiting for or running on a worker',
+        dispatcher.pending, device=device_id, client=kind)
+      writer.add('albatross_broadcast_queue_size', 'gauge', 'broadcasts the worker pool holds at most',
+        dispatcher.max_pending, device=device_id, client=kind)
+  with device.stats_lock:
+    closes = dict(device.connection_closes)
+    dex_load_results = dict(device.dex_load_results)
+    inject_failures = device.inject_failures
+  for kind, count in closes.items():
+    writer.add('albatross_connection_closes_total', 'counter', 'connections the device lost', count,
+      device=device_id, client=kind)
+  writer.add('albatross_inject_failures_total', 'counter', 'inject_albatross calls which failed', inject_failures,
+    device=device_id)
+  for result, count in dex_load_results.items():
+    writer.add('albatross_dex_load_total', 'counter', 'dex loads after a successful inject by DexLoadResult', count,
+      device=device_id, result=result)
+  for kind, client_metrics in device_metrics(device):
+    write_rpc_metrics(writer, device_id, kind, client_metrics)
+
+
+def collect_metrics(manager: DeviceManager) -> str:
+  writer = MetricsWriter()
+  registry = tracked_registry()
+  now = time.time()
+  for device in list(manager.devices.values()):
+    try:
+      write_device_metrics(writer, device, registry, now)
+    except Exception:
+      traceback.print_exc()
+  return writer.render()
+
+
+def collect_health(manager: DeviceManager) -> tuple[bool, dict]:
+  """
+  healthy when every device the manager knows is online and has its albatross client.
+  Without a device registry online is null and only the client counts
+  """
+  registry = tracked_registry()
+  devices = {}
+  healthy = True
+  for device_id, device in list(manager.devices.items()):
+    online = registry.is_online(device_id) if registry else None
+    connected = bool(device.__dict__.get('client'))
+    devices[device_id] = {'online': online, 'connected': connected}
+    if online is False or not connected:
+      healthy = False
+  return healthy, {'status': 'ok' if healthy else 'degraded', 'devices': devices}
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+  manager: DeviceManager = None
+
+  def do_GET(self):
+    path = self.path.split('?', 1)[0]
+    if path == '/metrics':
+      self.reply(200, 'text/plain; version=0.0.4; charset=utf-8', collect_metrics(self.manager).encode())
+    elif path == '/health':
+      healthy, status = collect_health(self.manager)
+      self.reply(200 if healthy else 503, 'application/json', json.dumps(status).encode())
+    else:
+      self.reply(404, 'text/plain', b'not found\n')
+
+  def reply(self, code, content_type, body):
+    self.send_response(code)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    # scrapes come every few seconds, keep them out of the output
+    pass
+
+
+class MetricsServer(object):
+  """
+  /metrics in the Prometheus text format and /health as json for the devices of a
+  DeviceManager, served by a daemon thread. Scrapes only read state the devices
+  and the device registry already have, they never run adb, connect a client or
+  run a shell on the device. albatross_device_online is left out when adb is not
+  tracked by a registry.
+  """
+
+  def __init__(self, manager: DeviceManager, host='127.0.0.1', port=0):
+    handler = type('BoundMetricsRequestHandler', (MetricsRequestHandler,), {'manager': manager})
+    self.httpd = ThreadingHTTPServer((host, port), handler)
+    self.httpd.daemon_threads = True
+    self.thread: threading.Thread | None = None
+
+  @property
+  def address(self):
+    return self.httpd.server_address
+
+  def start(self):
+    thread = threading.Thread(target=self.httpd.serve_forever, name='albatross-metrics', daemon=True)
+    self.thread = thread
+    thread.start()
+    return self
+
+  def stop(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
+
+_metrics_server: MetricsServer | None = None
+_metrics_server_tried = False
+_metrics_server_lock = threading.Lock()
+
+
+def start_metrics_server(manager: DeviceManager = None, host=None, port=None) -> MetricsServer:
+  """start the metrics endpoint once, port 0 picks a free port"""
+  global _metrics_server
+  with _metrics_server_lock:
+    if _metrics_server is None:
+      if manager is None:
+        manager = get_device_manager()
+      if host is None:
+        host = Configuration.metrics_host
+      if port is None:
+        port = Configuration.metrics_port
+      _metrics_server = MetricsServer(manager, host, port).start()
+      print('albatross metrics on http://{}:{}/metrics'.format(*_metrics_server.address[:2]))
+  return _metrics_server
+
+
+def start_configured_metrics_server(manager: DeviceManager = None):
+  """start the endpoint when metrics_port is configured, only the first call tries"""
+  global _metrics_server_tried
+  if _metrics_server_tried:
+    return
+  _metrics_server_tried = True
+  if Configuration.metrics_port:
+    try:
+      start_metrics_server(manager)
+    except OSError as e:
+      print('metrics server not started:', e)
@@ -0,0 +1,176 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import traceback
+from dataclasses import dataclass
+
+
+@dataclass
+class ProcessRecord:
+  pid: int
+  uid: int
+  name: str
+  packages: tuple = ()
+  importance: int = 0
+
+
+class ProcessTable(object):
+  """
+  App processes of one device indexed by pid, uid, process name and package. It is
+  seeded from SystemServerClient.get_all_processes, launch_process broadcasts add
+  processes and process_disconnect removes them. Processes started without a
+  broadcast or killed on the device are only seen by the next refresh: a lookup on a
+  table older than max_age starts one in the background and answers from the current
+  table, a caller whose call on a pid failed removes it.
+  """
+
+  def __init__(self, loader, max_age=30):
+    self.loader = loader
+    self.max_age = max_age
+    self.lock = threading.Lock()
+    self.by_pid = {}
+    self.by_uid = {}
+    self.by_name = {}
+    self.by_package = {}
+    self.loaded_time = 0
+    # held by the background refresh, a lookup never waits for it
+    self.refresh_lock = threading.Lock()
+    self.check_time = 0
+
+  def __len__(self):
+    return len(self.by_pid)
+
+  @staticmethod
+  def index_add(index, key, pid):
+    pids = index.get(key)
+    if pids is None:
+      index[key] = {pid}
+    else:
+      pids.add(pid)
+
+  @staticmethod
+  def index_remove(index, key, pid):
+    pids = index.get(key)
+    if pids is not None:
+      pids.discard(pid)
+      if not pids:
+        del index[key]
+
+  def __add(self, record: ProcessRecord):
+    pid = record.pid
+    if pid in self.by_pid:
+      self.__remove(pid)
+    self.by_pid[pid] = record
+    self.index_add(self.by_uid, record.uid, pid)
+    if record.name:
+      self.index_add(self.by_name, record.name, pid)
+    for package in record.packages:
+      self.index_add(self.by_package, package, pid)
+
+  def __remove(self, pid):
+    record = self.by_pid.pop(pid, None)
+    if record is None:
+      return None
+    self.index_remove(self.by_uid, record.uid, pid)
+    if record.name:
+      self.index_remove(self.by_name, record.name, pid)
+    for package in record.packages:
+      self.index_remove(self.by_package, package, pid)
+    return record
+
+  def load(self, rows):
+    """rows of get_all_processes: [pid, uid, importance, process_name, packages]"""
+    with self.lock:
+      self.by_pid = {}
+      self.by_uid = {}
+      self.by_name = {}
+      self.by_package = {}
+      for pid, uid, importance, name, packages in rows:
+        self.__add(ProcessRecord(pid, uid, name, tuple(packages or ()), importance))
+      self.loaded_time = time.time()
+
+  def refresh(self, min_interval=0):
+    """reload from the loader unless that happened less than min_interval seconds ago"""
+    if time.time() - self.loaded_time < min_interval:
+      return False
+    try:
+      rows = self.loader()
+    except Exception:
+      traceback.print_exc()
+      return False
+    if rows is None:
+      return False
+    self.load(rows)
+    return True
+
+  def check_age(self):
+    """start a refresh thread when the table is older than max_age, at most one per max_age"""
+    now = time.time()
+    if now - self.loaded_time <= self.max_age or now - self.check_time <= self.max_age:
+      return
+    if not self.refresh_lock.acquire(blocking=False):
+      return
+    self.check_time = now
+    try:
+      threading.Thread(target=self.__refresh_in_background, name='process-table-refresh', daemon=True).start()
+    except BaseException:
+      self.refresh_lock.release()
+      raise
+
+  def __refresh_in_background(self):
+    try:
+      self.refresh()
+    finally:
+      self.refresh_lock.release()
+
+  def add(self, record: ProcessRecord):
+    with self.lock:
+      self.__add(record)
+
+  def remove(self, pid):
+    with self.lock:
+      return self.__remove(pid)
+
+  def remove_package(self, package):
+    """forget the processes of a package, e.g. after a force-stop"""
+    with self.lock:
+      return [self.__remove(pid) for pid in list(self.by_package.get(package, ()))]
+
+  def on_launch_process(self, process_info: dict):
+    pkg = process_info.get('pkg')
+    self.add(ProcessRecord(process_info['pid'], process_info['uid'], process_info.get('process'),
+      (pkg,) if pkg else ()))
+
+  def on_process_disconnect(self, pid: int):
+    self.remove(pid)
+
+  def get(self, pid) -> ProcessRecord | None:
+    self.check_age()
+    return self.by_pid.get(pid)
+
+  def lookup(self, index_name, key) -> list:
+    self.check_age()
+    with self.lock:
+      return sorted(getattr(self, index_name).get(key, ()))
+
+  def pids_of_name(self, name) -> list:
+    return self.lookup('by_name', name)
+
+  def pids_of_uid(self, uid) -> list:
+    return self.lookup('by_uid', uid)
+
+  def pids_of_package(self, package) -> list:
+    return self.lookup('by_package', package)
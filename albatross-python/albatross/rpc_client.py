@@ -13,22 +13,58 @@
 # limitations under the License.
 
 
+import hashlib
 import json
+import logging
+import os
 import select
 import socket
 import struct
 import threading
 import time
 import traceback
-from collections import defaultdict
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from dataclasses import dataclass
 from enum import Enum
 
-from .wrapper import cached_subclass_property
+from .binary_payload import dumps as binary_dumps, loads as binary_loads
+from .broadcast_dispatcher import OrderedDispatcher, DispatcherClosed, get_deadline_timer
+from .broadcast_listeners import BroadcastListener, ListenerRegistry
+from .metrics import ClientMetrics, MethodMetrics
+from .wrapper import cached_property
+
+# request and response of every call at debug level, which is off unless the application
+# enables it, so a call only formats its args and result when someone reads them
+call_logger = logging.getLogger('albatross.rpc')
 
 MSG_APIS = 3
 CALL_ID_MASK = 0xffff
+
+# capability bits sent as the MSG_APIS request payload, a server that supports
+# some of them appends CAPABILITY_MARKER and the accepted bits after the api tables
+CAP_BINARY_PAYLOAD = 0x1
+# frames above the client's threshold may be zlib compressed, which is marked by the
+# top bit of the 24 bit length, so frame data is limited to 8M on such a connection
+CAP_COMPRESS = 0x2
+# advertised by a server which accepts the md5 of the api tables it sent before after
+# the capability word, a client only sends it to a server which advertised this bit
+CAP_API_DIGEST = 0x4
+# only bytes after this marker are read as accepted capabilities, whatever else a
+# server sends after its tables is ignored
+CAPABILITY_MARKER = b'caps'
+
+# b'wq', call id and the length word
+FRAME_HEAD_LEN = 8
+FRAME_LEN_MASK = 0xffffff
+COMPRESSED_LEN_MASK = 0x7fffff
+FLAG_COMPRESSED = 0x800000
 BROADCAST_RESULT_NO_HANDLER = -120
+# a client that already knows the api tables of a CAP_API_DIGEST server appends their md5
+# to the MSG_APIS payload, a server with the same tables answers this result with only
+# the marked capabilities
+API_TABLE_UNCHANGED = 1
 
 old_version = False
 
@@ -60,7 +96,21 @@ class ResultRaw:
 
   @staticmethod
   def parse_value(data, result):
-    return ResultRaw(result, data)
+    return ResultRaw(result, bytes(data) if data is not None else None)
+
+
+@dataclass
+class ApiTable:
+  digest: bytes
+  rpc_tables: dict
+  broadcast_tables: dict
+  broadcast_id_maps: dict
+  # every bit the server marked after the tables, not only those the client asked for
+  server_capabilities: int = 0
+
+
+# (server_key, host, port) -> ApiTable, shared by reconnects, subscribers and pools
+api_table_cache = {}
 
 
 class ServerReturnResult(ByteEnum):
@@ -78,50 +128,157 @@ err_desc = {
 void = type(None)
 
 
-def rpc_send_data(sock, data, call_id, cmd):
+use_sendmsg = hasattr(socket.socket, 'sendmsg')
+try:
+  IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+  IOV_MAX = 16
+
+
+def pack_frame(data, call_id, cmd, flags=0):
   if cmd is None:
     cmd = 0
   if cmd < 0:
     cmd = 256 + cmd
   if data:
-    len_result = len(data) + (cmd << 24)
-    head = b'wq' + struct.pack('<HI', call_id, len_result)
-    sock.send(b''.join([head, data]))
-  else:
-    len_result = cmd << 24
-    head = b'wq' + struct.pack('<HI', call_id, len_result)
-    sock.send(head)
-
-
-def rpc_receive_data(sock):
-  bs = sock.recv(8)
-  if not bs:
-    raise RpcCloseException("not get head data")
-  if bs[:2] != b'wq':
-    raise struct.error('wrong head:' + str(bs))
-  idx, len_result = struct.unpack('<HI', bs[2:])
-  data_len_expect = len_result & 0xffffff
-  result = len_result >> 24
-  if data_len_expect:
-    data_len = data_len_expect
-    buff_list = []
-    while data_len > 0:
-      bs = sock.recv(data_len)
-      if not bs:
-        raise socket.error('socket close')
-      data_len -= len(bs)
-      buff_list.append(bs)
-    if len(buff_list) == 1:
-      data = buff_list[0]
-    else:
-      data = b''.join(buff_list)
-    if len(data) != data_len_expect:
-      print("expect get data {},but get {}".format(data_len, len(data)))
-  else:
-    data = None
-  if result >= 128:
-    result -= 256
-  return idx, result, data
+    data_len = len(data)
+    if data_len > FRAME_LEN_MASK:
+      raise RpcSendException('frame data too large: {}'.format(data_len))
+    return b'wq' + struct.pack('<HI', call_id, data_len + flags + (cmd << 24)), data
+  return b'wq' + struct.pack('<HI', call_id, cmd << 24), None
+
+
+def send_buffers(sock, buffers):
+  """
+  Send every buffer in order without joining them. sendmsg may stop anywhere,
+  so the sent prefix is dropped and the rest is sent again until nothing is left.
+  """
+  if not use_sendmsg:
+    for buffer in buffers:
+      sock.sendall(buffer)
+    return
+  views = [memoryview(buffer) for buffer in buffers]
+  i = 0
+  n = len(views)
+  while i < n:
+    sent = sock.sendmsg(views[i:i + IOV_MAX])
+    while sent:
+      view = views[i]
+      if sent >= view.nbytes:
+        sent -= view.nbytes
+        i += 1
+      else:
+        views[i] = view[sent:]
+        sent = 0
+    while i < n and not views[i].nbytes:
+      i += 1
+
+
+def rpc_send_data(sock, data, call_id, cmd, flags=0):
+  head, data = pack_frame(data, call_id, cmd, flags)
+  if data:
+    send_buffers(sock, [head, data])
+    return len(head) + len(data)
+  sock.sendall(head)
+  return len(head)
+
+
+def rpc_send_frames(sock, frames):
+  """send several (data, call_id, cmd, flags) frames with as few syscalls as possible"""
+  buffers = []
+  for data, call_id, cmd, flags in frames:
+    head, data = pack_frame(data, call_id, cmd, flags)
+    buffers.append(head)
+    if data:
+      buffers.append(data)
+  send_buffers(sock, buffers)
+
+
+class FrameReader(object):
+  """
+  Reads frames with recv_into into a buffer that is reused from frame to frame.
+  The data returned by receive is a memoryview which is only valid until the next
+  receive, so it must be parsed (or copied) before that. With reuse_buffer off each
+  frame gets its own buffer and the view can be handed to another thread.
+  A read interrupted by a timeout is resumed by the next receive.
+  Once CAP_COMPRESS is agreed, set compressed so flagged frames get inflated.
+  """
+  max_keep_size = 1 << 20
+  compressed = False
+
+  def __init__(self, size=4096, reuse_buffer=True):
+    self.reuse_buffer = reuse_buffer
+    self.buffer = bytearray(size if reuse_buffer else 0)
+    self.head = bytearray(8)
+    self.head_view = memoryview(self.head)
+    self.head_size = 0
+    self.frame = None
+    self.data_view = None
+    self.data_size = 0
+
+  def prepare(self, data_len):
+    buffer = self.buffer
+    if not self.reuse_buffer or data_len > self.max_keep_size:
+      return memoryview(bytearray(data_len))
+    if data_len > len(buffer):
+      # views handed out before keep the old buffer alive, so never resize in place
+      buffer = bytearray(max(data_len, len(buffer) * 2))
+      self.buffer = buffer
+    return memoryview(buffer)[:data_len]
+
+  def receive(self, sock):
+    head_size = self.head_size
+    if head_size < 8:
+      head_view = self.head_view
+      while head_size < 8:
+        n = sock.recv_into(head_view[head_size:])
+        if not n:
+          self.head_size = 0
+          if head_size:
+            raise socket.error('socket close')
+          raise RpcCloseException("not get head data")
+        head_size += n
+        self.head_size = head_size
+      head = self.head
+      if head[0] != 0x77 or head[1] != 0x71:
+        self.head_size = 0
+        raise struct.error('wrong head:' + str(bytes(head)))
+      idx, len_result = struct.unpack_from('<HI', head, 2)
+      result = len_result >> 24
+      if result >= 128:
+        result -= 256
+      if self.compressed:
+        data_len = len_result & COMPRESSED_LEN_MASK
+        inflate = len_result & FLAG_COMPRESSED
+      else:
+        data_len = len_result & FRAME_LEN_MASK
+        inflate = 0
+      self.frame = (idx, result, inflate)
+      self.data_view = self.prepare(data_len) if data_len else None
+      self.data_size = 0
+    data_view = self.data_view
+    if data_view is not None:
+      data_len = len(data_view)
+      data_size = self.data_size
+      while data_size < data_len:
+        n = sock.recv_into(data_view[data_size:])
+        if not n:
+          self.head_size = 0
+          raise socket.error('socket close')
+        data_size += n
+        self.data_size = data_size
+    self.head_size = 0
+    self.data_view = None
+    idx, result, inflate = self.frame
+    if inflate and data_view is not None:
+      data_view = memoryview(zlib.decompress(data_view))
+    return idx, result, data_view
+
+
+def rpc_receive_data(sock, reader: FrameReader | None = None):
+  if reader is None:
+    reader = FrameReader(0, False)
+  return reader.receive(sock)
 
 
 def read_string(data, idx):
@@ -129,7 +286,7 @@ def read_string(data, idx):
   if str_len == 0:
     return None, idx + 2
   s = data[idx + 2:idx + str_len + 2]
-  return s.decode(), idx + 2 + str_len + 1
+  return str(s, 'utf-8'), idx + 2 + str_len + 1
 
 
 def read_json(data, idx):
@@ -141,6 +298,10 @@ def read_json(data, idx):
   return s, idx
 
 
+def read_binary(data, idx):
+  return binary_loads(data, idx)
+
+
 def read_int(data, idx):
   i, = struct.unpack('<i', data[idx:idx + 4])
   return i, idx + 4
@@ -199,8 +360,8 @@ def put_bool(b: bool):
 
 def put_string(s: str):
   if s:
-    b_len = struct.pack('<H', len(s))
-    return b''.join([b_len, s.encode(), b'\0'])
+    bs = s.encode()
+    return b''.join([struct.pack('<H', len(bs)), bs, b'\0'])
   return b'\0\0'
 
 
@@ -228,14 +389,15 @@ def convert_bytes(cmd, idx, b: bytes):
 
 
 def convert_string(cmd, idx, s: str):
-  if s:
-    b_len = struct.pack('<H', len(s))
-    return cmd, idx, b''.join([b_len, s.encode(), b'\0'])
-  return cmd, idx, b'\0\0'
+  return cmd, idx, put_string(s)
 
 
 def convert_json(cmd, idx, o):
-  return convert_string(cmd, idx, json.dumps(o, ensure_ascii=False, indent=1))
+  return convert_string(cmd, idx, json.dumps(o, ensure_ascii=False, separators=(',', ':')))
+
+
+def convert_binary(cmd, idx, o):
+  return cmd, idx, binary_dumps(o)
 
 
 def put_bytes(b: bytes):
@@ -283,6 +445,7 @@ class JustReturn(object):
 
 class AlbRpcMethod(object):
   parser = None
+  metrics: MethodMetrics | None = None
 
   def __init__(self, client, name, rpc_id, handler, parser):
     self.client = client
@@ -291,6 +454,8 @@ class AlbRpcMethod(object):
     self.handler = handler
     if parser:
       self.parser = parser
+    if client.collect_metrics:
+      self.metrics = client.metrics.method(name)
 
   def __call__(self, *args, hint=None, timeout=None, **kwargs):
     client = self.client
@@ -298,62 +463,123 @@ class AlbRpcMethod(object):
     if client.prohibit_request:
       raise BanRequestException('forbid request {} this time'.format(method_name))
     assert not kwargs
-    call_counter = client.call_counter
-    method_id = call_counter & CALL_ID_MASK
-    client.call_counter = call_counter + 1
-    rpc_name = client.name
-    quiet = client.quiet
-    if not quiet:
-      method_id_name = method_name + "|" + str(method_id)
-      if hint:
-        print("request method:", method_id_name, args, hint)
-      else:
-        print("request method:", method_id_name, args)
+    multiplex = client.multiplex
+    if multiplex:
+      method_id = client.next_call_id()
     else:
-      method_id_name = None
+      call_counter = client.call_counter
+      method_id = call_counter & CALL_ID_MASK
+      client.call_counter = call_counter + 1
+    rpc_name = client.name
+    method_id_name = self.log_request(method_id, args, hint)
     content = self.handler(*args)
     sock = client.sock
-    if timeout:
+    if timeout and not multiplex:
       sock.settimeout(timeout)
     if content and not isinstance(content, bytes):
       if isinstance(content, JustReturn):
         return content.result
       content = str(content).encode()
+    parser = self.parser
+    metrics = self.metrics
+    sent = received = wait_end = 0
+    send_end = None
+    if multiplex:
+      start = time.time()
+      client.last_request_time = start
+      begin = time.perf_counter()
+      try:
+        future, sent = client.multiplex_send(content, method_id, self.rpc_id, parser != void)
+        send_end = time.perf_counter()
+        result, data = client.multiplex_wait(future, method_id, timeout)
+        wait_end = time.perf_counter()
+        if future is not None:
+          received = FRAME_HEAD_LEN + len(data) if data else FRAME_HEAD_LEN
+        data = self.handle_response(result, data, method_id_name, time.time() - start)
+      except BaseException:
+        if metrics is not None:
+          self.record_metrics(metrics, begin, send_end, wait_end, sent, received, True)
+        raise
+      if metrics is not None:
+        self.record_metrics(metrics, begin, send_end, wait_end, sent, received, False)
+      return data
     request_lock = client.request_lock
     # if request_lock:
     send_exception = None
-    idx, result, data = None, None, None
     get_lock = request_lock.acquire(True, timeout=client.request_lock_wait_time)
     start = time.time()
     client.last_request_time = start
-    parser = self.parser
+    begin = time.perf_counter()
     try:
-      rpc_send_data(sock, content, method_id, self.rpc_id)
+      content, flags = client.compress_payload(content)
+      sent = rpc_send_data(sock, content, method_id, self.rpc_id, flags)
+      send_end = time.perf_counter()
+      idx, result, data = None, None, None
       if parser != void:
-        idx, result, data = rpc_receive_data(sock)
+        frame_reader = client.frame_reader
+        idx, result, data = rpc_receive_data(sock, frame_reader)
         while idx < method_id:
-          idx, result, data = rpc_receive_data(sock)
+          idx, result, data = rpc_receive_data(sock, frame_reader)
+        if idx != method_id:
+          desc = f'rpc {rpc_name} {method_name} response wrong idx except {method_id},got {idx} in {threading.current_thread().name}'
+          print(desc)
+        wait_end = time.perf_counter()
+        received = FRAME_HEAD_LEN + len(data) if data else FRAME_HEAD_LEN
+      # data is a view into the reusable receive buffer, so parse it before releasing the lock
+      data = self.handle_response(result, data, method_id_name, time.time() - start)
     except BaseException as e:
       send_exception = e
     if get_lock:
       request_lock.release()
+    if metrics is not None:
+      self.record_metrics(metrics, begin, send_end, wait_end, sent, received, send_exception is not None)
     if send_exception:
       raise send_exception
-    end = time.time()
+    if timeout:
+      sock.settimeout(client.default_timeout)
+    return data
+
+  @staticmethod
+  def record_metrics(metrics: MethodMetrics, begin, send_end, wait_end, sent, received, error):
+    """phases the call did not reach, e.g. the wait of a void method, are not recorded"""
+    end = time.perf_counter()
+    if send_end is None:
+      metrics.record(end - begin, None, None, sent, received, error)
+    elif wait_end:
+      metrics.record(send_end - begin, wait_end - send_end, end - wait_end, sent, received, error)
+    elif error:
+      # failed or timed out waiting for the response
+      metrics.record(send_end - begin, end - send_end, None, sent, received, error)
+    else:
+      metrics.record(send_end - begin, None, end - send_end, sent, received, error)
+
+  def log_request(self, method_id, args, hint):
+    """the name|id the response is logged under, None when calls are not logged"""
+    if self.client.quiet or not call_logger.isEnabledFor(logging.DEBUG):
+      return None
+    method_id_name = self.name + "|" + str(method_id)
+    if hint:
+      call_logger.debug('request method: %s %s %s', method_id_name, args, hint)
+    else:
+      call_logger.debug('request method: %s %s', method_id_name, args)
+    return method_id_name
+
+  def handle_response(self, result, data, method_id_name, cost):
+    client = self.client
+    parser = self.parser
+    if client.binary_payload:
+      parser = binary_return_parsers.get(parser, parser)
     if parser == void:
-      if not quiet:
-        print("response %s[%.2f]:" % (method_id_name, (end - start)), 'no return', rpc_name)
-      return
-    if idx != method_id:
-      desc = f'rpc {rpc_name} {method_name} response wrong idx except {method_id},got {idx} in {threading.current_thread().name}'
-      print(desc)
+      if method_id_name:
+        call_logger.debug('response %s[%.2f]: no return %s', method_id_name, cost, client.name)
+      return None
     if result < 0:
       err_fmt = err_desc.get(result)
       if err_fmt:
-        err_fmt = err_fmt.format(method_name)
+        err_fmt = err_fmt.format(self.name)
         if data:
           # err_detail, _ = read_string(data, 0)
-          err_detail = data.decode()
+          err_detail = str(data, 'utf-8')
           if err_detail:
             err_fmt += ",detail:" + err_detail
         raise RpcCallException(err_fmt)
@@ -362,10 +588,8 @@ class AlbRpcMethod(object):
       data = parser(data, result)
     elif data is None:
       data = result >= 0
-    if not quiet:
-      print("response %s[%.2f]:" % (method_id_name, (end - start)), str(data)[:128], rpc_name)
-    if timeout:
-      sock.settimeout(client.default_timeout)
+    if method_id_name:
+      call_logger.debug('response %s[%.2f]: %s %s', method_id_name, cost, str(data)[:128], client.name)
     return data
 
 
@@ -379,35 +603,139 @@ def broadcast_api(fn):
   return fn
 
 
-def create_call_function(arg_list, default_args):
-  def __wrapper(client, *args):
-    bs = []
+string_len_struct = struct.Struct('<H')
+bytes_len_struct = struct.Struct('<i')
+
+
+def string_pieces(s: str):
+  if s:
+    bs = s.encode()
+    return string_len_struct.pack(len(bs)), bs, b'\0'
+  return b'\0\0',
+
+
+def bytes_pieces(b: bytes):
+  if b:
+    return bytes_len_struct.pack(len(b)), b
+  return b'\0\0\0\0',
+
+
+arg_struct_formats = {int: 'i', bool: '?', float: 'f', double: 'd', byte: 'B', short: 'h', long: 'q'}
+
+arg_pieces_tables = {str: string_pieces, bytes: bytes_pieces}
+
+
+def create_call_function(arg_types, default_args):
+  """
+  Build the encoder of one rpc method from its argument types. Every run of
+  fixed-width arguments is packed by one precompiled struct.Struct and strings
+  and bytes are appended as pieces, so the whole request is joined only once.
+  """
+  num_args = len(arg_types)
+  num_defaults = len(default_args) if default_args else 0
+  segments = []
+  fmt = ''
+  run_start = 0
+  for i, arg_type in enumerate(arg_types):
+    code = arg_struct_formats.get(arg_type)
+    if code:
+      if not fmt:
+        run_start = i
+      fmt += code
+      continue
+    if fmt:
+      segments.append((run_start, i, struct.Struct('<' + fmt).pack))
+      fmt = ''
+    segments.append((i, 0, arg_pieces_tables[arg_type]))
+  if fmt:
+    segments.append((run_start, num_args, struct.Struct('<' + fmt).pack))
+
+  def fill_args(args):
     len_args = len(args)
-    if len_args != len(arg_list):
-      if len_args > len(arg_list):
+    if len_args > num_args:
+      raise RuntimeError('too many arguments')
+    if num_defaults + len_args < num_args:
+      raise RuntimeError('too few arguments')
+    return args + default_args[(len_args - num_args):]
+
+  if not segments:
+    def __wrapper(client, *args):
+      if args:
         raise RuntimeError('too many arguments')
-      if not default_args or len(default_args) + len_args < len(arg_list):
-        raise RuntimeError('too few arguments')
-      new_args = []
-      new_args.extend(args)
-      new_args.extend(default_args[(len_args - len(arg_list)):])
-      args = new_args
-
-    for i, arg in enumerate(args):
-      bs.append(arg_list[i](arg))
-    return b''.join(bs)
+      return b''
+  elif len(segments) == 1 and segments[0][1]:
+    pack = segments[0][2]
+
+    def __wrapper(client, *args):
+      if len(args) != num_args:
+        args = fill_args(args)
+      return pack(*args)
+  else:
+    def __wrapper(client, *args):
+      if len(args) != num_args:
+        args = fill_args(args)
+      bs = []
+      for start, end, encoder in segments:
+        if end:
+          bs.append(encoder(*args[start:end]))
+        else:
+          bs.extend(encoder(args[start]))
+      return b''.join(bs)
 
   return __wrapper
 
 
-def create_receive_function(arg_list):
-  def __wrapper(client, sock_data: bytes):
-    args = []
-    idx = 0
-    for parser in arg_list:
-      arg, idx = parser(sock_data, idx)
-      args.append(arg)
-    return args
+def create_receive_function(arg_types):
+  """
+  Build the decoder of one broadcast from its argument types. Runs of fixed-width
+  arguments are read by one precompiled struct.Struct.unpack_from straight from the
+  receive buffer, strings and json are read by the arg_read_tables readers.
+  arg_types items are either a type or an (enum_type, real_type) pair.
+  """
+  segments = []
+  enum_positions = []
+  fmt = ''
+  for i, arg_type in enumerate(arg_types):
+    if isinstance(arg_type, tuple):
+      enum_type, arg_type = arg_type
+      enum_positions.append((i, enum_type))
+    code = arg_struct_formats.get(arg_type)
+    if code:
+      fmt += code
+      continue
+    if fmt:
+      unpacker = struct.Struct('<' + fmt)
+      segments.append((unpacker.unpack_from, unpacker.size, None, None))
+      fmt = ''
+    reader = arg_read_tables[arg_type]
+    segments.append((None, 0, reader, read_binary if reader is read_json else reader))
+  if fmt:
+    unpacker = struct.Struct('<' + fmt)
+    segments.append((unpacker.unpack_from, unpacker.size, None, None))
+
+  if not segments:
+    def __wrapper(client, sock_data):
+      return ()
+  elif len(segments) == 1 and segments[0][0] and not enum_positions:
+    unpack_from = segments[0][0]
+
+    def __wrapper(client, sock_data):
+      return unpack_from(sock_data, 0)
+  else:
+    def __wrapper(client, sock_data):
+      args = []
+      idx = 0
+      binary = client is not None and client.binary_payload
+      for unpack_from, size, reader, binary_reader in segments:
+        if unpack_from:
+          args.extend(unpack_from(sock_data, idx))
+          idx += size
+        else:
+          arg, idx = (binary_reader if binary else reader)(sock_data, idx)
+          args.append(arg)
+      for i, enum_type in enum_positions:
+        args[i] = enum_type(args[i])
+      return args
 
   return __wrapper
 
@@ -437,7 +765,9 @@ def parse_str(data, result):
 
 
 def parse_bytes(data, result):
-  return data
+  if data is None:
+    return None
+  return bytes(data)
 
 
 def parse_dict(data, result):
@@ -456,6 +786,28 @@ def parse_list(data, result):
   return d
 
 
+def parse_binary_dict(data, result):
+  if not data:
+    return {}
+  d, _ = read_binary(data, 0)
+  assert isinstance(d, dict)
+  return d
+
+
+def parse_binary_list(data, result):
+  if not data:
+    return []
+  d, _ = read_binary(data, 0)
+  assert isinstance(d, list)
+  return d
+
+
+# replacements used once the server agreed to CAP_BINARY_PAYLOAD
+binary_return_parsers = {parse_dict: parse_binary_dict, parse_list: parse_binary_list}
+
+binary_return_convertors = {convert_json: convert_binary}
+
+
 class EnumResultParser(object):
   def __init__(self, enum_type, parser):
     self.enum_type = enum_type
@@ -534,7 +886,9 @@ class RpcMeta(type):
               break
             if issubclass(arg_type, Enum):
               arg_type = get_enum_real_type(arg_type)
-            args.append(arg_convert_tables[arg_type])
+            if arg_type not in arg_struct_formats and arg_type not in arg_pieces_tables:
+              raise WrongAnnotation(f'function {key} argument {name} type {arg_type} is not supported')
+            args.append(arg_type)
           f = create_call_function(args, default_args)
           f.__name__ = attr_value.__name__
           call_tables[key] = (f, ret_f)
@@ -564,11 +918,11 @@ class RpcMeta(type):
                   ret_f = staticmethod(ret_f)
               break
             if issubclass(arg_type, Enum):
-              real_type = get_enum_real_type(arg_type)
-              reader = EnumResultReader(arg_type, arg_read_tables[real_type])
-              args.append(reader)
+              args.append((arg_type, get_enum_real_type(arg_type)))
+            elif arg_type in arg_read_tables:
+              args.append(arg_type)
             else:
-              args.append(arg_read_tables[arg_type])
+              raise WrongAnnotation(f'function {key} argument {name} type {arg_type} is not supported')
           f = create_receive_function(args)
           f.__name__ = attr_value.__name__
           broadcast_tables[key] = (f, ret_f)
@@ -597,126 +951,243 @@ use_polling = not use_epoll and not use_kqueue
 
 
 class SocketMonitor(threading.Thread):
+  """
+  One reactor thread for the sockets of all clients. A socket registered with
+  register_socket only reports its close, callback(True, sock). A socket registered
+  with register_reader is read here: on_readable(sock) is called whenever data
+  arrives and has to read until BlockingIOError, it returns False once the
+  connection is finished and the close callback follows. Close callbacks run on a
+  small pool of close_workers threads, so one which reconnects does not hold up the
+  other sockets and a burst of closes does not start a thread each.
+  epoll is edge triggered, so a reader which stops early resumes itself through
+  call_soon.
+  """
+
+  close_workers = 4
 
   def __init__(self):
-    super().__init__()
+    super().__init__(daemon=True)
     self.name = 'socket monitor'
+    self.close_executor = ThreadPoolExecutor(self.close_workers, 'socket close')
+    # registration changes and call_soon write a byte here to wake up the poll
+    self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+    self.wakeup_reader.setblocking(False)
+    self.wakeup_writer.setblocking(False)
+    wakeup_fd = self.wakeup_reader.fileno()
     if use_epoll:
       self.poll = select.epoll()
+      self.poll.register(wakeup_fd, select.EPOLLIN | select.EPOLLET)
     elif use_kqueue:
       self.poll = select.kqueue()
+      self.poll.control([select.kevent(wakeup_fd, filter=select.KQ_FILTER_READ, flags=select.KQ_EV_ADD)], 0)
     else:
       self.poll = None
       self._poll_lock = threading.Lock()
       self._sockets_to_poll = []
-
     self.callbacks = {}
+    self.soon_calls = deque()
     self.running = True
 
+  def wakeup(self):
+    try:
+      self.wakeup_writer.send(b'\0')
+    except (BlockingIOError, OSError):
+      # a full pipe wakes the poll as well
+      pass
+
+  def call_soon(self, fn):
+    """run fn on the monitor thread"""
+    self.soon_calls.append(fn)
+    self.wakeup()
+
   def register_socket(self, sock, callback, extra_flag=None):
     fileno = sock.fileno()
     if use_epoll:
       if extra_flag is None:
         extra_flag = select.EPOLLET
       flags = select.EPOLLERR | select.EPOLLRDHUP | extra_flag
+      self.callbacks[fileno] = (sock, callback, extra_flag, None)
       self.poll.register(fileno, flags)
     elif use_kqueue:
       if extra_flag is None:
         extra_flag = select.KQ_EV_EOF
+      self.callbacks[fileno] = (sock, callback, extra_flag, None)
       kevent = select.kevent(fileno, filter=select.KQ_FILTER_READ, flags=select.KQ_EV_ADD)
       self.poll.control([kevent], 0)
     else:
+      self.callbacks[fileno] = (sock, callback, extra_flag, None)
       with self._poll_lock:
         self._sockets_to_poll.append(sock)
-    self.callbacks[fileno] = (sock, callback, extra_flag)
+      self.wakeup()
 
-  def unregister_socket(self, fileno):
-    v = self.callbacks.pop(fileno, None)
-    if not v:
-      return False
+  def register_reader(self, sock, on_readable, callback):
+    """sock has to be non-blocking"""
+    fileno = sock.fileno()
+    self.callbacks[fileno] = (sock, callback, None, on_readable)
     if use_epoll:
-      self.poll.unregister(fileno)
+      self.poll.register(fileno, select.EPOLLIN | select.EPOLLERR | select.EPOLLRDHUP | select.EPOLLET)
     elif use_kqueue:
-      kevent = select.kevent(fileno, filter=select.KQ_FILTER_READ, flags=select.KQ_EV_DELETE)
+      kevent = select.kevent(fileno, filter=select.KQ_FILTER_READ, flags=select.KQ_EV_ADD)
       self.poll.control([kevent], 0)
     else:
-      sock, _, _ = v
       with self._poll_lock:
-        if sock in self._sockets_to_poll:
-          self._sockets_to_poll.remove(sock)
+        self._sockets_to_poll.append(sock)
+      self.wakeup()
+
+  def unregister_socket(self, fileno):
+    v = self.callbacks.pop(fileno, None)
+    if not v:
+      return False
+    try:
+      if use_epoll:
+        self.poll.unregister(fileno)
+      elif use_kqueue:
+        kevent = select.kevent(fileno, filter=select.KQ_FILTER_READ, flags=select.KQ_EV_DELETE)
+        self.poll.control([kevent], 0)
+      else:
+        sock = v[0]
+        with self._poll_lock:
+          if sock in self._sockets_to_poll:
+            self._sockets_to_poll.remove(sock)
+        self.wakeup()
+    except (OSError, ValueError):
+      # the socket was closed first, the kernel dropped it already
+      pass
     return v[1]
 
+  def run_reader(self, fileno):
+    entry = self.callbacks.get(fileno)
+    if entry is None:
+      return
+    sock, callback, _, on_readable = entry
+    try:
+      alive = on_readable(sock)
+    except Exception:
+      traceback.print_exc()
+      alive = False
+    if not alive and self.callbacks.get(fileno) is entry:
+      self.unregister_socket(fileno)
+      if callback is not None:
+        self.report_close(callback, sock)
+
+  def on_event(self, fileno, is_close):
+    entry = self.callbacks.get(fileno)
+    if entry is None:
+      return
+    sock, callback, flags, on_readable = entry
+    if on_readable is not None:
+      # the reader gets the data sent before a close and reports the close itself
+      self.run_reader(fileno)
+    elif is_close:
+      self.unregister_socket(fileno)
+      if callback is not None:
+        self.report_close(callback, sock)
+    elif use_kqueue and flags == select.KQ_EV_EOF:
+      # only the close was asked for
+      return
+    elif callback is not None:
+      callback(False, sock)
+
+  def report_close(self, callback, sock):
+    """
+    Close callbacks may reconnect and subscribe again, blocking calls which must not
+    stall the reads of every other client, so they run on the close workers.
+    """
+    self.close_executor.submit(self.run_close_callback, callback, sock)
+
+  @staticmethod
+  def run_close_callback(callback, sock):
+    try:
+      callback(True, sock)
+    except Exception:
+      traceback.print_exc()
+
+  def drain_wakeup(self):
+    try:
+      while self.wakeup_reader.recv(4096):
+        pass
+    except (BlockingIOError, OSError):
+      pass
+    soon_calls = self.soon_calls
+    while soon_calls:
+      fn = soon_calls.popleft()
+      try:
+        fn()
+      except Exception:
+        traceback.print_exc()
+
+  def stop(self):
+    self.running = False
+    self.wakeup()
+
   def run(self):
+    wakeup_fd = self.wakeup_reader.fileno()
     while self.running:
-      none_value = (None, None, None)
       if use_epoll:
-        events = self.poll.poll()
-        for file_no, event in events:
-          if event & (select.EPOLLERR | select.EPOLLRDHUP):
-            sock, callback, flags = self.callbacks.get(file_no, none_value)
-            if callback is not None:
-              callback(True, sock)
-            self.unregister_socket(file_no)
+        close_mask = select.EPOLLERR | select.EPOLLRDHUP | select.EPOLLHUP
+        for fileno, event in self.poll.poll():
+          if fileno == wakeup_fd:
+            self.drain_wakeup()
           else:
-            print('unsupported event', hex(event))
+            self.on_event(fileno, event & close_mask)
       elif use_kqueue:
-        events = self.poll.control(None, 1)  # 等待至少1个事件
-        for kev in events:
-          ident = kev.ident
-          sock, callback, flags = self.callbacks.get(ident, none_value)
-          if callback is None:
-            self.unregister_socket(ident)
-            continue
-          if kev.flags & (select.KQ_EV_EOF | select.KQ_EV_ERROR):
-            # 处理错误事件
-            callback(True, sock)
-            self.unregister_socket(ident)
-          elif kev.filter == select.KQ_FILTER_READ:
-            if flags == select.KQ_EV_EOF:
-              continue
-            callback(False, sock)
+        for kev in self.poll.control(None, 16):
+          if kev.ident == wakeup_fd:
+            self.drain_wakeup()
+          else:
+            self.on_event(kev.ident, kev.flags & (select.KQ_EV_EOF | select.KQ_EV_ERROR))
       else:
         with self._poll_lock:
-          sockets_to_check = list(self._sockets_to_poll)
-        if sockets_to_check:
-          # 使用 select.select 检查可读或异常
-          try:
-            ready_to_read, _, exceptional = select.select(sockets_to_check, [], sockets_to_check, None)  # 非阻塞
-          except ValueError:
-            # 如果 sockets_to_check 中有已关闭的socket，select可能会抛出ValueError
-            time.sleep(0.2)  # 短暂休眠避免忙等
-            continue
-          if not ready_to_read and not exceptional:
-            time.sleep(1)
-            continue
-          for sock in ready_to_read:
-            fileno = sock.fileno()
-            sock_obj, callback, flags = self.callbacks.get(fileno, none_value)
-            if sock_obj is None: continue
-            if callback is not None:
-              callback(False, sock)
-          for sock in exceptional:
-            fileno = sock.fileno()
-            sock_obj, callback, flags = self.callbacks.get(fileno, none_value)
-            if sock_obj is None: continue
-            if callback is not None:
-              callback(True, sock)
-            self.unregister_socket(fileno)
-        else:
-          time.sleep(2)  # 10ms
+          sockets_to_check = [sock for sock in self._sockets_to_poll if sock.fileno() >= 0]
+          self._sockets_to_poll = list(sockets_to_check)
+        sockets_to_check.append(self.wakeup_reader)
+        try:
+          ready_to_read, _, exceptional = select.select(sockets_to_check, [], sockets_to_check)
+        except (ValueError, OSError):
+          # a socket got closed meanwhile, it is dropped on the next round
+          continue
+        for sock in exceptional:
+          if sock is not self.wakeup_reader:
+            self.on_event(sock.fileno(), True)
+        for sock in ready_to_read:
+          if sock is self.wakeup_reader:
+            self.drain_wakeup()
+          elif sock.fileno() >= 0:
+            self.on_event(sock.fileno(), False)
 
 
 global_socket_monitor = None
+global_socket_monitor_lock = threading.Lock()
 
 
 def get_monitor() -> SocketMonitor:
   global global_socket_monitor
   if global_socket_monitor is None:
-    global_socket_monitor = SocketMonitor()
-    global_socket_monitor.start()
+    with global_socket_monitor_lock:
+      if global_socket_monitor is None:
+        monitor = SocketMonitor()
+        monitor.start()
+        global_socket_monitor = monitor
   return global_socket_monitor
 
 
+class BroadcastReply(object):
+  """
+  Reply state of one received broadcast. A broadcast the server waits on is answered
+  once, by the handler itself or by its return value, timer reports it when that takes
+  too long.
+  """
+
+  def __init__(self, cmd, idx):
+    self.cmd = cmd
+    self.idx = idx
+    self.lock = threading.Lock()
+    self.send_count = 0
+    # the lowest bit of idx tells the server waits for a reply
+    self.closed = not idx & 1
+    self.timer = None
+
+
 class RpcClient(metaclass=RpcMeta):
   sock: socket.socket | None = None
   allow_apis = None
@@ -727,22 +1198,64 @@ class RpcClient(metaclass=RpcMeta):
   call_counter = 0
   request_lock_wait_time = 100
   prohibit_request = False
-  can_send = True
-  send_count = 0
   on_close_callback = None
+  # a quiet client never logs its calls, others log them to call_logger at debug level
   quiet = False
-
-  def __init__(self, host, port, name=None, timeout=None):
+  # when enabled, requests from many threads share the socket and a reader thread
+  # dispatches every response to its caller by call id instead of holding request_lock
+  multiplex = False
+  # non-blocking duplicate of sock which the socket monitor reads
+  reader_sock: socket.socket | None = None
+  rpc_method_class = AlbRpcMethod
+  # capabilities this client asks for in the MSG_APIS handshake, none by default so
+  # servers which do not expect a request payload see the plain handshake. Set e.g.
+  # CAP_BINARY_PAYLOAD | CAP_COMPRESS on a subclass to ask for them
+  capabilities = 0
+  server_capabilities = 0
+  binary_payload = False
+  compress = False
+  # broadcasts are read by the socket monitor and handled by a pool of this many worker
+  # threads owned by the subscriber, broadcasts with the same broadcast_key keep their
+  # order. 0 gives the subscriber a thread which reads and handles its broadcasts one by one
+  broadcast_workers = 4
+  broadcast_queue_size = 256
+  # seconds after which a broadcast the server waits on is reported as slow. The server
+  # keeps waiting for the handler, e.g. launch_process holds the app until the attach is
+  # done, so a queued or running handler never gets a default reply. 0 reports nothing
+  broadcast_slow_timeout = 60
+  broadcast_dispatcher: OrderedDispatcher | None = None
+  broadcast_reader: FrameReader | None = None
+  # a decoded broadcast waiting for room in the full worker pool
+  parked_broadcast: tuple | None = None
+  subscribe_done: threading.Event | None = None
+  compress_threshold = 1024
+  compress_level = 1
+  # count calls, errors, bytes and send/wait/parse latencies of every rpc method in metrics
+  collect_metrics = True
+  # time of the last successful connect and how many connects this client made
+  connect_time = 0
+  connect_count = 0
+
+  def __init__(self, host, port, name=None, timeout=None, multiplex=None, server_key=None):
     super().__init__()
     self.host = host
     self.port = port
+    # identifies the server build, e.g. md5 of the server binary, so a new build behind
+    # the same port does not get the api table digest of the old one
+    self.server_key = server_key
     if timeout:
       self.default_timeout = timeout
-    self.connect()
+    if multiplex is not None:
+      self.multiplex = multiplex
     if name is None:
       name = self.__class__.__name__.lower() + '-{}'.format(port)
     self.name = name
     self.request_lock = threading.Lock()
+    self.send_lock = threading.Lock()
+    self.call_id_lock = threading.Lock()
+    self.send_queue = deque()
+    self.pending_calls = {}
+    self.connect()
 
   def forbid_call(self):
     self.allow_apis = {}
@@ -776,7 +1289,7 @@ class RpcClient(metaclass=RpcMeta):
     if method in allow_apis:
       handle_method = getattr(self, 'call_' + method)
       parse_method = getattr(self, 'parse_' + method, None)
-      rpc_method = AlbRpcMethod(self, method, self.allow_apis[method], handle_method, parse_method)
+      rpc_method = self.rpc_method_class(self, method, self.allow_apis[method], handle_method, parse_method)
       setattr(self, method, rpc_method)
       return rpc_method
     if method in self.broadcast_tables:
@@ -790,15 +1303,131 @@ class RpcClient(metaclass=RpcMeta):
   def connect(self):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.settimeout(20)
-    sock.connect((self.host, self.port))
-    self.get_apis(sock)
+    try:
+      sock.connect((self.host, self.port))
+      # an adb forward accepts whether or not the server listens, only the answer to
+      # MSG_APIS shows that it does
+      self.get_apis(sock)
+    except BaseException:
+      sock.close()
+      raise
     sock.settimeout(self.default_timeout)
+    # responses of a multiplexed connection are parsed by other threads, so each frame gets its own buffer
+    self.frame_reader = FrameReader(reuse_buffer=not self.multiplex)
+    self.frame_reader.compressed = self.compress
     self.sock = sock
-    if use_polling:
+    self.connect_time = time.time()
+    self.connect_count += 1
+    if self.multiplex:
+      # the monitor thread reads the responses and hands them to the waiting callers
+      self.start_reader(sock, self.read_responses, self.on_reader_close)
+    elif use_polling:
       get_monitor().register_socket(sock, self.on_read_win)
     else:
       get_monitor().register_socket(sock, self.on_close)
 
+  def next_call_id(self):
+    with self.call_id_lock:
+      call_counter = self.call_counter
+      self.call_counter = call_counter + 1
+    return call_counter & CALL_ID_MASK
+
+  def flush_send_queue(self, sock):
+    """
+    Send every queued frame in one sendmsg. Whoever holds send_lock also sends the
+    frames other threads queued meanwhile, so a burst of calls costs few syscalls.
+    """
+    with self.send_lock:
+      send_queue = self.send_queue
+      frames = []
+      while send_queue:
+        frames.append(send_queue.popleft())
+      if not frames:
+        return
+      try:
+        rpc_send_frames(sock, frames)
+      except BaseException as e:
+        pending_calls = self.pending_calls
+        for _, call_id, _, _ in frames:
+          future = pending_calls.pop(call_id, None)
+          if future is not None and not future.done():
+            future.set_exception(e)
+        raise
+
+  def multiplex_request(self, content, call_id, cmd, wait_response=True, timeout=None):
+    future, _ = self.multiplex_send(content, call_id, cmd, wait_response)
+    return self.multiplex_wait(future, call_id, timeout)
+
+  def multiplex_send(self, content, call_id, cmd, wait_response=True):
+    """queue and flush one request frame, returns its future (None without response) and payload size"""
+    sock = self.sock
+    if not sock:
+      raise RpcCloseException("connection is closed")
+    pending_calls = self.pending_calls
+    future = Future()
+    pending_calls[call_id] = future
+    content, flags = self.compress_payload(content)
+    self.send_queue.append((content, call_id, cmd, flags))
+    try:
+      self.flush_send_queue(sock)
+    except BaseException:
+      pending_calls.pop(call_id, None)
+      raise
+    if not wait_response:
+      if future.done():
+        # only set when sending our frame failed in another thread
+        future.result()
+      pending_calls.pop(call_id, None)
+      future = None
+    return future, FRAME_HEAD_LEN + len(content) if content else FRAME_HEAD_LEN
+
+  def multiplex_wait(self, future: Future | None, call_id, timeout=None):
+    if future is None:
+      return None, None
+    pending_calls = self.pending_calls
+    try:
+      return future.result(timeout or self.default_timeout)
+    except FutureTimeoutError:
+      pending_calls.pop(call_id, None)
+      raise TimeoutError(f'{self.name} wait response {call_id} timeout')
+
+  def start_reader(self, sock, on_readable, on_close):
+    # reads go through a non-blocking duplicate, sock keeps its timeout for the senders
+    reader_sock = sock.dup()
+    reader_sock.setblocking(False)
+    self.reader_sock = reader_sock
+    get_monitor().register_reader(reader_sock, on_readable, lambda is_close, _: on_close(sock))
+
+  def read_responses(self, reader_sock):
+    pending_calls = self.pending_calls
+    frame_reader = self.frame_reader
+    while True:
+      try:
+        idx, result, data = frame_reader.receive(reader_sock)
+      except BlockingIOError:
+        return True
+      except Exception as e:
+        if self.sock is not None and self.continuous:
+          print(f'{self.name} response reader close:', e)
+        return False
+      future = pending_calls.pop(idx, None)
+      if future is None:
+        print(f'{self.name} drop response {idx} which has no caller')
+        continue
+      future.set_result((result, data))
+
+  def fail_pending_calls(self):
+    pending_calls = self.pending_calls
+    for call_id in list(pending_calls):
+      future = pending_calls.pop(call_id, None)
+      if future is not None:
+        future.set_exception(RpcCloseException(f'{self.name} closed before response {call_id}'))
+
+  def on_reader_close(self, sock):
+    self.fail_pending_calls()
+    if self.sock is sock:
+      self.on_close(True, sock)
+
   def reconnect(self):
     try:
       if not self.sock:
@@ -809,14 +1438,32 @@ class RpcClient(metaclass=RpcMeta):
     return False
 
   def close(self):
+    dispatcher = self.broadcast_dispatcher
+    if dispatcher is not None:
+      self.broadcast_dispatcher = None
+      # the running handlers finish, the queued ones are dropped with the connection
+      dispatcher.close()
     sock = self.sock
     if sock:
+      self.sock = None
       try:
-        get_monitor().unregister_socket(sock.fileno())
+        monitor = get_monitor()
+        monitor.unregister_socket(sock.fileno())
+        reader_sock = self.reader_sock
+        if reader_sock is not None:
+          self.reader_sock = None
+          monitor.unregister_socket(reader_sock.fileno())
+          reader_sock.close()
+          # the duplicate kept the connection open, let the server see the close now
+          sock.shutdown(socket.SHUT_RDWR)
         sock.close()
       except:
         pass
-      self.sock = None
+      # nobody reads the responses anymore, callers must not wait out their timeout
+      self.fail_pending_calls()
+      subscribe_done = self.subscribe_done
+      if subscribe_done is not None:
+        subscribe_done.set()
       if self.on_close_callback:
         try:
           self.on_close_callback(self)
@@ -825,12 +1472,54 @@ class RpcClient(metaclass=RpcMeta):
       return True
     return False
 
+  def compress_payload(self, data):
+    if self.compress and data:
+      if len(data) >= self.compress_threshold:
+        packed = zlib.compress(data, self.compress_level)
+        if len(packed) < len(data):
+          return packed, FLAG_COMPRESSED
+      if len(data) > COMPRESSED_LEN_MASK:
+        raise RpcSendException('frame data too large: {}'.format(len(data)))
+    return data, 0
+
+  def cached_api_table(self) -> ApiTable | None:
+    return api_table_cache.get((self.server_key, self.host, self.port))
+
+  def handshake_payload(self, api_table: ApiTable | None = None):
+    """empty unless the client asks for capabilities or the server advertised CAP_API_DIGEST"""
+    if api_table is not None and api_table.server_capabilities & CAP_API_DIGEST:
+      return struct.pack('<I', self.capabilities) + api_table.digest
+    if self.capabilities:
+      return struct.pack('<I', self.capabilities)
+    return None
+
+  @staticmethod
+  def parse_capabilities(data, idx):
+    """the capability bits following CAPABILITY_MARKER at idx, 0 without the marker"""
+    if not data or len(data) < idx + 8 or bytes(data[idx:idx + 4]) != CAPABILITY_MARKER:
+      return 0
+    return struct.unpack_from('<I', data, idx + 4)[0]
+
+  def handle_handshake(self, result, data, api_table: ApiTable | None = None):
+    if result == API_TABLE_UNCHANGED and (not data or len(data) <= 8):
+      if api_table is None:
+        raise RpcCloseException(f'{self.name} handshake: api tables unchanged but none were sent')
+      self.use_api_table(api_table, self.parse_capabilities(data, 0) & self.capabilities)
+      return api_table.rpc_tables
+    if result < 0 or not data or len(data) < 8:
+      raise RpcCloseException(f'{self.name} handshake: no api tables in the MSG_APIS response')
+    return self.load_apis(data)
+
   def get_apis(self, sock=None):
     if not sock:
       sock = self.sock
-    rpc_send_data(sock, None, self.call_counter, MSG_APIS)
+    api_table = self.cached_api_table()
+    rpc_send_data(sock, self.handshake_payload(api_table), self.call_counter, MSG_APIS)
     self.call_counter += 1
     idx, result, data = rpc_receive_data(sock)
+    return self.handle_handshake(result, data, api_table)
+
+  def load_apis(self, data):
     num_api = struct.unpack('<i', data[:4])[0]
     if not old_version:
       num_broadcast = struct.unpack('<i', data[4:8])[0]
@@ -851,34 +1540,114 @@ class RpcClient(metaclass=RpcMeta):
       rpc_name, idx = read_string(data, idx + 1)
       broadcast_tables[rpc_name] = cmd
       broadcast_id_maps[cmd] = rpc_name
-    self.allow_apis = rpc_tables
-    self.broadcast_tables = broadcast_tables
-    self.broadcast_id_maps = broadcast_id_maps
+    # older servers ignore the request payload and send nothing marked after the tables
+    server_capabilities = self.parse_capabilities(data, idx)
+    api_table = ApiTable(hashlib.md5(data[:idx]).digest(), rpc_tables, broadcast_tables, broadcast_id_maps,
+      server_capabilities)
+    api_table_cache[(self.server_key, self.host, self.port)] = api_table
+    self.use_api_table(api_table, server_capabilities & self.capabilities)
     return rpc_tables
 
+  def use_api_table(self, api_table: ApiTable, server_capabilities):
+    self.server_capabilities = server_capabilities
+    self.binary_payload = bool(server_capabilities & CAP_BINARY_PAYLOAD)
+    self.compress = bool(server_capabilities & CAP_COMPRESS)
+    self.allow_apis = api_table.rpc_tables
+    self.broadcast_tables = api_table.broadcast_tables
+    self.broadcast_id_maps = api_table.broadcast_id_maps
+
   @rpc_api
   def subscribe(self):
     pass
 
   def register_broadcast_handler(self, broadcast_name, handler):
+    """the one handler whose result is the reply of the broadcast, replaces the previous handler"""
     setattr(self, 'handle_' + broadcast_name, handler)
 
-  def register_broadcast_listener(self, msg_id, listener):
-    raise NotImplementedError
-
-  @cached_subclass_property
-  def broadcast_listeners(self) -> dict:
-    return defaultdict(list)
+  def register_broadcast_listener(self, broadcast_name, listener, uid=None, package=None,
+                                  pid=None) -> BroadcastListener:
+    """
+    Call listener(*args) after each broadcast_name broadcast matching all given filters,
+    once its reply is sent. Any number of listeners may be registered, pass the returned
+    value to unregister_broadcast_listener to remove one.
+    """
+    if not hasattr(self, 'receive_' + broadcast_name):
+      raise ValueError(f'{self.__class__.__name__} has no broadcast {broadcast_name}')
+    return self.broadcast_listeners.add(broadcast_name, listener, uid=uid, package=package, pid=pid)
+
+  def unregister_broadcast_listener(self, listener: BroadcastListener) -> bool:
+    return self.broadcast_listeners.remove(listener)
+
+  @cached_property
+  def metrics(self) -> ClientMetrics:
+    return ClientMetrics(self.name)
+
+  @cached_property
+  def broadcast_listeners(self) -> ListenerRegistry:
+    return ListenerRegistry()
+
+  def notify_broadcast_listeners(self, broadcast_name, args):
+    listeners = self.__dict__.get('broadcast_listeners')
+    if listeners:
+      listeners.notify(broadcast_name, self.broadcast_attrs(broadcast_name, args), args)
+
+  @cached_property
+  def broadcast_state(self):
+    return threading.local()
+
+  @property
+  def broadcast_reply(self) -> BroadcastReply | None:
+    """the broadcast the current thread is handling"""
+    return getattr(self.broadcast_state, 'reply', None)
+
+  @property
+  def can_send(self):
+    reply = self.broadcast_reply
+    return reply is None or not reply.closed
+
+  @property
+  def send_count(self):
+    reply = self.broadcast_reply
+    return reply.send_count if reply else 0
+
+  @property
+  def idx(self):
+    reply = self.broadcast_reply
+    return reply.idx if reply else None
 
   def send(self, cmd, data, idx):
-    if self.can_send:
-      rpc_send_data(self.sock, data, idx, cmd)
-    else:
-      raise RpcSendException('can not send data {}'.format(data))
-    self.send_count += 1
+    reply = self.broadcast_reply
+    if reply is None:
+      self.send_frame(cmd, data, idx)
+      return
+    with reply.lock:
+      if reply.closed:
+        raise RpcSendException('can not send data {}'.format(data))
+      self.send_frame(cmd, data, idx)
+      reply.send_count += 1
+
+  def send_frame(self, cmd, data, idx):
+    data, flags = self.compress_payload(data)
+    # replies of several broadcast workers share the socket
+    with self.send_lock:
+      rpc_send_data(self.sock, data, idx, cmd, flags)
+
+  def finish_reply(self, reply: BroadcastReply, cmd, data, idx):
+    """send data unless the broadcast needs no reply or was answered already"""
+    with reply.lock:
+      if reply.timer is not None:
+        get_deadline_timer().cancel(reply.timer)
+      if not reply.closed and not reply.send_count:
+        self.send_frame(cmd, data, idx)
+      reply.closed = True
+
+  def report_slow_reply(self, reply: BroadcastReply, broadcast_name):
+    with reply.lock:
+      if reply.closed or reply.send_count or not self.sock:
+        return
+    print(f'{self.name} broadcast {broadcast_name} not handled in {self.broadcast_slow_timeout}s, server still waits')
 
   continuous = True
-  idx = None
 
   def on_read_win(self, is_close, sock):
     if is_close:
@@ -894,54 +1663,142 @@ class RpcClient(metaclass=RpcMeta):
     self.__subscribe_loop()
 
   def __subscribe_loop(self):
-    self.can_send = False
+    frame_reader = FrameReader()
+    frame_reader.compressed = self.compress
     try:
       while self.continuous:
         try:
-          idx, cmd, data = rpc_receive_data(self.sock)
+          idx, cmd, data = rpc_receive_data(self.sock, frame_reader)
         except TimeoutError as e:
           continue
-        broadcast_name = self.broadcast_id_maps.get(cmd)
-        should_send = idx & 1
-        to_send = b'send empty'
-        self.idx = idx
-        # idx = idx >> 1
-        if should_send:
-          self.can_send = True
-          self.send_count = 0
-        else:
-          self.can_send = False
-        try:
-          if broadcast_name:
-            arg_parser = getattr(self, 'receive_' + broadcast_name)
-            args = arg_parser(data)
-            handler = getattr(self, 'handle_' + broadcast_name)
-            result = handler(*args)
-            convertor = getattr(self, 'result_' + broadcast_name, None)
-            if convertor:
-              cmd, idx, to_send = convertor(cmd, idx, result)
-          else:
-            cmd = BROADCAST_RESULT_NO_HANDLER
-            print('no handler! receive', idx, cmd, data)
-        except Exception as e:
-          traceback.print_exc()
-        if should_send and not self.send_count:
-          self.send(cmd, to_send, idx)
+        self.dispatch_broadcast(idx, cmd, data)
     except Exception as e:
       if self.continuous:
         traceback.print_exc()
         print(f'{self.name} subscriber close:', e)
     self.close()
 
+  def broadcast_key(self, broadcast_name, args):
+    """broadcasts with equal keys are handled in the order they arrived, by default per uid or pid"""
+    if args:
+      arg = args[0]
+      if isinstance(arg, dict):
+        return arg.get('uid', arg.get('pid', broadcast_name))
+      if isinstance(arg, int):
+        return arg
+    return broadcast_name
+
+  def broadcast_attrs(self, broadcast_name, args) -> dict:
+    """the pid, uid and package listeners of the broadcast may filter on"""
+    if args:
+      arg = args[0]
+      if isinstance(arg, dict):
+        return {'pid': arg.get('pid'), 'uid': arg.get('uid'), 'package': arg.get('pkg', arg.get('package'))}
+      if isinstance(arg, int):
+        return {'pid': arg}
+    return {}
+
+  def read_broadcasts(self, reader_sock):
+    """monitor callback of a subscribed socket, False once the subscription ended"""
+    parked = self.parked_broadcast
+    if parked is not None:
+      if not self.queue_broadcast(*parked):
+        return True
+      self.parked_broadcast = None
+    frame_reader = self.broadcast_reader
+    while self.continuous:
+      try:
+        idx, cmd, data = frame_reader.receive(reader_sock)
+      except BlockingIOError:
+        return True
+      except Exception as e:
+        if self.continuous:
+          print(f'{self.name} subscriber close:', e)
+        return False
+      job = self.prepare_broadcast(idx, cmd, data)
+      if job is not None and not self.queue_broadcast(*job):
+        # the workers are behind, stop reading until they made room
+        self.parked_broadcast = job
+        return True
+    return False
+
+  def resume_broadcasts(self):
+    reader_sock = self.reader_sock
+    if reader_sock is not None:
+      get_monitor().run_reader(reader_sock.fileno())
+
+  def dispatch_broadcast(self, idx, cmd, data):
+    job = self.prepare_broadcast(idx, cmd, data)
+    if job is not None:
+      self.handle_broadcast(*job)
+
+  def prepare_broadcast(self, idx, cmd, data):
+    """decode a broadcast into (reply, broadcast_name, args), None when it was answered already"""
+    reply = BroadcastReply(cmd, idx)
+    broadcast_name = self.broadcast_id_maps.get(cmd)
+    if not broadcast_name:
+      print('no handler! receive', idx, cmd, data)
+      self.finish_reply(reply, BROADCAST_RESULT_NO_HANDLER, b'send empty', idx)
+      return None
+    try:
+      args = getattr(self, 'receive_' + broadcast_name)(data)
+    except Exception:
+      traceback.print_exc()
+      self.finish_reply(reply, cmd, b'send empty', idx)
+      return None
+    return reply, broadcast_name, args
+
+  def queue_broadcast(self, reply: BroadcastReply, broadcast_name, args):
+    """hand the broadcast to the worker pool, False when the pool is full"""
+    dispatcher = self.broadcast_dispatcher
+    if dispatcher is None:
+      self.finish_reply(reply, reply.cmd, b'send empty', reply.idx)
+      return True
+    if reply.timer is None and not reply.closed and self.broadcast_slow_timeout:
+      reply.timer = get_deadline_timer().schedule(self.broadcast_slow_timeout,
+        lambda: self.report_slow_reply(reply, broadcast_name))
+    monitor = get_monitor()
+    try:
+      return dispatcher.submit(self.broadcast_key(broadcast_name, args), self.handle_broadcast,
+        reply, broadcast_name, args, on_space=lambda: monitor.call_soon(self.resume_broadcasts))
+    except DispatcherClosed:
+      self.finish_reply(reply, reply.cmd, b'send empty', reply.idx)
+      return True
+
+  def handle_broadcast(self, reply: BroadcastReply, broadcast_name, args):
+    cmd = reply.cmd
+    idx = reply.idx
+    to_send = b'send empty'
+    state = self.broadcast_state
+    state.reply = reply
+    try:
+      handler = getattr(self, 'handle_' + broadcast_name)
+      result = handler(*args)
+      convertor = getattr(self, 'result_' + broadcast_name, None)
+      if convertor and self.binary_payload:
+        convertor = binary_return_convertors.get(convertor, convertor)
+      if convertor:
+        cmd, idx, to_send = convertor(cmd, idx, result)
+    except Exception as e:
+      traceback.print_exc()
+    finally:
+      state.reply = None
+    self.finish_reply(reply, cmd, to_send, idx)
+    self.notify_broadcast_listeners(broadcast_name, args)
+
   subscribe_thread: threading.Thread | None = None
 
   def join_subscribe(self):
     subscribe_thread = self.subscribe_thread
     if subscribe_thread is not None:
+      # join with a timeout so Ctrl-C is still delivered, returns as soon as the thread ends
       while subscribe_thread.is_alive():
-        time.sleep(5)
-        # subscribe_thread.join()
+        subscribe_thread.join(5)
       self.subscribe_thread = None
+    subscribe_done = self.subscribe_done
+    if subscribe_done is not None:
+      while not subscribe_done.wait(5):
+        pass
 
   subscriber = None
 
@@ -949,10 +1806,14 @@ class RpcClient(metaclass=RpcMeta):
     subscriber.close()
     self.subscriber = None
 
-  def create_subscriber(self) -> 'RpcClient':
+  def create_subscriber(self, handlers: dict | None = None) -> 'RpcClient':
+    """handlers maps broadcast names to handlers registered before the subscription starts"""
     if self.subscriber:
       return self.subscriber
-    subscriber = self.__class__(self.host, self.port, self.name + ':subscribe', self.default_timeout)
+    subscriber = self.__class__(self.host, self.port, self.name + ':subscribe', self.default_timeout, multiplex=False,
+      server_key=self.server_key)
+    for broadcast_name, handler in (handlers or {}).items():
+      subscriber.register_broadcast_handler(broadcast_name, handler)
     subscriber.subscribe()
     self.subscriber = subscriber
     subscriber.set_on_close_listener(self._subscriber_close)
@@ -960,8 +1821,21 @@ class RpcClient(metaclass=RpcMeta):
 
   def parse_subscribe(self, data, result):
     if result >= 0:
+      sock = self.sock
+      if self.broadcast_workers > 0:
+        # the monitor reads the broadcasts and notices the close, no thread of our own
+        get_monitor().unregister_socket(sock.fileno())
+        # a pool per subscriber, a device busy attaching apps does not hold up the others
+        self.broadcast_dispatcher = OrderedDispatcher('{}:broadcast'.format(self.name), self.broadcast_workers,
+          self.broadcast_queue_size)
+        frame_reader = FrameReader()
+        frame_reader.compressed = self.compress
+        self.broadcast_reader = frame_reader
+        self.subscribe_done = threading.Event()
+        self.start_reader(sock, self.read_broadcasts, lambda _: self.close())
+        return True
       if use_polling:
-        get_monitor().unregister_socket(self.sock.fileno())
+        get_monitor().unregister_socket(sock.fileno())
       subscribe_thread = threading.Thread(target=self.__subscribe_loop, name='{}:subscribe'.format(self.name))
       subscribe_thread.start()
       self.subscribe_thread = subscribe_thread
@@ -0,0 +1,168 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import queue
+import subprocess
+import threading
+import time
+import uuid
+
+from .common import OUT_TIME_CODE
+
+
+class ShellSessionClosed(Exception):
+  pass
+
+
+def wrap_command(cmd: str, marker: bytes, in_shell=False) -> bytes:
+  # stdin of the command is /dev/null so it can not eat the commands that follow. cmd
+  # runs in a subshell, so an exit in it can not skip the marker and a cd or variable
+  # does not leak into the next command. in_shell runs it in the session shell itself
+  if in_shell:
+    cmd = b'{ ' + cmd.encode() + b'\n}'
+  else:
+    cmd = b'( ' + cmd.encode() + b'\n)'
+  return cmd + b' </dev/null 2>&1; printf "\\n%s %d\\n" ' + marker + b' $?\n'
+
+
+def parse_marker(line: bytes, marker: bytes):
+  try:
+    return int(line[len(marker):])
+  except ValueError:
+    return -1
+
+
+def strip_marker_newline(data: bytes):
+  # drop the newline printed before the marker
+  if data.endswith(b'\n'):
+    return data[:-1]
+  return data
+
+
+class ShellSession(object):
+  """
+  A long lived remote shell, e.g. `adb -s serial shell sh`, which runs the commands
+  written to its stdin one after another. Every command is followed by a printf of a
+  per session marker and the exit code, so the output and return code of a command
+  are read back from the same pipe without spawning adb again.
+  """
+
+  def __init__(self, args, name=None):
+    self.args = args
+    self.name = name or ' '.join(args)
+    self.marker = ('__albatross_' + uuid.uuid4().hex + '__').encode()
+    self.lock = threading.Lock()
+    self.writer = None
+    self.closer = None
+    self.lines: queue.Queue | None = None
+    self.reader_done: threading.Event | None = None
+    self.command_count = 0
+
+  def __repr__(self):
+    return self.name
+
+  def open(self):
+    """start the remote shell, return (writer, reader, closer)"""
+    process = subprocess.Popen(self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def closer():
+      process.kill()
+      process.wait(2)
+
+    return process.stdin, process.stdout, closer
+
+  def start(self):
+    writer, reader, closer = self.open()
+    lines = queue.Queue()
+    reader_done = threading.Event()
+    reader_thread = threading.Thread(target=self.__read_loop, args=(reader, lines, reader_done),
+      name=self.name + ':reader', daemon=True)
+    reader_thread.start()
+    self.writer = writer
+    self.closer = closer
+    self.lines = lines
+    self.reader_done = reader_done
+
+  @staticmethod
+  def __read_loop(reader, lines, reader_done):
+    try:
+      for line in reader:
+        lines.put(line)
+    except Exception:
+      pass
+    reader_done.set()
+    lines.put(None)
+
+  @property
+  def alive(self):
+    reader_done = self.reader_done
+    return reader_done is not None and not reader_done.is_set()
+
+  def run(self, cmd: str, timeout=20, in_shell=False):
+    """
+    Run cmd and return (ret_code, output) like common.run_shell, stderr is merged
+    into the output. cmd runs in a subshell unless in_shell asks to change the state
+    of the session shell, e.g. cd or export for the commands that follow. A command
+    which times out kills the session, the next run starts a new one. Raise
+    ShellSessionClosed when the remote shell went away.
+    """
+    with self.lock:
+      if not self.alive:
+        self.close()
+        self.start()
+      writer = self.writer
+      lines = self.lines
+      marker = self.marker
+      try:
+        writer.write(wrap_command(cmd, marker, in_shell))
+        writer.flush()
+      except OSError as e:
+        self.close()
+        raise ShellSessionClosed('{} write fail: {}'.format(self.name, e))
+      deadline = time.time() + timeout if timeout else None
+      output = []
+      while True:
+        try:
+          if deadline is None:
+            line = lines.get()
+          else:
+            line = lines.get(timeout=max(deadline - time.time(), 0))
+        except queue.Empty:
+          self.close()
+          return OUT_TIME_CODE, b''
+        if line is None:
+          self.close()
+          raise ShellSessionClosed('{} exited'.format(self.name))
+        if line.startswith(marker):
+          self.command_count += 1
+          return parse_marker(line, marker), strip_marker_newline(b''.join(output))
+        output.append(line)
+
+  def close(self):
+    closer = self.closer
+    if closer is None:
+      return
+    writer = self.writer
+    self.writer = None
+    self.closer = None
+    self.lines = None
+    self.reader_done = None
+    try:
+      writer.close()
+    except OSError:
+      pass
+    try:
+      closer()
+    except Exception:
+      pass
@@ -14,6 +14,7 @@
 
 
 from .albatross_client import AlbatrossClient, InjectFlag
+from .async_rpc_client import AsyncRpcClient
 from .rpc_client import rpc_api, broadcast_api, byte, RpcClient
 from .wrapper import cached_class_property
 
@@ -50,7 +51,7 @@ class SystemServerClient(RpcClient):
     pass
 
   @rpc_api
-  def get_all_processes(self) -> dict:
+  def get_all_processes(self) -> list:
     pass
 
   @rpc_api
@@ -72,7 +73,23 @@ class SystemServerClient(RpcClient):
   def force_stop_app(self, pkg: str) -> bool:
     pass
 
+  @rpc_api
+  def get_packages(self, third_party: bool, include_disabled: bool) -> list:
+    pass
+
+  @rpc_api
+  def get_main_activities(self, pkg: str) -> list:
+    pass
+
+  @rpc_api
+  def is_screen_on(self) -> bool:
+    pass
+
   @broadcast_api
   def launch_process(self, process_info: dict) -> byte:
     print('launch process', process_info)
     return byte(0)
+
+
+class AsyncSystemServerClient(AsyncRpcClient, SystemServerClient):
+  pass
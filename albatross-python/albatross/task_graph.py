@@ -0,0 +1,77 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class TaskGraph(object):
+  """
+  Named steps run on a thread pool, each one as soon as the steps it depends on
+  finished. When a step raises, no further step is started and run() raises the
+  exception after the running ones are done. timings keeps the seconds spent in
+  every step plus the total.
+  """
+
+  def __init__(self, name, max_workers=4):
+    self.name = name
+    self.max_workers = max_workers
+    self.steps = {}
+    self.results = {}
+    self.timings = {}
+
+  def add(self, name, func, deps=()):
+    for dep in deps:
+      if dep not in self.steps:
+        raise ValueError('{} depends on unknown step {}'.format(name, dep))
+    self.steps[name] = (func, tuple(deps))
+    return name
+
+  def run_step(self, name, func):
+    start = time.time()
+    try:
+      return func()
+    finally:
+      self.timings[name] = time.time() - start
+
+  def run(self) -> dict:
+    start = time.time()
+    results = self.results
+    pending = dict(self.steps)
+    running = {}
+    error = None
+    with ThreadPoolExecutor(self.max_workers, self.name) as executor:
+      while pending or running:
+        if error is None:
+          for name, (func, deps) in list(pending.items()):
+            if all(dep in results for dep in deps):
+              del pending[name]
+              running[executor.submit(self.run_step, name, func)] = name
+        if not running:
+          break
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+          name = running.pop(future)
+          try:
+            results[name] = future.result()
+          except BaseException as e:
+            if error is None:
+              error = e
+    self.timings['total'] = time.time() - start
+    if error is not None:
+      raise error
+    return results
+
+  def report(self):
+    return '{}: {}'.format(self.name, ', '.join('{} {:.3f}s'.format(name, cost) for name, cost in self.timings.items()))
@@ -37,10 +37,10 @@ class cached_property(object):
       with self.lock:
         val = obj_dict.get(attr_name, nil_value)
         if val is nil_value:
-          value = func(obj)
-          if value is not nil_value:
-            obj_dict[attr_name] = value
-    return value
+          val = func(obj)
+          if val is not nil_value:
+            obj_dict[attr_name] = val
+    return val
 
   @staticmethod
   def reset(obj, attr, v):
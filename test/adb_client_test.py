@@ -0,0 +1,86 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import stat
+
+import pytest
+
+from albatross.adb_client import AdbClient, AdbError
+
+
+@pytest.fixture
+def adb(adb_server):
+  return AdbClient('127.0.0.1', adb_server.port, timeout=5)
+
+
+def test_host_requests(adb, adb_server):
+  assert adb.available()
+  assert adb.version() == 0x29
+  assert adb.devices() == [('emu-1', 'device'), ('emu-2', 'offline')]
+  assert adb.connect('10.0.0.2:5555') == 'connected to 10.0.0.2:5555'
+  assert adb_server.requests == ['host:version', 'host:version', 'host:devices', 'host:connect:10.0.0.2:5555']
+
+
+def test_unavailable():
+  adb = AdbClient('127.0.0.1', 1, timeout=1)
+  assert not adb.available()
+
+
+def test_forward(adb, adb_server):
+  adb.forward('emu-1', 'tcp:18088', 'localabstract:albatross')
+  assert adb.list_forward('emu-1') == [['emu-1', 'tcp:18088', 'localabstract:albatross']]
+  assert adb_server.requests[0] == 'host-serial:emu-1:forward:tcp:18088;localabstract:albatross'
+
+
+def test_transport_fail(adb):
+  with pytest.raises(AdbError, match='device not found'):
+    adb.transport('emu-2', 'shell:true')
+  ret_code, out = adb.shell('emu-2', 'true')
+  assert ret_code != 0 and b'device not found' in out
+
+
+def test_shell_v2_demux(adb, adb_server):
+  assert adb.shell('emu-1', 'echo out; echo err >&2; exit 3') == (3, b'out\n\nError:\nerr\n')
+  assert adb.shell('emu-1', 'printf 0123456789') == (0, b'0123456789')
+  assert adb.shell('emu-1', 'echo err >&2') == (0, b'Error:\nerr\n')
+  assert 'shell,v2,raw:printf 0123456789' in adb_server.requests
+
+
+def test_shell_v1(adb, adb_server):
+  adb_server.shell_v2 = False
+  assert adb.shell('emu-1', 'echo one; echo two; exit 5') == (5, b'one\ntwo\n')
+  assert adb.shell('emu-1', 'true') == (0, b'')
+  assert not any(request.startswith('shell,v2') for request in adb_server.requests)
+
+
+def test_sync_push_and_stat(adb, adb_server, tmp_path):
+  local = tmp_path / 'payload.bin'
+  # more than one DATA chunk
+  payload = os.urandom(150 * 1024)
+  local.write_bytes(payload)
+  adb.push('emu-1', str(local), '/data/local/tmp/', 0o644)
+  mode, data, mtime = adb_server.files['/data/local/tmp/payload.bin']
+  assert data == payload
+  assert mode == stat.S_IFREG | 0o644
+  assert mtime == int(local.stat().st_mtime)
+  assert adb.stat('emu-1', '/data/local/tmp/payload.bin') == (mode, len(payload), mtime)
+  assert adb.stat('emu-1', '/data/local/tmp/missing') == (0, 0, 0)
+
+
+def test_sync_push_fail(adb, tmp_path):
+  local = tmp_path / 'payload.bin'
+  local.write_bytes(b'x')
+  with pytest.raises(AdbError, match='permission denied'):
+    adb.push('emu-1', str(local), '/system/payload.bin')
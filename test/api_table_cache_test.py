@@ -0,0 +1,74 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+
+import pytest
+
+from albatross.rpc_client import ApiTable, RpcException, api_table_cache, CAP_API_DIGEST
+from fake_rpc_server import FakeClient, api_table_data
+
+
+def open_fds():
+  return len(os.listdir('/proc/self/fd'))
+
+
+def test_cached_table_is_checked_by_the_server(rpc_server):
+  first = FakeClient('127.0.0.1', rpc_server.port, server_key='build-1')
+  second = FakeClient('127.0.0.1', rpc_server.port, server_key='build-1')
+  # the second client still asks, with the digest instead of fetching the tables
+  assert len(rpc_server.handshakes) == 2
+  assert rpc_server.handshakes[1][4:] == hashlib.md5(api_table_data()).digest()
+  assert second.allow_apis is first.allow_apis
+  assert second.ping() == 'pong'
+  first.close()
+  second.close()
+
+
+def test_reconnect_checks_again(rpc_server):
+  client = FakeClient('127.0.0.1', rpc_server.port, server_key='build-1')
+  client.close()
+  assert client.reconnect()
+  assert client.ping() == 'pong'
+  assert len(rpc_server.handshakes) == 2
+  client.close()
+
+
+def test_changed_tables_are_fetched(rpc_server):
+  key = ('build-1', '127.0.0.1', rpc_server.port)
+  api_table_cache[key] = ApiTable(b'\0' * 16, {'gone': 99}, {}, {}, CAP_API_DIGEST)
+  client = FakeClient('127.0.0.1', rpc_server.port, server_key='build-1')
+  assert 'ping' in client.allow_apis and 'gone' not in client.allow_apis
+  assert api_table_cache[key].digest == hashlib.md5(api_table_data()).digest()
+  client.close()
+
+
+def test_accept_without_server_fails(rpc_server):
+  FakeClient('127.0.0.1', rpc_server.port, server_key='build-1').close()
+  rpc_server.accept_only = True
+  fds = open_fds()
+  for _ in range(3):
+    with pytest.raises((RpcException, OSError)):
+      FakeClient('127.0.0.1', rpc_server.port, server_key='build-1')
+  # the socket of a failed handshake is closed
+  assert open_fds() == fds
+
+
+def test_reconnect_without_server_fails(rpc_server):
+  client = FakeClient('127.0.0.1', rpc_server.port, server_key='build-1')
+  client.close()
+  rpc_server.accept_only = True
+  assert not client.reconnect()
+  assert client.sock is None
@@ -0,0 +1,63 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import pytest
+
+from albatross.async_rpc_client import AsyncRpcClient
+from albatross.rpc_client import RpcCloseException
+from fake_rpc_server import FakeClient, PROCESSES
+
+
+class AsyncFakeClient(AsyncRpcClient, FakeClient):
+  pass
+
+
+def test_call_before_connect(rpc_server):
+  client = AsyncFakeClient('127.0.0.1', rpc_server.port)
+  with pytest.raises(RpcCloseException):
+    client.ping()
+  assert rpc_server.accepts == 0
+
+
+def test_calls(rpc_server):
+  async def run():
+    client = await AsyncFakeClient.create('127.0.0.1', rpc_server.port)
+    client.quiet = True
+    try:
+      assert await client.ping() == 'pong'
+      assert await client.get_processes() == PROCESSES
+      payload = bytes(range(256))
+      assert await client.echo(payload) == payload
+    finally:
+      client.close()
+
+  asyncio.run(run())
+  assert [name for name, _ in rpc_server.requests] == ['ping', 'get_processes', 'echo']
+
+
+def test_concurrent_calls_get_their_own_results(rpc_server):
+  rpc_server.delays['slow'] = 0.2
+
+  async def run():
+    client = await AsyncFakeClient.create('127.0.0.1', rpc_server.port)
+    client.quiet = True
+    try:
+      # the slow response arrives last, every await still gets its own result
+      return await asyncio.gather(client.slow(), client.echo(b'a'), client.echo(b'bc'))
+    finally:
+      client.close()
+
+  assert asyncio.run(run()) == ['pong', b'a', b'bc']
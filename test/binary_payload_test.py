@@ -0,0 +1,82 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+
+import pytest
+
+from albatross.binary_payload import dumps, loads, BinaryPayloadError, TAG_INT32, TAG_INT64, TAG_STR8, TAG_STR16, \
+  TAG_STR32
+
+
+def test_round_trip():
+  value = {'pid': 1234, 'name': 'com.example', 'ok': True, 'gone': False, 'none': None, 'ratio': 0.5,
+           'big': 1 << 40, 'negative': -7, 'blob': b'\x00\xff', 'items': [1, 'two', [3.0], {}]}
+  data = dumps(value)
+  assert loads(data) == (value, len(data))
+
+
+def test_integer_width():
+  assert dumps(0x7fffffff)[0] == TAG_INT32
+  assert dumps(-0x80000000)[0] == TAG_INT32
+  assert dumps(0x80000000)[0] == TAG_INT64
+  assert dumps(-0x80000001)[0] == TAG_INT64
+
+
+@pytest.mark.parametrize('size, tag', [(0, TAG_STR8), (255, TAG_STR8), (256, TAG_STR16), (0x10000, TAG_STR32)])
+def test_string_width(size, tag):
+  s = 'a' * size
+  data = dumps(s)
+  assert data[0] == tag
+  assert loads(data) == (s, len(data))
+
+
+def test_tuple_and_memoryview():
+  data = dumps((1, memoryview(b'ab')))
+  assert loads(data)[0] == [1, b'ab']
+
+
+def test_load_at_offset():
+  data = b'\xaa\xbb' + dumps('x') + dumps(5)
+  value, idx = loads(data, 2)
+  assert value == 'x'
+  assert loads(data, idx) == (5, len(data))
+  # memoryviews of a receive buffer decode the same
+  assert loads(memoryview(data), 2) == ('x', idx)
+
+
+def test_errors():
+  with pytest.raises(BinaryPayloadError):
+    dumps(object())
+  with pytest.raises(BinaryPayloadError, match='unknown tag'):
+    loads(b'\x7f')
+  with pytest.raises(BinaryPayloadError, match='truncated'):
+    loads(dumps([1, 2])[:-2])
+  with pytest.raises(BinaryPayloadError, match='truncated'):
+    loads(struct.pack('<BI', TAG_INT64, 1))
+
+
+def test_int_out_of_range():
+  with pytest.raises(BinaryPayloadError, match='int64'):
+    dumps(1 << 63)
+  with pytest.raises(BinaryPayloadError, match='int64'):
+    dumps([-(1 << 63) - 1])
+  assert loads(dumps(-(1 << 63)))[0] == -(1 << 63)
+
+
+@pytest.mark.parametrize('value', ['short', 'x' * 300, 'y' * 0x10000, b'raw bytes'])
+def test_truncated_body(value):
+  data = dumps(value)
+  with pytest.raises(BinaryPayloadError, match='truncated'):
+    loads(data[:-1])
@@ -0,0 +1,157 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import struct
+import threading
+import time
+
+import pytest
+
+from albatross.broadcast_dispatcher import OrderedDispatcher, DispatcherClosed, DeadlineTimer
+from fake_rpc_server import FakeClient, pack_str
+
+
+@pytest.fixture
+def dispatcher():
+  dispatcher = OrderedDispatcher('test-dispatcher', workers=4, max_pending=8)
+  yield dispatcher
+  dispatcher.close()
+
+
+def wait_for(predicate, timeout=2):
+  deadline = time.time() + timeout
+  while not predicate():
+    if time.time() > deadline:
+      return False
+    time.sleep(0.005)
+  return True
+
+
+def test_same_key_keeps_order(dispatcher):
+  calls = {key: [] for key in range(3)}
+
+  def handle(key, i):
+    time.sleep(0.001)
+    calls[key].append(i)
+
+  for i in range(20):
+    for key in calls:
+      dispatcher.submit(key, handle, key, i)
+  assert wait_for(lambda: dispatcher.pending == 0)
+  for key, values in calls.items():
+    assert values == list(range(20))
+
+
+def test_keys_run_in_parallel(dispatcher):
+  barrier = threading.Barrier(2, timeout=2)
+  done = []
+  dispatcher.submit('a', lambda: done.append(barrier.wait()))
+  dispatcher.submit('b', lambda: done.append(barrier.wait()))
+  assert wait_for(lambda: len(done) == 2)
+
+
+def test_backpressure(dispatcher):
+  release = threading.Event()
+  for i in range(dispatcher.max_pending):
+    assert dispatcher.submit('blocked', release.wait)
+  spaces = []
+  # a full queue refuses the call and reports when there is room again
+  assert not dispatcher.submit('other', print, on_space=lambda: spaces.append(True))
+  assert dispatcher.pending == dispatcher.max_pending
+  submitted = threading.Event()
+  thread = threading.Thread(target=lambda: dispatcher.submit('other', submitted.set))
+  thread.start()
+  # without on_space the submit waits
+  assert not submitted.wait(0.1)
+  release.set()
+  assert submitted.wait(2)
+  assert wait_for(lambda: spaces == [True])
+  thread.join()
+
+
+def test_exception_does_not_stop_key(dispatcher, capsys):
+  done = threading.Event()
+
+  def fail():
+    raise RuntimeError('broken handler')
+
+  dispatcher.submit('key', fail)
+  dispatcher.submit('key', done.set)
+  assert done.wait(2)
+  assert 'broken handler' in capsys.readouterr().err
+
+
+def test_close(dispatcher):
+  dispatcher.close()
+  with pytest.raises(DispatcherClosed):
+    dispatcher.submit('key', print)
+  assert wait_for(lambda: not any(thread.is_alive() for thread in dispatcher.threads))
+
+
+def test_deadline_timer():
+  timer = DeadlineTimer('test-deadline')
+  fired = []
+  timer.schedule(0.1, lambda: fired.append('late'))
+  timer.schedule(0.02, lambda: fired.append('early'))
+  cancelled = timer.schedule(0.05, lambda: fired.append('cancelled'))
+  timer.cancel(cancelled)
+  assert wait_for(lambda: len(fired) == 2)
+  time.sleep(0.05)
+  assert fired == ['early', 'late']
+
+
+class SlowReportClient(FakeClient):
+  broadcast_slow_timeout = 0.05
+
+
+def subscribe(server, handlers):
+  client = SlowReportClient('127.0.0.1', server.port)
+  client.quiet = True
+  return client, client.create_subscriber(handlers)
+
+
+def test_slow_handler_is_never_answered_for(rpc_server, capsys):
+  launch_info = {'pid': 5, 'uid': 10005}
+  rpc_server.broadcasts = [('launch_process', pack_str(json.dumps(launch_info))),
+    ('process_disconnect', struct.pack('<i', 7))]
+  handled = []
+
+  def on_launch_process(process_info):
+    # longer than broadcast_slow_timeout, the server has to wait for the result
+    time.sleep(0.3)
+    handled.append(process_info)
+    return 3
+
+  client, subscriber = subscribe(rpc_server, {'launch_process': on_launch_process,
+    'process_disconnect': handled.append})
+  assert wait_for(lambda: len(rpc_server.replies) == 2)
+  # the quick broadcast of another pid did not wait behind the slow one
+  assert handled == [7, launch_info]
+  assert rpc_server.replies == [(3, 101, b'send empty'), (1, 100, struct.pack('<i', 3))]
+  assert 'launch_process not handled in 0.05s, server still waits' in capsys.readouterr().out
+  subscriber.close()
+  client.close()
+
+
+def test_every_subscriber_has_its_own_workers(rpc_server):
+  client_a, subscriber_a = subscribe(rpc_server, {})
+  client_b, subscriber_b = subscribe(rpc_server, {})
+  dispatcher = subscriber_a.broadcast_dispatcher
+  assert dispatcher is not None and dispatcher is not subscriber_b.broadcast_dispatcher
+  subscriber_a.close()
+  assert subscriber_a.broadcast_dispatcher is None and dispatcher.closed
+  assert not subscriber_b.broadcast_dispatcher.closed
+  for client in (subscriber_b, client_a, client_b):
+    client.close()
@@ -0,0 +1,84 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import struct
+
+import pytest
+
+from albatross.broadcast_listeners import ListenerRegistry
+from fake_rpc_server import FakeClient, pack_str, wait_for
+
+
+def test_filters_and_order():
+  registry = ListenerRegistry()
+  calls = []
+  registry.add('launch_process', lambda info: calls.append('all'))
+  registry.add('launch_process', lambda info: calls.append('uid'), uid=10001)
+  registry.add('launch_process', lambda info: calls.append('uid+package'), uid=10001, package='com.a')
+  registry.add('launch_process', lambda info: calls.append('pid'), pid=5)
+  registry.add('launch_process', lambda info: calls.append('other uid'), uid=10002)
+  registry.notify('launch_process', {'pid': 5, 'uid': 10001, 'package': 'com.a'}, ({},))
+  assert calls == ['all', 'uid', 'uid+package', 'pid']
+  calls.clear()
+  registry.notify('launch_process', {'pid': 6, 'uid': 10001, 'package': 'com.b'}, ({},))
+  assert calls == ['all', 'uid']
+  calls.clear()
+  registry.notify('process_disconnect', {'pid': 5}, (5,))
+  assert calls == []
+
+
+def test_remove():
+  registry = ListenerRegistry()
+  listener = registry.add('process_disconnect', print, pid=5)
+  assert len(registry) == 1
+  assert registry.remove(listener)
+  assert not registry.remove(listener)
+  assert len(registry) == 0 and registry.match('process_disconnect', {'pid': 5}) == []
+
+
+def test_unknown_filter():
+  with pytest.raises(ValueError):
+    ListenerRegistry().add('launch_process', print, user=0)
+
+
+def test_failing_listener_does_not_stop_the_others(capsys):
+  registry = ListenerRegistry()
+  calls = []
+  registry.add('process_disconnect', lambda pid: 1 / 0)
+  registry.add('process_disconnect', calls.append)
+  registry.notify('process_disconnect', {'pid': 5}, (5,))
+  assert calls == [5]
+  assert 'ZeroDivisionError' in capsys.readouterr().err
+
+
+def test_listeners_see_subscribed_broadcasts(rpc_server):
+  rpc_server.broadcasts = [('launch_process', pack_str(json.dumps({'pid': 5, 'uid': 10001, 'pkg': 'com.a'}))),
+    ('launch_process', pack_str(json.dumps({'pid': 6, 'uid': 10002, 'pkg': 'com.b'}))),
+    ('process_disconnect', struct.pack('<i', 6)), ('process_disconnect', struct.pack('<i', 5))]
+  subscriber = FakeClient('127.0.0.1', rpc_server.port)
+  subscriber.quiet = True
+  with pytest.raises(ValueError):
+    subscriber.register_broadcast_listener('no_such_broadcast', print)
+  launched = []
+  disconnected = []
+  # registered before the subscription starts, the server sends its broadcasts right away
+  subscriber.register_broadcast_handler('launch_process', lambda info: 1)
+  subscriber.register_broadcast_listener('launch_process', launched.append, package='com.a')
+  subscriber.register_broadcast_listener('process_disconnect', disconnected.append, pid=5)
+  subscriber.subscribe()
+  assert wait_for(lambda: len(rpc_server.replies) == 4)
+  assert wait_for(lambda: disconnected == [5])
+  assert wait_for(lambda: launched == [{'pid': 5, 'uid': 10001, 'pkg': 'com.a'}])
+  subscriber.close()
@@ -0,0 +1,77 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import struct
+
+from albatross.rpc_client import CAP_BINARY_PAYLOAD, CAP_COMPRESS
+from fake_rpc_server import FakeClient, PROCESSES, api_table_data
+
+
+class CapableClient(FakeClient):
+  capabilities = CAP_BINARY_PAYLOAD | CAP_COMPRESS
+  compress_threshold = 16
+
+
+def connect(client_class, server):
+  client = client_class('127.0.0.1', server.port)
+  client.quiet = True
+  return client
+
+
+def test_no_payload_by_default(rpc_server):
+  client = connect(FakeClient, rpc_server)
+  assert client.ping() == 'pong'
+  assert rpc_server.handshakes == [b'']
+  assert not client.binary_payload and not client.compress
+  client.close()
+
+
+def test_digest_only_to_advertising_server(rpc_server):
+  connect(FakeClient, rpc_server).close()
+  client = connect(FakeClient, rpc_server)
+  digest = hashlib.md5(api_table_data()).digest()
+  assert rpc_server.handshakes == [b'', struct.pack('<I', 0) + digest]
+  assert client.ping() == 'pong'
+  client.close()
+
+
+def test_old_server_never_sees_a_payload(rpc_server):
+  rpc_server.marker = False
+  rpc_server.digest = False
+  for _ in range(2):
+    client = connect(FakeClient, rpc_server)
+    assert client.ping() == 'pong'
+    client.close()
+  assert rpc_server.handshakes == [b'', b'']
+
+
+def test_opt_in_capabilities(rpc_server):
+  rpc_server.capabilities = CAP_BINARY_PAYLOAD | CAP_COMPRESS
+  client = connect(CapableClient, rpc_server)
+  assert client.binary_payload and client.compress
+  assert client.get_processes() == PROCESSES
+  payload = bytes(range(256)) * 64
+  assert client.echo(payload) == payload
+  client.close()
+
+
+def test_capabilities_only_after_marker(rpc_server):
+  # a server which ignores the request sends no marker, nothing is enabled
+  rpc_server.marker = False
+  rpc_server.capabilities = CAP_BINARY_PAYLOAD
+  client = connect(CapableClient, rpc_server)
+  assert client.server_capabilities == 0 and not client.binary_payload
+  assert client.get_processes() == PROCESSES
+  client.close()
@@ -0,0 +1,100 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from albatross.client_pool import RpcClientPool, PoolExhausted
+from albatross.rpc_client import RpcCloseException
+from fake_rpc_server import FakeClient, api_table_data, wait_for
+
+
+@pytest.fixture
+def pool(rpc_server):
+  pool = RpcClientPool(FakeClient, '127.0.0.1', rpc_server.port, size=2)
+  yield pool
+  pool.close()
+
+
+def test_connections_are_reused(pool, rpc_server):
+  with pool.connection() as client:
+    assert client.ping() == 'pong'
+  with pool.connection() as again:
+    assert again is client
+  assert pool.created == 1 and rpc_server.accepts == 1
+
+
+def test_every_connection_handshakes(pool, rpc_server):
+  pool.prefill()
+  assert pool.created == 2 and len(pool.idle) == 2
+  # the second connection checks the table it got from the first by digest
+  digest = hashlib.md5(api_table_data()).digest()
+  assert rpc_server.handshakes == [b'', struct.pack('<I', 0) + digest]
+
+
+def test_exhausted(pool):
+  first = pool.acquire()
+  second = pool.acquire()
+  start = time.time()
+  with pytest.raises(PoolExhausted):
+    pool.acquire(timeout=0.1)
+  assert time.time() - start >= 0.1
+  released = []
+  thread = threading.Thread(target=lambda: released.append(pool.acquire(timeout=2)))
+  thread.start()
+  pool.release(first)
+  thread.join()
+  assert released == [first]
+  pool.release(first)
+  pool.release(second)
+
+
+def test_calls_run_in_parallel(pool, rpc_server):
+  rpc_server.delays['slow'] = 0.2
+  pool.prefill()
+  start = time.time()
+  with ThreadPoolExecutor(2) as executor:
+    assert list(executor.map(lambda _: pool.slow(), range(2))) == ['pong', 'pong']
+  # one connection each, the second call did not wait for the first
+  assert time.time() - start < 0.35
+
+
+def test_dead_connection_is_replaced(pool, rpc_server):
+  pool.prefill()
+  rpc_server.close_connections()
+  assert wait_for(lambda: not any(client.sock for client in pool.idle))
+  assert pool.ping() == 'pong'
+  assert pool.created == 1 and rpc_server.accepts == 3
+
+
+def test_idle_connection_is_pinged(pool, rpc_server):
+  with pool.connection() as client:
+    client.ping()
+  client.last_request_time -= pool.health_check_interval + 1
+  with pool.connection() as again:
+    assert again is client
+  assert [name for name, _ in rpc_server.requests] == ['ping', 'ping']
+
+
+def test_closed_pool(pool):
+  pool.prefill()
+  pool.close()
+  assert pool.idle == [] and pool.created == 0
+  with pytest.raises(RpcCloseException):
+    pool.acquire()
@@ -0,0 +1,40 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'albatross-python'))
+
+from albatross.rpc_client import api_table_cache
+from fake_adb_server import FakeAdbServer
+from fake_rpc_server import FakeRpcServer
+
+
+@pytest.fixture
+def adb_server():
+  server = FakeAdbServer().start()
+  yield server
+  server.stop()
+
+
+@pytest.fixture
+def rpc_server():
+  # every test starts without api tables of servers an earlier test used
+  api_table_cache.clear()
+  server = FakeRpcServer().start()
+  yield server
+  server.stop()
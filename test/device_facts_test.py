@@ -0,0 +1,68 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from albatross.common import Configuration
+from albatross.device import AlbatrossDevice, facts_probe, identity_probe
+
+
+class ProbedDevice(AlbatrossDevice):
+
+  def __init__(self, identity):
+    self.device_id = 'emu-1'
+    self.identity = identity
+    self.probes = []
+
+  def shell(self, cmd, timeout=None):
+    self.probes.append('facts' if cmd == facts_probe else 'identity' if cmd == identity_probe else cmd)
+    lines = ['{}={}'.format(*item) for item in self.identity.items()]
+    if cmd == facts_probe:
+      lines += ['abi=arm64-v8a', 'su=/system/bin/su']
+    return '\n'.join(lines)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+  monkeypatch.setattr(Configuration, 'cache_dir', str(tmp_path))
+  monkeypatch.setattr(Configuration, 'device_facts_cache', True)
+
+
+IDENTITY = {'fingerprint': 'build/1', 'boot_id': 'boot-1', 'uid': '2000'}
+
+
+def test_cold_start_asks_only_the_identity():
+  device = ProbedDevice(dict(IDENTITY))
+  assert device.facts['abi'] == 'arm64-v8a'
+  device.facts['root_mode'] = 'su'
+  device.save_facts()
+  device = ProbedDevice(dict(IDENTITY))
+  assert device.facts['su'] == '/system/bin/su' and device.facts['root_mode'] == 'su'
+  assert device.probes == ['identity']
+
+
+def test_reboot_drops_root_mode():
+  device = ProbedDevice(dict(IDENTITY))
+  device.facts['root_mode'] = 'su'
+  device.save_facts()
+  device = ProbedDevice(dict(IDENTITY, boot_id='boot-2'))
+  assert 'root_mode' not in device.facts and device.facts['boot_id'] == 'boot-2'
+  assert device.probes == ['identity']
+
+
+def test_new_build_probes_again():
+  ProbedDevice(dict(IDENTITY)).facts
+  device = ProbedDevice(dict(IDENTITY, fingerprint='build/2'))
+  assert device.facts['fingerprint'] == 'build/2'
+  assert device.probes == ['identity', 'facts']
@@ -0,0 +1,69 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from albatross import device
+from albatross.adb_client import AdbClient
+from albatross.device_registry import DeviceRegistry, parse_devices
+from fake_rpc_server import wait_for
+
+
+@pytest.fixture
+def registry(adb_server):
+  registry = DeviceRegistry(AdbClient('127.0.0.1', adb_server.port))
+  registry.retry_interval = 0.05
+  registry.start()
+  assert registry.wait_ready(2)
+  yield registry
+  registry.stop()
+
+
+def test_parse_devices():
+  assert parse_devices(b'emu-1\tdevice\n10.0.0.2:5555\toffline\n\n') == {'emu-1': 'device', '10.0.0.2:5555': 'offline'}
+  assert parse_devices(b'') == {}
+
+
+def test_initial_list(registry):
+  assert registry.states == {'emu-1': 'device', 'emu-2': 'offline'}
+  assert registry.is_online('emu-1') and not registry.is_online('emu-2')
+  assert registry.devices() == ['emu-1']
+
+
+def test_pushed_changes(registry, adb_server):
+  changes = []
+  registry.add_listener(lambda *change: changes.append(change))
+  adb_server.set_state('emu-2', 'device')
+  assert registry.wait_state('emu-2', timeout=2)
+  adb_server.set_state('emu-1', None)
+  assert wait_for(lambda: len(changes) == 2)
+  assert changes == [('emu-2', 'device', 'offline'), ('emu-1', None, 'device')]
+  assert not registry.wait_state('emu-1', timeout=0.05)
+  # one connection for all of it, no polling
+  assert adb_server.requests.count('host:track-devices') == 1
+
+
+def test_lost_stream_is_tracked_again(registry, adb_server):
+  adb_server.drop_trackers()
+  adb_server.set_state('emu-3', 'device')
+  assert registry.wait_state('emu-3', timeout=2)
+  assert wait_for(registry.ready.is_set)
+  assert adb_server.requests.count('host:track-devices') == 2
+
+
+def test_lookups_read_the_registry(registry, adb_server, monkeypatch):
+  monkeypatch.setattr(device, 'get_device_registry', lambda: registry)
+  assert device.get_devices() == ['emu-1']
+  assert device.check_device_alive('emu-1') and not device.check_device_alive('emu-2')
+  assert adb_server.requests == ['host:track-devices']
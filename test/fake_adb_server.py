@@ -0,0 +1,218 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import struct
+import subprocess
+import threading
+import traceback
+
+sync_head = struct.Struct('<4sI')
+sync_stat = struct.Struct('<4sIII')
+shell_v2_head = struct.Struct('<BI')
+
+
+def recv_exact(sock, n):
+  buf = b''
+  while len(buf) < n:
+    chunk = sock.recv(n - len(buf))
+    if not chunk:
+      raise EOFError
+    buf += chunk
+  return buf
+
+
+def hex_data(data: bytes):
+  return b'%04x' % len(data) + data
+
+
+class FakeAdbServer(object):
+  """
+  Speaks the adb server smart-socket protocol for one online device: host services,
+  track-devices, forward, shell (v1 and v2, commands run by the local sh) and sync
+  STAT/SEND with the pushed files kept in memory. requests records every request it
+  was sent, set_state pushes a device change to the trackers.
+  """
+
+  def __init__(self, serial='emu-1', shell_v2=True):
+    self.serial = serial
+    self.shell_v2 = shell_v2
+    self.device_states = {serial: 'device', 'emu-2': 'offline'}
+    # path -> (mode, data, mtime)
+    self.files = {}
+    self.forwards = []
+    self.requests = []
+    self.changed = threading.Condition()
+    self.trackers = []
+    self.sock = socket.socket()
+    self.sock.bind(('127.0.0.1', 0))
+    self.sock.listen(16)
+    self.port = self.sock.getsockname()[1]
+    self.running = True
+
+  def start(self):
+    threading.Thread(target=self.accept_loop, name='fake-adb', daemon=True).start()
+    return self
+
+  def stop(self):
+    self.running = False
+    self.sock.close()
+    self.drop_trackers()
+
+  def set_state(self, serial, state):
+    """state None removes the device"""
+    with self.changed:
+      if state is None:
+        self.device_states.pop(serial, None)
+      else:
+        self.device_states[serial] = state
+      self.changed.notify_all()
+
+  def drop_trackers(self):
+    with self.changed:
+      trackers = self.trackers
+      self.trackers = []
+      self.changed.notify_all()
+    for conn in trackers:
+      try:
+        conn.shutdown(socket.SHUT_RDWR)
+      except OSError:
+        pass
+
+  def device_listing(self):
+    return ''.join('{}\t{}\n'.format(*item) for item in self.device_states.items()).encode()
+
+  def accept_loop(self):
+    while self.running:
+      try:
+        conn, _ = self.sock.accept()
+      except OSError:
+        return
+      threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+  def serve(self, conn):
+    try:
+      self.handle(conn)
+    except EOFError:
+      pass
+    except Exception:
+      traceback.print_exc()
+    finally:
+      conn.close()
+
+  def read_request(self, conn):
+    n = int(recv_exact(conn, 4), 16)
+    request = recv_exact(conn, n).decode()
+    self.requests.append(request)
+    return request
+
+  def handle(self, conn):
+    request = self.read_request(conn)
+    if request == 'host:version':
+      conn.sendall(b'OKAY' + hex_data(b'0029'))
+    elif request == 'host:devices':
+      conn.sendall(b'OKAY' + hex_data(self.device_listing()))
+    elif request == 'host:track-devices':
+      self.track_devices(conn)
+    elif request.startswith('host:connect:'):
+      conn.sendall(b'OKAY' + hex_data(b'connected to ' + request[13:].encode()))
+    elif request.startswith('host-serial:'):
+      _, serial, service = request.split(':', 2)
+      self.handle_serial(conn, serial, service)
+    elif request.startswith('host:transport:'):
+      if request[15:] != self.serial:
+        conn.sendall(b'FAIL' + hex_data(b'device not found'))
+        return
+      conn.sendall(b'OKAY')
+      self.handle_transport(conn, self.read_request(conn))
+    else:
+      conn.sendall(b'FAIL' + hex_data(b'unknown ' + request.encode()))
+
+  def track_devices(self, conn):
+    with self.changed:
+      self.trackers.append(conn)
+      listing = self.device_listing()
+    conn.sendall(b'OKAY' + hex_data(listing))
+    while self.running:
+      with self.changed:
+        while listing == self.device_listing() and conn in self.trackers:
+          self.changed.wait()
+        if conn not in self.trackers:
+          return
+        listing = self.device_listing()
+      conn.sendall(hex_data(listing))
+
+  def handle_serial(self, conn, serial, service):
+    if service == 'features':
+      conn.sendall(b'OKAY' + hex_data(b'shell_v2,cmd' if self.shell_v2 else b'cmd'))
+    elif service.startswith('forward:'):
+      local, remote = service[8:].split(';')
+      self.forwards.append((serial, local, remote))
+      conn.sendall(b'OKAYOKAY')
+    elif service == 'list-forward':
+      listing = ''.join('{} {} {}\n'.format(*forward) for forward in self.forwards if forward[0] == serial)
+      conn.sendall(b'OKAY' + hex_data(listing.encode()))
+    else:
+      conn.sendall(b'FAIL' + hex_data(b'unknown ' + service.encode()))
+
+  def handle_transport(self, conn, service):
+    if service.startswith('shell,v2,raw:'):
+      conn.sendall(b'OKAY')
+      packet_id, n = shell_v2_head.unpack(recv_exact(conn, 5))
+      assert packet_id == 4 and n == 0, 'expect close stdin'
+      p = subprocess.run(['sh', '-c', service[13:]], capture_output=True, stdin=subprocess.DEVNULL)
+      # stdout in two packets so the client has to join them
+      half = len(p.stdout) // 2
+      for packet_id, data in ((1, p.stdout[:half]), (1, p.stdout[half:]), (2, p.stderr)):
+        if data:
+          conn.sendall(shell_v2_head.pack(packet_id, len(data)) + data)
+      conn.sendall(shell_v2_head.pack(3, 1) + bytes([p.returncode]))
+    elif service.startswith('shell:'):
+      conn.sendall(b'OKAY')
+      p = subprocess.run(['sh', '-c', service[6:]], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        stdin=subprocess.DEVNULL)
+      # a pty turns every newline into \r\n
+      conn.sendall(p.stdout.replace(b'\n', b'\r\n'))
+    elif service == 'sync:':
+      conn.sendall(b'OKAY')
+      self.handle_sync(conn)
+    else:
+      conn.sendall(b'FAIL' + hex_data(b'unknown service ' + service.encode()))
+
+  def handle_sync(self, conn):
+    while True:
+      ident, n = sync_head.unpack(recv_exact(conn, 8))
+      if ident == b'QUIT':
+        return
+      if ident == b'STAT':
+        path = recv_exact(conn, n).decode()
+        mode, data, mtime = self.files.get(path, (0, b'', 0))
+        conn.sendall(sync_stat.pack(b'STAT', mode, len(data), mtime))
+      elif ident == b'SEND':
+        path, mode = recv_exact(conn, n).decode().rsplit(',', 1)
+        chunks = []
+        while True:
+          ident, n = sync_head.unpack(recv_exact(conn, 8))
+          if ident == b'DONE':
+            mtime = n
+            break
+          chunks.append(recv_exact(conn, n))
+        if not path.startswith('/data/'):
+          msg = b'permission denied'
+          conn.sendall(sync_head.pack(b'FAIL', len(msg)) + msg)
+          continue
+        self.files[path] = (int(mode), b''.join(chunks), mtime)
+        conn.sendall(sync_head.pack(b'OKAY', 0))
+      else:
+        raise EOFError
@@ -0,0 +1,238 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import socket
+import struct
+import threading
+import time
+import zlib
+
+from albatross.binary_payload import dumps
+from albatross.rpc_client import RpcClient, rpc_api, broadcast_api, CAP_BINARY_PAYLOAD, CAP_COMPRESS, \
+  CAP_API_DIGEST, CAPABILITY_MARKER, API_TABLE_UNCHANGED, MSG_APIS, FLAG_COMPRESSED, COMPRESSED_LEN_MASK, \
+  FRAME_LEN_MASK, void
+
+APIS = ['subscribe', 'ping', 'echo', 'slow', 'get_processes']
+BROADCASTS = ['launch_process', 'process_disconnect']
+PROCESSES = [[1, 10001, 'com.a'], [2, 10002, 'com.b']]
+
+
+def pack_str(s: str):
+  bs = s.encode()
+  return struct.pack('<H', len(bs)) + bs + b'\0'
+
+
+def recv_exact(sock, n):
+  buf = b''
+  while len(buf) < n:
+    chunk = sock.recv(n - len(buf))
+    if not chunk:
+      raise EOFError
+    buf += chunk
+  return buf
+
+
+def wait_for(predicate, timeout=2):
+  deadline = time.time() + timeout
+  while not predicate():
+    if time.time() > deadline:
+      return False
+    time.sleep(0.005)
+  return True
+
+
+def api_table_data():
+  data = struct.pack('<ii', len(APIS), len(BROADCASTS))
+  for i, name in enumerate(APIS):
+    data += bytes([10 + i]) + pack_str(name)
+  for i, name in enumerate(BROADCASTS):
+    data += bytes([100 + i]) + pack_str(name)
+  return data
+
+
+class FakeClient(RpcClient):
+
+  @rpc_api
+  def echo(self, data: bytes) -> bytes:
+    pass
+
+  @rpc_api
+  def slow(self) -> str:
+    pass
+
+  @rpc_api
+  def get_processes(self) -> list:
+    pass
+
+  @broadcast_api
+  def launch_process(self, process_info: dict) -> int:
+    pass
+
+  @broadcast_api
+  def process_disconnect(self, pid: int) -> void:
+    pass
+
+
+class FakeConnection(object):
+
+  def __init__(self, server: 'FakeRpcServer', sock):
+    self.server = server
+    self.sock = sock
+    self.send_lock = threading.Lock()
+    self.capabilities = 0
+
+  def send_frame(self, idx, result, data=b''):
+    if result < 0:
+      result += 256
+    with self.send_lock:
+      self.sock.sendall(b'wq' + struct.pack('<HI', idx, len(data) | (result << 24)) + data)
+
+  def read_frame(self):
+    idx, len_result = struct.unpack('<HI', recv_exact(self.sock, 8)[2:])
+    if self.capabilities & CAP_COMPRESS:
+      data = recv_exact(self.sock, len_result & COMPRESSED_LEN_MASK)
+      if len_result & FLAG_COMPRESSED:
+        data = zlib.decompress(data)
+    else:
+      data = recv_exact(self.sock, len_result & FRAME_LEN_MASK)
+    return idx, len_result >> 24, data
+
+  def close(self):
+    try:
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
+    self.sock.close()
+
+  def serve(self):
+    server = self.server
+    try:
+      while True:
+        idx, cmd, data = self.read_frame()
+        if cmd == MSG_APIS:
+          self.handshake(idx, data)
+          continue
+        name = APIS[cmd - 10]
+        server.requests.append((name, data))
+        if name == 'subscribe':
+          self.send_frame(idx, 0)
+          self.subscribe()
+          return
+        delay = server.delays.get(name)
+        if delay:
+          # answered later from another thread, so responses may overtake each other
+          threading.Timer(delay, self.respond, (idx, name, data)).start()
+        else:
+          self.respond(idx, name, data)
+    except (EOFError, OSError):
+      pass
+
+  def handshake(self, idx, data):
+    server = self.server
+    server.handshakes.append(data)
+    requested = struct.unpack_from('<I', data)[0] if len(data) >= 4 and server.marker else 0
+    self.capabilities = requested & server.capabilities
+    marked = self.capabilities | (CAP_API_DIGEST if server.digest else 0)
+    marker = CAPABILITY_MARKER + struct.pack('<I', marked) if server.marker else b''
+    table = api_table_data()
+    if server.digest and len(data) == 20 and data[4:] == hashlib.md5(table).digest():
+      self.send_frame(idx, API_TABLE_UNCHANGED, marker)
+    else:
+      self.send_frame(idx, 0, table + marker)
+
+  def respond(self, idx, name, data):
+    try:
+      if name in ('ping', 'slow'):
+        self.send_frame(idx, 0, pack_str('pong'))
+      elif name == 'echo':
+        # the argument is its u32 length and the bytes
+        self.send_frame(idx, 0, data[4:])
+      elif name == 'get_processes':
+        if self.capabilities & CAP_BINARY_PAYLOAD:
+          self.send_frame(idx, 0, dumps(PROCESSES))
+        else:
+          self.send_frame(idx, 0, pack_str(json.dumps(PROCESSES)))
+      else:
+        self.send_frame(idx, 0)
+    except OSError:
+      pass
+
+  def subscribe(self):
+    server = self.server
+    for i, (name, payload) in enumerate(server.broadcasts):
+      # odd ids are broadcasts which wait for a reply
+      self.send_frame((i << 1) | 1, 100 + BROADCASTS.index(name), payload)
+    while True:
+      idx, result, data = self.read_frame()
+      server.replies.append((idx, result, data))
+
+
+class FakeRpcServer(object):
+  """
+  An albatross rpc server with the APIS and BROADCASTS tables. capabilities are those it
+  accepts, digest adds CAP_API_DIGEST to the marked bits and answers a matching table
+  digest with API_TABLE_UNCHANGED, marker off behaves like a server which knows nothing
+  of capabilities. With accept_only every connection is closed right after the accept,
+  like an adb forward to a port nobody listens on.
+  """
+
+  def __init__(self, capabilities=0, digest=True, marker=True, broadcasts=None):
+    self.capabilities = capabilities
+    self.digest = digest
+    self.marker = marker
+    self.broadcasts = broadcasts or []
+    self.accept_only = False
+    self.delays = {}
+    self.handshakes = []
+    self.requests = []
+    self.replies = []
+    self.connections = []
+    self.accepts = 0
+    self.sock = socket.socket()
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.sock.bind(('127.0.0.1', 0))
+    self.sock.listen(64)
+    self.port = self.sock.getsockname()[1]
+    self.running = True
+
+  def start(self):
+    threading.Thread(target=self.accept_loop, name='fake-rpc', daemon=True).start()
+    return self
+
+  def stop(self):
+    self.running = False
+    self.sock.close()
+    self.close_connections()
+
+  def close_connections(self):
+    connections = self.connections
+    self.connections = []
+    for connection in connections:
+      connection.close()
+
+  def accept_loop(self):
+    while self.running:
+      try:
+        sock, _ = self.sock.accept()
+      except OSError:
+        return
+      self.accepts += 1
+      if self.accept_only:
+        sock.close()
+        continue
+      connection = FakeConnection(self, sock)
+      self.connections.append(connection)
+      threading.Thread(target=connection.serve, daemon=True).start()
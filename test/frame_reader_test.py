@@ -0,0 +1,120 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import struct
+import zlib
+
+import pytest
+
+from albatross.rpc_client import FrameReader, FLAG_COMPRESSED, RpcCloseException, pack_frame, rpc_send_data, \
+  rpc_send_frames, rpc_receive_data
+
+
+@pytest.fixture
+def sock_pair():
+  a, b = socket.socketpair()
+  yield a, b
+  a.close()
+  b.close()
+
+
+def frame(data, call_id, cmd, flags=0):
+  head, data = pack_frame(data, call_id, cmd, flags)
+  return head + (data or b'')
+
+
+def test_pack_frame():
+  assert frame(b'abc', 7, 3) == b'wq' + struct.pack('<HI', 7, 3 | 3 << 24) + b'abc'
+  # negative results travel as a byte
+  assert frame(None, 1, -6) == b'wq' + struct.pack('<HI', 1, 250 << 24)
+
+
+def test_receive_frames(sock_pair):
+  a, b = sock_pair
+  rpc_send_frames(a, [(b'first', 1, 0, 0), (None, 2, -4, 0), (b'x' * 10000, 3, 5, 0)])
+  reader = FrameReader(16)
+  idx, result, data = reader.receive(b)
+  assert (idx, result, bytes(data)) == (1, 0, b'first')
+  assert reader.receive(b) == (2, -4, None)
+  idx, result, data = reader.receive(b)
+  assert (idx, result, bytes(data)) == (3, 5, b'x' * 10000)
+  # the buffer grew and is reused
+  assert len(reader.buffer) >= 10000
+
+
+def test_reuse_buffer(sock_pair):
+  a, b = sock_pair
+  reader = FrameReader(64)
+  rpc_send_data(a, b'one', 1, 0)
+  rpc_send_data(a, b'two', 2, 0)
+  first = reader.receive(b)[2]
+  second = reader.receive(b)[2]
+  # a reused buffer is overwritten by the next frame
+  assert bytes(first) == b'two' and bytes(second) == b'two'
+  reader = FrameReader(0, False)
+  rpc_send_data(a, b'one', 1, 0)
+  rpc_send_data(a, b'two', 2, 0)
+  first = reader.receive(b)[2]
+  second = reader.receive(b)[2]
+  assert bytes(first) == b'one' and bytes(second) == b'two'
+
+
+def test_resume_after_timeout(sock_pair):
+  a, b = sock_pair
+  b.settimeout(0.05)
+  reader = FrameReader()
+  data = frame(b'payload', 9, 1)
+  a.sendall(data[:5])
+  with pytest.raises(socket.timeout):
+    reader.receive(b)
+  a.sendall(data[5:10])
+  with pytest.raises(socket.timeout):
+    reader.receive(b)
+  a.sendall(data[10:])
+  idx, result, view = reader.receive(b)
+  assert (idx, result, bytes(view)) == (9, 1, b'payload')
+
+
+def test_compressed(sock_pair):
+  a, b = sock_pair
+  payload = b'albatross ' * 1000
+  packed = zlib.compress(payload)
+  rpc_send_data(a, packed, 4, 0, FLAG_COMPRESSED)
+  reader = FrameReader()
+  reader.compressed = True
+  idx, result, data = reader.receive(b)
+  assert (idx, result, bytes(data)) == (4, 0, payload)
+
+
+def test_wrong_head(sock_pair):
+  a, b = sock_pair
+  a.sendall(b'xx' + struct.pack('<HI', 1, 0))
+  with pytest.raises(struct.error, match='wrong head'):
+    rpc_receive_data(b)
+
+
+def test_close(sock_pair):
+  a, b = sock_pair
+  a.close()
+  with pytest.raises(RpcCloseException):
+    rpc_receive_data(b)
+
+
+def test_close_in_frame(sock_pair):
+  a, b = sock_pair
+  a.sendall(frame(b'payload', 1, 0)[:10])
+  a.close()
+  with pytest.raises(OSError):
+    rpc_receive_data(b)
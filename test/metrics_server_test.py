@@ -0,0 +1,116 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import threading
+import urllib.error
+import urllib.request
+from collections import Counter
+
+import pytest
+
+from albatross import metrics_server
+from albatross.device import AlbatrossDevice
+from albatross.metrics_server import MetricsServer, MetricsWriter
+from fake_rpc_server import FakeClient
+
+
+class StaticRegistry(object):
+
+  def __init__(self, states):
+    self.states = states
+    self.ready = threading.Event()
+    self.ready.set()
+
+  def is_online(self, serial):
+    return self.states.get(serial) == 'device'
+
+
+class Manager(object):
+
+  def __init__(self, *devices):
+    self.devices = {device.device_id: device for device in devices}
+
+
+def stats_device(device_id):
+  device = AlbatrossDevice.__new__(AlbatrossDevice)
+  device.device_id = device_id
+  device.stats_lock = threading.Lock()
+  device.connection_closes = Counter()
+  device.dex_load_results = Counter()
+  device.inject_failures = 0
+  return device
+
+
+@pytest.fixture
+def registry(monkeypatch):
+  registry = StaticRegistry({'emu-1': 'device', 'emu-2': 'offline'})
+  # scrapes must not look for an adb server
+  monkeypatch.setattr(metrics_server, 'get_device_registry', lambda: registry)
+  return registry
+
+
+@pytest.fixture
+def server(rpc_server, registry):
+  device = stats_device('emu-1')
+  client = FakeClient('127.0.0.1', rpc_server.port)
+  client.quiet = True
+  client.ping()
+  device.__dict__['client'] = client
+  device.connection_closes['system_server'] += 2
+  device.dex_load_results['SUCCESS'] += 1
+  server = MetricsServer(Manager(device, stats_device('emu-2'))).start()
+  yield server
+  server.stop()
+  client.close()
+
+
+def get(server, path):
+  url = 'http://{}:{}{}'.format(*server.address[:2], path)
+  try:
+    with urllib.request.urlopen(url, timeout=5) as response:
+      return response.status, response.read().decode()
+  except urllib.error.HTTPError as e:
+    return e.code, e.read().decode()
+
+
+def test_writer_renders_families():
+  writer = MetricsWriter()
+  writer.add('x_total', 'counter', 'xs', 1, device='a"b')
+  writer.add('x_total', 'counter', 'xs', 2, device='c')
+  writer.add('up', 'gauge', 'up', 1)
+  assert writer.render() == '\n'.join(['# HELP x_total xs', '# TYPE x_total counter', 'x_total{device="a\\"b"} 1',
+    'x_total{device="c"} 2', '# HELP up up', '# TYPE up gauge', 'up 1', ''])
+
+
+def test_metrics(server):
+  status, body = get(server, '/metrics')
+  assert status == 200
+  lines = body.splitlines()
+  assert 'albatross_device_online{device="emu-1"} 1' in lines
+  assert 'albatross_device_online{device="emu-2"} 0' in lines
+  assert 'albatross_connection_closes_total{device="emu-1",client="system_server"} 2' in lines
+  assert 'albatross_dex_load_total{device="emu-1",result="SUCCESS"} 1' in lines
+  assert 'albatross_rpc_calls_total{device="emu-1",client="albatross",method="ping"} 1' in lines
+  assert 'albatross_rpc_latency_seconds_count{phase="wait",device="emu-1",client="albatross",method="ping"} 1' in lines
+  # the device without a client has no connection metrics
+  assert not any(line.startswith('albatross_connection_age_seconds{device="emu-2"') for line in lines)
+
+
+def test_health(server, registry):
+  status, body = get(server, '/health')
+  assert status == 503
+  assert json.loads(body) == {'status': 'degraded', 'devices': {
+    'emu-1': {'online': True, 'connected': True}, 'emu-2': {'online': False, 'connected': False}}}
+  assert get(server, '/nothing')[0] == 404
@@ -0,0 +1,115 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import threading
+
+import pytest
+
+from albatross.metrics import LatencyHistogram, MethodMetrics, ClientMetrics, bucket_index, bucket_value, \
+  BUCKET_COUNT, MAX_VALUE, SUB_BUCKET_HALF
+from fake_rpc_server import FakeClient
+
+
+@pytest.mark.parametrize('value', [0, 1, 127, 128, 129, 255, 256, 257, 1000, 123456, 123456789, MAX_VALUE])
+def test_bucket_bounds(value):
+  index = bucket_index(value)
+  assert index < BUCKET_COUNT
+  assert bucket_value(index) >= value
+  if index:
+    assert bucket_value(index - 1) < value
+
+
+def test_bucket_error():
+  for value in (200, 5000, 777777, 98765432):
+    assert (bucket_value(bucket_index(value)) - value) / value < 1 / SUB_BUCKET_HALF
+
+
+def test_percentiles():
+  random.seed(7)
+  values = sorted(random.expovariate(100) for _ in range(20000))
+  histogram = LatencyHistogram()
+  for value in values:
+    histogram.record(value)
+  assert histogram.count == len(values)
+  for percent in (50, 90, 99):
+    exact = values[int(len(values) * percent / 100) - 1]
+    assert abs(histogram.percentile(percent) - exact) / exact < 0.03
+  assert histogram.percentile(100) == histogram.max / 1000000
+  assert histogram.mean() == pytest.approx(sum(values) / len(values), rel=0.001)
+
+
+def test_clamp_and_empty():
+  histogram = LatencyHistogram()
+  assert histogram.percentile(99) == 0.0 and histogram.mean() == 0.0
+  histogram.record(-1)
+  histogram.record(10 ** 6)
+  assert histogram.max == MAX_VALUE
+  assert histogram.percentile(1) == 0.0
+
+
+def test_merge_and_copy():
+  a = LatencyHistogram()
+  b = LatencyHistogram()
+  a.record(0.001)
+  b.record(0.002)
+  b.record(0.003)
+  copy = a.copy()
+  copy.merge(b)
+  assert (a.count, copy.count) == (1, 3)
+  assert copy.max == 3000
+  assert copy.percentile(50) == pytest.approx(0.002, rel=0.02)
+
+
+def test_method_metrics():
+  metrics = MethodMetrics('ping')
+  metrics.record(0.001, 0.01, 0.0001, 10, 20)
+  metrics.record(0.001, None, None, 10, 0, error=True)
+  summary = metrics.summary()
+  assert (summary['calls'], summary['errors'], summary['bytes_out'], summary['bytes_in']) == (2, 1, 20, 20)
+  assert (summary['send']['count'], summary['wait']['count'], summary['parse']['count']) == (2, 1, 1)
+
+
+def test_client_metrics_concurrent():
+  client_metrics = ClientMetrics('client')
+
+  def call():
+    for _ in range(500):
+      client_metrics.method('ping').record(0.001, 0.001, 0.001, 8, 8)
+
+  threads = [threading.Thread(target=call) for _ in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  snapshot = client_metrics.snapshot()
+  assert list(snapshot) == ['ping']
+  assert snapshot['ping'].calls == 2000 and snapshot['ping'].send.count == 2000
+  ping = client_metrics.method('ping')
+  client_metrics.reset()
+  assert client_metrics.summary()['ping']['calls'] == 0
+  # a method which cached its MethodMetrics keeps counting after the reset
+  ping.record(0.001, None, None, 8, 0)
+  assert client_metrics.snapshot()['ping'].calls == 1
+
+
+def test_reset_keeps_client_counting(rpc_server):
+  client = FakeClient('127.0.0.1', rpc_server.port)
+  client.quiet = True
+  assert client.ping() == 'pong'
+  client.metrics.reset()
+  assert client.ping() == 'pong'
+  ping = client.metrics.snapshot()['ping']
+  assert ping.calls == 1 and ping.wait.count == 1
+  client.close()
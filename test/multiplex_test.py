@@ -0,0 +1,82 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from albatross.rpc_client import RpcCloseException
+from fake_rpc_server import FakeClient, wait_for
+
+
+@pytest.fixture
+def client(rpc_server):
+  client = FakeClient('127.0.0.1', rpc_server.port, multiplex=True)
+  client.quiet = True
+  yield client
+  client.close()
+
+
+def test_parallel_calls_get_their_own_results(client):
+  payloads = [bytes([i]) * (i + 1) for i in range(64)]
+  with ThreadPoolExecutor(8) as executor:
+    assert list(executor.map(client.echo, payloads)) == payloads
+
+
+def test_response_overtakes_slow_call(client, rpc_server):
+  rpc_server.delays['slow'] = 0.3
+  results = []
+  slow_thread = threading.Thread(target=lambda: results.append(client.slow()))
+  slow_thread.start()
+  assert wait_for(lambda: len(rpc_server.requests) == 1)
+  start = time.time()
+  # answered while the slow call still waits, no request_lock held in between
+  assert client.echo(b'quick') == b'quick'
+  assert time.time() - start < 0.2 and not results
+  slow_thread.join()
+  assert results == ['pong']
+
+
+def test_timeout_drops_late_response(client, rpc_server, capsys):
+  rpc_server.delays['slow'] = 0.3
+  with pytest.raises(TimeoutError):
+    client.slow(timeout=0.05)
+  assert not client.pending_calls
+  time.sleep(0.35)
+  # the late response has no caller anymore and the connection keeps working
+  assert client.echo(b'after') == b'after'
+  assert 'which has no caller' in capsys.readouterr().out
+
+
+def test_close_fails_waiting_calls(client, rpc_server):
+  rpc_server.delays['slow'] = 5
+  errors = []
+
+  def call_slow():
+    try:
+      client.slow()
+    except Exception as e:
+      errors.append(e)
+
+  thread = threading.Thread(target=call_slow)
+  thread.start()
+  assert wait_for(lambda: len(rpc_server.requests) == 1)
+  start = time.time()
+  rpc_server.close_connections()
+  thread.join(2)
+  assert len(errors) == 1 and isinstance(errors[0], RpcCloseException)
+  assert time.time() - start < 2
+  assert not client.sock
@@ -0,0 +1,123 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+from albatross.device import AlbatrossDevice
+from albatross.process_table import ProcessTable
+from fake_rpc_server import wait_for
+
+ROWS = [
+  [100, 10001, 100, 'com.a', ['com.a']],
+  [101, 10001, 200, 'com.a:push', ['com.a']],
+  [200, 10002, 100, 'com.b', ['com.b', 'com.shared']],
+]
+
+
+class Loader(object):
+
+  def __init__(self, rows):
+    self.rows = rows
+    self.calls = 0
+    self.release = threading.Event()
+    self.release.set()
+
+  def __call__(self):
+    self.calls += 1
+    self.release.wait(2)
+    return self.rows
+
+
+def loaded_table(max_age=30):
+  table = ProcessTable(Loader(ROWS), max_age)
+  assert table.refresh()
+  return table
+
+
+def test_indexes():
+  table = loaded_table()
+  assert len(table) == 3
+  assert table.pids_of_uid(10001) == [100, 101]
+  assert table.pids_of_name('com.a:push') == [101]
+  assert table.pids_of_package('com.shared') == [200]
+  assert table.get(200).packages == ('com.b', 'com.shared')
+  table.on_launch_process({'pid': 300, 'uid': 10003, 'process': 'com.c', 'pkg': 'com.c'})
+  assert table.pids_of_package('com.c') == [300]
+  table.on_process_disconnect(100)
+  assert table.pids_of_uid(10001) == [101] and table.get(100) is None
+  assert [record.pid for record in table.remove_package('com.b')] == [200]
+  assert table.pids_of_package('com.shared') == []
+
+
+def test_lookup_never_waits_for_refresh():
+  table = loaded_table(max_age=0.05)
+  loader = table.loader
+  loader.release.clear()
+  table.loaded_time -= 1
+  # the stale table answers at once while the refresh blocks in the loader
+  assert table.pids_of_name('com.a') == [100]
+  assert table.pids_of_name('com.a') == [100]
+  assert wait_for(lambda: loader.calls == 2)
+  loader.rows = ROWS[:1] + [[400, 10004, 100, 'com.a', ['com.a']]]
+  loader.release.set()
+  assert wait_for(lambda: table.pids_of_name('com.a') == [100, 400])
+  # one refresh for all the stale lookups
+  assert loader.calls == 2
+
+
+def test_fresh_table_is_not_reloaded():
+  table = loaded_table()
+  for _ in range(10):
+    table.pids_of_uid(10001)
+  assert table.loader.calls == 1
+
+
+class PidofDevice(AlbatrossDevice):
+
+  def __init__(self, table):
+    self.device_id = 'emu-1'
+    self.process_table = table
+    self.shell_commands = []
+
+  def shell(self, cmd, **kwargs):
+    self.shell_commands.append(cmd)
+    return '555 556\n'
+
+
+def test_pidof_trusts_the_table():
+  device = PidofDevice(loaded_table())
+  assert device.pidof('com.a') == ['100']
+  assert device.shell_commands == []
+  # a native process is not in the table
+  assert device.pidof('surfaceflinger') == ['555', '556']
+  assert device.shell_commands == ['pidof surfaceflinger']
+  assert device.process_table.loader.calls == 1
+
+
+class GoneProcessClient(object):
+
+  @staticmethod
+  def inject_albatross(pid, flags, arg):
+    return -1
+
+
+def test_failed_call_drops_the_pid():
+  device = PidofDevice(loaded_table())
+  device.stats_lock = threading.Lock()
+  device.inject_failures = 0
+  assert device.attach_pids(GoneProcessClient(), device.pidof('com.a'), (None,) * 6) == []
+  assert device.inject_failures == 1
+  # the stale pid left the table, the next lookup asks the device
+  assert device.pidof('com.a') == ['555', '556']
+  assert device.shell_commands == ['pidof com.a']
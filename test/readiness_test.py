@@ -0,0 +1,59 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from albatross.common import wait_until
+from albatross.device import AlbatrossDevice
+
+
+def bare_device():
+  # only what the client helpers need, no adb behind it
+  device = AlbatrossDevice.__new__(AlbatrossDevice)
+  device.device_id = 'emu-1'
+  return device
+
+
+def test_wait_until():
+  calls = []
+  assert wait_until(lambda: calls.append(1) or len(calls) >= 3 and 'ready', 2, 0.01) == 'ready'
+  start = time.time()
+  assert wait_until(lambda: False, 0.1, 0.01) is None
+  assert time.time() - start < 0.5
+
+
+def test_accepting_forward_is_not_ready(rpc_server):
+  rpc_server.accept_only = True
+  device = bare_device()
+  assert device.try_create_client(rpc_server.port, 'build-1') is None
+
+
+def test_ready_once_the_server_answers(rpc_server):
+  rpc_server.accept_only = True
+  device = bare_device()
+  threading.Timer(0.2, setattr, (rpc_server, 'accept_only', False)).start()
+  client = wait_until(lambda: device.try_create_client(rpc_server.port, 'build-1'), 5)
+  assert client is not None
+  assert ('ping', b'') in rpc_server.requests
+  client.close()
+
+
+def test_silent_server_is_not_ready(rpc_server):
+  # the handshake passes but calls are never answered
+  rpc_server.delays['ping'] = 10
+  device = bare_device()
+  start = time.time()
+  assert device.try_create_client(rpc_server.port, 'build-1') is None
+  assert time.time() - start < 8
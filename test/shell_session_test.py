@@ -0,0 +1,56 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from albatross.shell_session import ShellSession, wrap_command
+
+
+@pytest.fixture
+def session():
+  # a local sh speaks the same stdin protocol as the device shell
+  session = ShellSession(['sh'], 'local-sh')
+  yield session
+  session.close()
+
+
+def test_wrap_command_defaults_to_subshell():
+  assert wrap_command('ls', b'M').startswith(b'( ls\n)')
+  assert wrap_command('ls', b'M', in_shell=True).startswith(b'{ ls\n}')
+
+
+def test_run(session):
+  assert session.run('echo hello; echo err >&2') == (0, b'hello\nerr\n')
+  assert session.run('false') == (1, b'')
+  assert session.command_count == 2
+
+
+def test_exit_keeps_the_session(session):
+  assert session.run('echo bye; exit 3') == (3, b'bye\n')
+  assert session.run('echo still') == (0, b'still\n')
+  assert session.command_count == 2
+
+
+def test_state_stays_in_the_subshell(session):
+  start_dir = session.run('pwd')[1]
+  session.run('cd /; export ALB_TEST=1')
+  assert session.run('pwd; echo "x$ALB_TEST"') == (0, start_dir + b'x\n')
+  # in_shell is the explicit way to change the session shell
+  session.run('cd /; export ALB_TEST=1', in_shell=True)
+  assert session.run('pwd; echo "x$ALB_TEST"') == (0, b'/\nx1\n')
+
+
+def test_command_can_not_read_the_next_ones(session):
+  assert session.run('cat') == (0, b'')
+  assert session.run('echo next') == (0, b'next\n')
@@ -0,0 +1,145 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from albatross.device import AlbatrossDevice
+from albatross.rpc_client import RpcCloseException, get_monitor
+from fake_rpc_server import FakeClient, wait_for
+
+
+def connect(server, multiplex=True):
+  client = FakeClient('127.0.0.1', server.port, multiplex=multiplex)
+  client.quiet = True
+  return client
+
+
+def call_slow(client):
+  """start client.slow() on a thread, the list gets the RpcCloseException it raised"""
+  errors = []
+
+  def call():
+    try:
+      client.slow()
+    except RpcCloseException as e:
+      errors.append(e)
+
+  caller = threading.Thread(target=call)
+  caller.start()
+  return caller, errors
+
+
+def test_server_close_fails_pending_calls(rpc_server):
+  rpc_server.delays['slow'] = 10
+  client = connect(rpc_server)
+  caller, errors = call_slow(client)
+  assert wait_for(lambda: ('slow', b'') in rpc_server.requests)
+  rpc_server.close_connections()
+  caller.join(2)
+  assert len(errors) == 1
+  assert wait_for(lambda: client.sock is None)
+
+
+def test_user_close_fails_pending_calls(rpc_server):
+  rpc_server.delays['slow'] = 10
+  client = connect(rpc_server)
+  caller, errors = call_slow(client)
+  assert wait_for(lambda: ('slow', b'') in rpc_server.requests)
+  start = time.time()
+  client.close()
+  caller.join(2)
+  assert len(errors) == 1
+  assert time.time() - start < 1
+
+
+def test_close_callback_does_not_block_the_reactor(rpc_server):
+  blocked = connect(rpc_server)
+  other = connect(rpc_server)
+  release = threading.Event()
+  threads = []
+
+  def on_close(client):
+    threads.append(threading.current_thread().name)
+    release.wait(5)
+
+  blocked.set_on_close_listener(on_close)
+  # the connection of blocked goes first
+  rpc_server.connections[0].close()
+  assert wait_for(lambda: threads)
+  assert threads[0].startswith('socket close')
+  # the reactor still reads the responses of other clients
+  assert other.ping() == 'pong'
+  release.set()
+  other.close()
+
+
+def test_close_burst_uses_the_close_workers(rpc_server):
+  monitor = get_monitor()
+  closed = []
+  names = set()
+  lock = threading.Lock()
+
+  def on_close(client):
+    with lock:
+      names.add(threading.current_thread().name)
+      closed.append(client)
+    time.sleep(0.05)
+
+  clients = []
+  for _ in range(12):
+    client = connect(rpc_server)
+    client.set_on_close_listener(on_close)
+    clients.append(client)
+  rpc_server.close_connections()
+  assert wait_for(lambda: len(closed) == len(clients), 5)
+  assert len(names) <= monitor.close_workers
+
+
+class FlappingClient(object):
+  """reconnects every time, like a forward whose server drops each connection"""
+
+  def __init__(self):
+    self.reconnects = 0
+
+  def reconnect(self):
+    self.reconnects += 1
+    return True
+
+
+def test_reconnect_backoff_gives_up():
+  device = AlbatrossDevice.__new__(AlbatrossDevice)
+  device.device_id = 'emu-1'
+  device.stats_lock = threading.Lock()
+  device.reconnect_backoff = {}
+  device.reconnect_max_delay = 0.5
+  client = FlappingClient()
+  start = time.time()
+  results = [device.reconnect_closed(client, 'system_server') for _ in range(6)]
+  # 0, 0.2 and 0.4s before the reconnects, then it gives up
+  assert results[:3] == [True, True, True]
+  assert results[3] is False
+  assert client.reconnects < 6
+  assert time.time() - start < 2
+
+
+def test_reconnect_to_dead_server(rpc_server):
+  device = AlbatrossDevice.__new__(AlbatrossDevice)
+  device.device_id = 'emu-1'
+  device.stats_lock = threading.Lock()
+  device.reconnect_backoff = {}
+  client = connect(rpc_server)
+  rpc_server.accept_only = True
+  client.close()
+  assert not device.reconnect_closed(client, 'system_server')
@@ -0,0 +1,103 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+from albatross.device import AlbatrossDevice
+from albatross.rpc_client import RpcException
+
+
+class Agent(object):
+  """stands in for a loaded SystemServerClient"""
+
+  def __init__(self, apis, fail=False):
+    self.allow_apis = dict.fromkeys(apis)
+    self.fail = fail
+    self.calls = []
+
+  def __getattr__(self, method):
+    def call(*args):
+      self.calls.append((method, args))
+      if self.fail:
+        raise RpcException('agent broken')
+      return {'get_packages': ['com.a'], 'get_main_activities': ['com.a/.Main'], 'is_screen_on': False,
+        'start_activity': 'success', 'force_stop_app': True}[method]
+
+    return call
+
+
+class ShellDevice(AlbatrossDevice):
+
+  def __init__(self, agent=None):
+    self.device_id = 'emu-1'
+    self.thread_state = threading.local()
+    self.process_table = None
+    self.commands = []
+    if agent is not None:
+      self.__dict__['system_server_client'] = agent
+
+  def shell(self, cmd, timeout=None):
+    self.commands.append(cmd)
+    if cmd.startswith('pm list packages'):
+      return 'package:com.shell\n'
+    if cmd == 'dumpsys power':
+      return 'mWakefulness=Awake\n'
+    return ''
+
+
+ALL_APIS = ['get_packages', 'get_main_activities', 'is_screen_on', 'start_activity', 'force_stop_app']
+
+
+def test_agent_answers_without_shell():
+  agent = Agent(ALL_APIS)
+  device = ShellDevice(agent)
+  assert device.get_user_packages() == ['com.a']
+  assert device.is_app_install('com.a')
+  assert device.get_app_main_activities('com.a') == ['com.a/.Main']
+  assert device.is_screen_on is False
+  assert device.start_activity('com.a/.Main')
+  assert device.stop_app('com.a')
+  assert device.commands == []
+  assert ('get_packages', (True, True)) in agent.calls
+  # a relative activity name is expanded for the agent
+  assert ('start_activity', ('com.a', 'com.a.Main', 0)) in agent.calls
+
+
+def test_shell_without_agent():
+  device = ShellDevice()
+  assert device.get_user_packages() == ['com.shell']
+  assert device.is_screen_on is True
+  assert device.commands == ['pm list packages -3 -e', 'dumpsys power']
+
+
+def test_unknown_method_uses_shell():
+  agent = Agent(['get_packages'])
+  device = ShellDevice(agent)
+  assert device.is_screen_on is True
+  assert device.commands == ['dumpsys power'] and agent.calls == []
+
+
+def test_failed_call_falls_back_to_shell():
+  agent = Agent(ALL_APIS, fail=True)
+  device = ShellDevice(agent)
+  assert device.get_user_packages(include_disabled=True) == ['com.shell']
+  assert device.commands == ['pm list packages -3']
+  assert agent.calls == [('get_packages', (True, True))]
+
+
+def test_action_uses_shell():
+  agent = Agent(ALL_APIS)
+  device = ShellDevice(agent)
+  device.start_activity('com.a/.Main', 'android.intent.action.VIEW')
+  assert device.commands == ['am start -n com.a/.Main -a android.intent.action.VIEW'] and agent.calls == []
@@ -0,0 +1,74 @@
+# Copyright 2025 QingWan (qingwanmail@foxmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+import pytest
+
+from albatross.task_graph import TaskGraph
+
+
+def test_dependency_order():
+  graph = TaskGraph('attach')
+  order = []
+  lock = threading.Lock()
+
+  def step(name, delay=0.0):
+    def run():
+      time.sleep(delay)
+      with lock:
+        order.append(name)
+      return name
+    return run
+
+  graph.add('client', step('client', 0.05))
+  graph.add('dex', step('dex'), deps=['client'])
+  graph.add('root', step('root'))
+  graph.add('load', step('load'), deps=['dex', 'root'])
+  assert graph.run() == {'client': 'client', 'dex': 'dex', 'root': 'root', 'load': 'load'}
+  assert order.index('client') < order.index('dex') < order.index('load')
+  assert order.index('root') < order.index('load')
+  assert set(graph.timings) == {'client', 'dex', 'root', 'load', 'total'}
+  assert graph.report().startswith('attach: ')
+
+
+def test_independent_steps_run_in_parallel():
+  graph = TaskGraph('parallel', max_workers=3)
+  barrier = threading.Barrier(3, timeout=2)
+  for i in range(3):
+    graph.add(str(i), barrier.wait)
+  # every step waits for the other two, so this only finishes when they overlap
+  assert len(graph.run()) == 3
+
+
+def test_unknown_dependency():
+  graph = TaskGraph('deps')
+  with pytest.raises(ValueError, match='unknown step'):
+    graph.add('dex', lambda: None, deps=['client'])
+
+
+def test_failure_stops_later_steps():
+  graph = TaskGraph('fail')
+  ran = []
+
+  def fail():
+    raise RuntimeError('no client')
+
+  graph.add('client', fail)
+  graph.add('dex', lambda: ran.append('dex'), deps=['client'])
+  with pytest.raises(RuntimeError, match='no client'):
+    graph.run()
+  assert not ran
+  assert 'client' in graph.timings